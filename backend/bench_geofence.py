@@ -0,0 +1,132 @@
+"""
+Micro-benchmark: nearest stop within 50 m for a route.
+
+Compares the old path (filter STOPS_DF by route, iterrows + haversine) with
+the per-route schedule arrays from schedule.py, one report at a time and as
+one batch per route, on the full merged stops CSV.
+
+    python bench_geofence.py --queries 200
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+import gtfs_snapshot
+from schedule import build_route_schedules
+from spatial import haversine_distance
+
+STOPS_FILE = "../final_merged_with_stops.csv"
+GEOFENCE_RADIUS_M = 50
+
+
+def legacy_nearest(stops_df, route_id, lat, lng):
+    # Same code path validate_user_and_calculate_delay used before the index
+    route_stops = stops_df[stops_df['route_id'].astype(str) == str(route_id)]
+    if route_stops.empty:
+        return None, float('inf')
+    min_dist = float('inf')
+    nearest_stop = None
+    for _, stop in route_stops.iterrows():
+        dist = haversine_distance(lat, lng, stop['stop_lat'], stop['stop_lon'])
+        if dist < min_dist:
+            min_dist = dist
+            nearest_stop = stop
+    if min_dist <= GEOFENCE_RADIUS_M:
+        return nearest_stop['stop_id'], min_dist
+    return None, min_dist
+
+
+def schedule_nearest(schedules, route_id, lat, lng):
+    schedule = schedules.get(str(route_id))
+    if schedule is None:
+        return None, float('inf')
+    stop_index, distance, _, _ = schedule.match([lat], [lng], [0], GEOFENCE_RADIUS_M)
+    if stop_index[0] < 0:
+        return None, float('inf')
+    return schedule.stop_ids[stop_index[0]], distance[0]
+
+
+def schedule_batch(schedules, queries):
+    # One match() call per route for every query on it
+    by_route = {}
+    for i, (route_id, lat, lng) in enumerate(queries):
+        by_route.setdefault(route_id, []).append(i)
+    results = [None] * len(queries)
+    for route_id, indexes in by_route.items():
+        schedule = schedules[route_id]
+        lats = np.array([queries[i][1] for i in indexes])
+        lngs = np.array([queries[i][2] for i in indexes])
+        stop_index, _, _, _ = schedule.match(lats, lngs, np.zeros(len(indexes)), GEOFENCE_RADIUS_M)
+        for i, idx in zip(indexes, stop_index):
+            results[i] = schedule.stop_ids[idx] if idx >= 0 else None
+    return results
+
+
+def make_queries(stops_df, n, seed):
+    # Half the points sit near a stop (jitter ~30 m), half are off-stop
+    rng = random.Random(seed)
+    sample = stops_df.sample(n=n, random_state=seed)
+    queries = []
+    for i, row in enumerate(sample.itertuples(index=False)):
+        jitter = 0.0003 if i % 2 == 0 else 0.01
+        queries.append((str(row.route_id),
+                        row.stop_lat + rng.uniform(-jitter, jitter),
+                        row.stop_lon + rng.uniform(-jitter, jitter)))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the geofence stop lookup.')
+    parser.add_argument('--queries', type=int, default=200, help='Number of lookups')
+    parser.add_argument('--legacy-queries', type=int, default=20, help='Lookups to run on the slow path')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"Loading {STOPS_FILE}...")
+    t0 = time.perf_counter()
+    stops_df = pd.read_csv(STOPS_FILE).sort_values(by=['trip_id', 'arrival_time'])
+    print(f"  {len(stops_df)} rows in {time.perf_counter() - t0:.2f}s")
+
+    t0 = time.perf_counter()
+    schedules = build_route_schedules(gtfs_snapshot.load_merged_stops(STOPS_FILE))
+    print(f"  Built {len(schedules)} route schedules in {time.perf_counter() - t0:.2f}s")
+
+    queries = make_queries(stops_df, args.queries, args.seed)
+
+    t0 = time.perf_counter()
+    indexed_results = [schedule_nearest(schedules, *q) for q in queries]
+    indexed_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    batch_results = schedule_batch(schedules, queries)
+    batch_time = time.perf_counter() - t0
+
+    legacy_queries = queries[:args.legacy_queries]
+    t0 = time.perf_counter()
+    legacy_results = [legacy_nearest(stops_df, *q) for q in legacy_queries]
+    legacy_time = time.perf_counter() - t0
+
+    # Different stop ids at the same distance are ties (stops sharing coordinates)
+    mismatches = sum(
+        1 for a, b in zip(legacy_results, indexed_results)
+        if str(a[0]) != str(b[0]) and abs(a[1] - b[1]) > 0.01
+    )
+    batch_mismatches = sum(1 for a, b in zip(indexed_results, batch_results) if str(a[0]) != str(b))
+
+    legacy_per = legacy_time / max(len(legacy_queries), 1) * 1000
+    indexed_per = indexed_time / max(len(queries), 1) * 1000
+    batch_per = batch_time / max(len(queries), 1) * 1000
+    print("")
+    print(f"Legacy scan     : {legacy_per:10.3f} ms/lookup ({len(legacy_queries)} lookups)")
+    print(f"Schedule, single: {indexed_per:10.3f} ms/lookup ({len(queries)} lookups)")
+    print(f"Schedule, batch : {batch_per:10.3f} ms/lookup ({len(queries)} lookups)")
+    if indexed_per > 0:
+        print(f"Speedup (single): {legacy_per / indexed_per:10.1f}x")
+    print(f"Mismatched results: {mismatches}/{len(legacy_queries)} vs legacy, {batch_mismatches} single vs batch")
+
+
+if __name__ == "__main__":
+    main()
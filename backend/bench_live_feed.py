@@ -0,0 +1,79 @@
+"""
+Benchmark /api/live-buses: fetch + parse per request vs the shared poller cache.
+
+Runs fully offline against fake_otd_server.py:
+
+    python bench_live_feed.py --vehicles 3000 --requests 50
+"""
+import argparse
+import time
+
+import requests
+from google.transit import gtfs_realtime_pb2
+
+from fake_otd_server import FakeFeed, start_server
+from live_feed import LiveFeedPoller
+
+
+def decode(content):
+    # Same shape as main.decode_vehicle_feed, without the route maps
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return [
+        {
+            "id": entity.id,
+            "lat": entity.vehicle.position.latitude,
+            "lng": entity.vehicle.position.longitude,
+            "speed": round(entity.vehicle.position.speed * 3.6, 1),
+            "trip_id": entity.vehicle.trip.trip_id,
+        }
+        for entity in feed.entity if entity.HasField('vehicle')
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the live feed cache.')
+    parser.add_argument('--vehicles', type=int, default=3000)
+    parser.add_argument('--requests', type=int, default=50, help='Simulated client requests')
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args()
+
+    feed = FakeFeed(args.vehicles, unknown_ratio=0.2, seed=1)
+    server = start_server(feed, args.port, update_seconds=0)
+    url = f"http://127.0.0.1:{args.port}/VehiclePositions.pb"
+    print(f"Fake feed: {args.vehicles} vehicles, {len(feed.content)} bytes")
+
+    # Old path: every client request fetches and parses the whole feed
+    t0 = time.perf_counter()
+    for _ in range(args.requests):
+        response = requests.get(url)
+        response.raise_for_status()
+        decode(response.content)
+    legacy = (time.perf_counter() - t0) / args.requests * 1000
+
+    # New path: one poll, then every request reads the cached bytes
+    poller = LiveFeedPoller(url, decode)
+    t0 = time.perf_counter()
+    poller.poll_once()
+    first_poll = (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    poller.poll_once()
+    conditional_poll = (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    for _ in range(args.requests):
+        _ = poller.body, poller.age_seconds()
+    cached = (time.perf_counter() - t0) / args.requests * 1000
+
+    server.shutdown()
+
+    print("")
+    print(f"Fetch + parse per request : {legacy:10.3f} ms/request")
+    print(f"Poller first fetch        : {first_poll:10.3f} ms")
+    print(f"Poller 304 re-poll        : {conditional_poll:10.3f} ms (not_modified={poller.not_modified})")
+    print(f"Cached read               : {cached:10.5f} ms/request")
+
+
+if __name__ == "__main__":
+    main()
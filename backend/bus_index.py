@@ -0,0 +1,64 @@
+from spatial import GridIndex
+
+INDEX_CELL_M = 500 # Grid cell for viewport queries
+
+
+class BusIndex:
+    """
+    Bus dicts by id, with a per-route index and a spatial grid.
+
+    Kept up to date one bus at a time as the published list changes (see
+    BusStream), so a filtered query only touches the buses on the requested
+    routes or in the grid cells under the viewport.
+    """
+
+    def __init__(self, route_key="route_id", cell_m=INDEX_CELL_M):
+        self.route_key = route_key
+        self.buses = {} # bus id -> bus dict
+        self.by_route = {} # route -> set of bus ids
+        self.grid = GridIndex(cell_m)
+
+    def __len__(self):
+        return len(self.buses)
+
+    def upsert(self, bus):
+        bus_id = bus['id']
+        old = self.buses.get(bus_id)
+        route = str(bus.get(self.route_key))
+        if old is not None:
+            old_route = str(old.get(self.route_key))
+            if old_route != route:
+                self._drop_route(old_route, bus_id)
+        self.buses[bus_id] = bus
+        self.by_route.setdefault(route, set()).add(bus_id)
+        self.grid.insert(bus_id, bus['lat'], bus['lng'])
+
+    def remove(self, bus_id):
+        old = self.buses.pop(bus_id, None)
+        if old is None:
+            return False
+        self._drop_route(str(old.get(self.route_key)), bus_id)
+        self.grid.remove(bus_id)
+        return True
+
+    def _drop_route(self, route, bus_id):
+        ids = self.by_route.get(route)
+        if ids is not None:
+            ids.discard(bus_id)
+            if not ids:
+                del self.by_route[route]
+
+    def query(self, bus_filter):
+        """Buses matching a BusFilter, using whichever index narrows it down."""
+        if bus_filter.route_ids is not None:
+            candidates = set()
+            for route in bus_filter.route_ids:
+                candidates.update(self.by_route.get(route, ()))
+            if bus_filter.bbox is not None and len(candidates) > 64:
+                candidates.intersection_update(self.grid.within(*bus_filter.bbox))
+        elif bus_filter.bbox is not None:
+            candidates = self.grid.within(*bus_filter.bbox)
+        else:
+            candidates = self.buses
+        buses = self.buses
+        return [buses[bus_id] for bus_id in candidates if bus_filter.matches(buses[bus_id])]
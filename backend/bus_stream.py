@@ -0,0 +1,194 @@
+"""
+Server-Sent Events push for the bus lists.
+
+A BusStream keeps the last published list of one source (virtual or live
+buses) and a short log of changes. Each client gets the current snapshot
+once, then only deltas - buses added, moved (or otherwise changed) and
+removed - narrowed to the routes / bounding box it asked for. A client that
+falls too far behind the log gets a fresh snapshot instead.
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+
+from bus_index import BusIndex
+
+HEARTBEAT_SECONDS = 15
+
+
+class BusFilter:
+    """route ids / bounding box / minimum confidence; None means "any"."""
+
+    __slots__ = ('route_ids', 'bbox', 'min_confidence', 'route_key')
+
+    def __init__(self, route_ids=None, bbox=None, min_confidence=None, route_key="route_id"):
+        self.route_ids = set(route_ids) if route_ids is not None else None
+        self.bbox = bbox # (west, south, east, north)
+        self.min_confidence = min_confidence
+        self.route_key = route_key
+
+    @property
+    def is_empty(self):
+        return self.route_ids is None and self.bbox is None and self.min_confidence is None
+
+    def matches(self, bus):
+        if self.route_ids is not None and str(bus.get(self.route_key)) not in self.route_ids:
+            return False
+        if self.bbox is not None:
+            west, south, east, north = self.bbox
+            if not (south <= bus['lat'] <= north and west <= bus['lng'] <= east):
+                return False
+        if self.min_confidence is not None and bus.get('confidence', 1.0) < self.min_confidence:
+            return False
+        return True
+
+
+class BusStream:
+    """
+    Latest bus list of one source plus a bounded change log.
+
+    update() / apply() are called from whatever thread publishes the list;
+    subscribers run on the event loop and are woken thread-safely.
+    """
+
+    def __init__(self, name, route_key="route_id", log_size=256):
+        self.name = name
+        self.route_key = route_key
+        self.lock = threading.Lock()
+        self.index = BusIndex(route_key) # current buses, by id / route / grid cell
+        self.version = 0
+        self.log = deque(maxlen=log_size) # (version, changed bus dicts, removed ids)
+        self.subscribers = 0
+        self.resyncs = 0
+        self._loop = None
+        self._event = None
+
+    def update(self, buses):
+        """Publish a full list; the delta is worked out against the last one."""
+        with self.lock:
+            current = self.index.buses
+            fresh = {bus['id']: bus for bus in buses}
+            changed = [bus for bus_id, bus in fresh.items() if current.get(bus_id) != bus]
+            removed = [bus_id for bus_id in current if bus_id not in fresh]
+            self._apply(changed, removed)
+
+    def apply(self, changed, removed):
+        """Publish known changes (e.g. ClusterEngine's dirty set) without a full diff."""
+        with self.lock:
+            self._apply(changed, removed)
+
+    def _apply(self, changed, removed):
+        for bus in changed:
+            self.index.upsert(bus)
+        removed = [bus_id for bus_id in removed if self.index.remove(bus_id)]
+        if not changed and not removed:
+            return
+        self.version += 1
+        self.log.append((self.version, changed, removed))
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                self._loop = None # Loop closed (app shut down)
+
+    def query(self, bus_filter):
+        """Current buses matching bus_filter (served from the route / grid indexes)."""
+        with self.lock:
+            return self.index.query(bus_filter)
+
+    def _wake(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    def snapshot(self):
+        with self.lock:
+            return self.version, list(self.index.buses.values())
+
+    def since(self, version):
+        """Log entries after `version`, or None if some have already been dropped."""
+        with self.lock:
+            if version == self.version:
+                return []
+            if not self.log or self.log[0][0] > version + 1:
+                return None
+            return [entry for entry in self.log if entry[0] > version]
+
+    async def wait(self, version, timeout):
+        """Wait until the version moves past `version`. False on timeout."""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+        while self.version == version:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def events(self, bus_filter, heartbeat_seconds=HEARTBEAT_SECONDS):
+        """SSE event strings for one client: snapshot, then deltas."""
+        self.subscribers += 1
+        try:
+            version, visible, message = self._snapshot_event(bus_filter)
+            yield message
+            while True:
+                if not await self.wait(version, heartbeat_seconds):
+                    yield ": ping\n\n"
+                    continue
+                entries = self.since(version)
+                if entries is None:
+                    # Too slow for the log; start over from a snapshot
+                    self.resyncs += 1
+                    version, visible, message = self._snapshot_event(bus_filter)
+                    yield message
+                    continue
+                if not entries:
+                    continue
+                version = entries[-1][0]
+                delta = _delta(entries, visible, bus_filter)
+                if delta is not None:
+                    delta["version"] = version
+                    yield f"event: delta\ndata: {json.dumps(delta)}\n\n"
+        finally:
+            self.subscribers -= 1
+
+    def _snapshot_event(self, bus_filter):
+        with self.lock:
+            version, buses = self.version, self.index.query(bus_filter)
+        visible = {bus['id'] for bus in buses}
+        message = f"event: snapshot\ndata: {json.dumps({'version': version, 'buses': buses})}\n\n"
+        return version, visible, message
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "buses": len(self.index),
+            "subscribers": self.subscribers,
+            "resyncs": self.resyncs,
+        }
+
+
+def _delta(entries, visible, bus_filter):
+    """Fold log entries into one added/moved/removed message for a client."""
+    touched = {} # bus id -> latest bus dict, or None if removed
+    for _, changed, removed in entries:
+        for bus in changed:
+            touched[bus['id']] = bus
+        for bus_id in removed:
+            touched[bus_id] = None
+
+    added, moved, removed = [], [], []
+    for bus_id, bus in touched.items():
+        now = bus is not None and bus_filter.matches(bus)
+        before = bus_id in visible
+        if now:
+            (moved if before else added).append(bus)
+            visible.add(bus_id)
+        elif before:
+            # Gone, or left the client's routes / viewport
+            removed.append(bus_id)
+            visible.discard(bus_id)
+    if not (added or moved or removed):
+        return None
+    return {"added": added, "moved": moved, "removed": removed}
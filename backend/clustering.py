@@ -0,0 +1,256 @@
+from collections import deque
+
+from spatial import GridIndex
+
+
+class Cluster:
+    """A group of riders on one route that we believe are on the same bus."""
+
+    __slots__ = ('id', 'seq', 'route_id', 'members', 'sum_lat', 'sum_lng',
+                 'delay_total', 'delay_count', 'last_updated')
+
+    def __init__(self, cluster_id, seq, route_id):
+        self.id = cluster_id
+        self.seq = seq # creation order, older clusters win merges
+        self.route_id = route_id
+        self.members = set() # user_ids
+        self.sum_lat = 0.0
+        self.sum_lng = 0.0
+        self.delay_total = 0.0
+        self.delay_count = 0 # reports validated against a stop
+        self.last_updated = 0.0
+
+    @property
+    def lat(self):
+        return self.sum_lat / len(self.members)
+
+    @property
+    def lng(self):
+        return self.sum_lng / len(self.members)
+
+    @property
+    def avg_delay(self):
+        return self.delay_total / self.delay_count if self.delay_count > 0 else 0.0
+
+
+class ClusterEngine:
+    """
+    Incremental clustering of live rider reports into virtual buses.
+
+    Instead of regrouping every report on every POST, each route keeps a
+    spatial hash of its cluster centroids. A new or moved report is detached
+    from its old cluster and attached to the nearest centroid within
+    `radius_m` (or starts a new cluster), so one report only touches the
+    cells around it. Reports expire from a time-ordered queue, and clusters
+    keep their id for as long as they have members.
+
+    `validator(route_id, reports) -> [(stop_id, delay_minutes), ...]` runs
+    once per route per batch on ingest; each result is folded into the
+    cluster's running delay average.
+
+    At most `max_reports` riders are held: a new rider beyond that evicts
+    the one whose latest report is oldest, so memory stays flat however
+    many ids a client makes up.
+    """
+
+    def __init__(self, radius_m=50, ttl_seconds=300, validator=None, max_reports=None):
+        self.radius_m = radius_m
+        self.ttl_seconds = ttl_seconds
+        self.validator = validator
+        self.max_reports = max_reports
+        self.evicted = 0
+        self.last_evicted = [] # user ids evicted by the last upsert_many()
+
+        self.reports = {} # user_id -> latest report
+        self.report_cluster = {} # user_id -> cluster id
+        self.report_delay = {} # user_id -> delay minutes (only if validated)
+        self.expiry = deque() # (timestamp, user_id), oldest first
+
+        self.clusters = {} # cluster id -> Cluster
+        self.route_grids = {} # route_id -> GridIndex of cluster centroids
+        self._next_id = 0
+
+        # Changes since the last publish()
+        self.dirty = set()
+        self.removed = set()
+        self.buses = {} # cluster id -> published bus object
+        self.last_changed = [] # bus objects rebuilt by the last publish()
+        self.last_removed = [] # cluster ids dropped by the last publish()
+
+    def __len__(self):
+        return len(self.reports)
+
+    # --- Ingest ---
+    def upsert(self, report):
+        """Add a report, replacing any earlier one from the same user."""
+        self.upsert_many([report])
+
+    def upsert_many(self, reports):
+        """Add a batch of reports; stop validation runs once per route."""
+        delays = [None] * len(reports)
+        if self.validator is not None:
+            by_route = {}
+            for i, report in enumerate(reports):
+                by_route.setdefault(report.route_id, []).append(i)
+            for route_id, indexes in by_route.items():
+                results = self.validator(route_id, [reports[i] for i in indexes])
+                for i, (stop_id, delay_minutes) in zip(indexes, results):
+                    if stop_id is not None:
+                        delays[i] = delay_minutes
+
+        self.last_evicted = []
+        for report, delay in zip(reports, delays):
+            if report.user_id in self.reports:
+                self._detach(report.user_id)
+            elif self.max_reports is not None and len(self.reports) >= self.max_reports:
+                self._evict_oldest()
+            self.reports[report.user_id] = report
+            self.expiry.append((report.timestamp, report.user_id))
+            self._attach(report, delay)
+        self._compact_expiry()
+
+    def remove(self, user_id):
+        if user_id in self.reports:
+            self._detach(user_id)
+            del self.reports[user_id]
+
+    def expire(self, now):
+        """Drop reports older than the TTL and return their user ids."""
+        expired = []
+        while self.expiry and now - self.expiry[0][0] >= self.ttl_seconds:
+            timestamp, user_id = self.expiry.popleft()
+            report = self.reports.get(user_id)
+            # The user may have reported again since; only the latest counts
+            if report is not None and report.timestamp == timestamp:
+                self.remove(user_id)
+                expired.append(user_id)
+        return expired
+
+    def _evict_oldest(self):
+        # Front of the expiry queue, skipping entries superseded by a newer report
+        while self.expiry:
+            timestamp, user_id = self.expiry.popleft()
+            report = self.reports.get(user_id)
+            if report is not None and report.timestamp == timestamp:
+                self.remove(user_id)
+                self.evicted += 1
+                self.last_evicted.append(user_id)
+                return
+
+    def _compact_expiry(self):
+        # Every report appends to the queue, so a chatty rider leaves stale
+        # entries behind until they age out; rebuild once they dominate
+        if len(self.expiry) <= 2 * len(self.reports) + 1024:
+            return
+        self.expiry = deque(sorted((report.timestamp, user_id) for user_id, report in self.reports.items()))
+
+    # --- Output ---
+    def publish(self, bus_factory):
+        """
+        Rebuild the bus objects of clusters that changed since the last call
+        and return the full list. Unchanged clusters reuse their old object.
+        """
+        removed = []
+        for cluster_id in self.removed:
+            if self.buses.pop(cluster_id, None) is not None:
+                removed.append(cluster_id)
+        changed = []
+        for cluster_id in self.dirty:
+            cluster = self.clusters.get(cluster_id)
+            if cluster is not None:
+                bus = bus_factory(cluster)
+                self.buses[cluster_id] = bus
+                changed.append(bus)
+        self.dirty.clear()
+        self.removed.clear()
+        # What this call changed, for delta consumers (see bus_stream.py)
+        self.last_changed = changed
+        self.last_removed = removed
+        return list(self.buses.values())
+
+    # --- Internals ---
+    def _grid(self, route_id):
+        grid = self.route_grids.get(route_id)
+        if grid is None:
+            grid = GridIndex(self.radius_m)
+            self.route_grids[route_id] = grid
+        return grid
+
+    def _new_cluster(self, route_id):
+        seq = self._next_id
+        self._next_id += 1
+        cluster = Cluster(f"vbus_{route_id}_{seq}", seq, route_id)
+        self.clusters[cluster.id] = cluster
+        return cluster
+
+    def _attach(self, report, delay):
+        grid = self._grid(report.route_id)
+        cluster_id, _ = grid.nearest(report.lat, report.lng, self.radius_m)
+        if cluster_id is not None:
+            cluster = self.clusters[cluster_id]
+        else:
+            cluster = self._new_cluster(report.route_id)
+
+        cluster.members.add(report.user_id)
+        cluster.sum_lat += report.lat
+        cluster.sum_lng += report.lng
+        if delay is not None:
+            cluster.delay_total += delay
+            cluster.delay_count += 1
+            self.report_delay[report.user_id] = delay
+        cluster.last_updated = max(cluster.last_updated, report.timestamp)
+        self.report_cluster[report.user_id] = cluster.id
+        self._centroid_moved(cluster)
+
+    def _detach(self, user_id):
+        report = self.reports[user_id]
+        cluster = self.clusters[self.report_cluster.pop(user_id)]
+        cluster.members.discard(user_id)
+        cluster.sum_lat -= report.lat
+        cluster.sum_lng -= report.lng
+        delay = self.report_delay.pop(user_id, None)
+        if delay is not None:
+            cluster.delay_total -= delay
+            cluster.delay_count -= 1
+
+        if not cluster.members:
+            self._drop_cluster(cluster)
+        else:
+            self._centroid_moved(cluster)
+
+    def _drop_cluster(self, cluster):
+        self._grid(cluster.route_id).remove(cluster.id)
+        del self.clusters[cluster.id]
+        self.dirty.discard(cluster.id)
+        self.removed.add(cluster.id)
+
+    def _centroid_moved(self, cluster):
+        grid = self._grid(cluster.route_id)
+        grid.insert(cluster.id, cluster.lat, cluster.lng)
+        self.dirty.add(cluster.id)
+
+        # Two clusters that drifted together are the same bus: fold the
+        # smaller one into the larger (older id wins on a tie).
+        other_id, _ = grid.nearest(cluster.lat, cluster.lng, self.radius_m, exclude=cluster.id)
+        if other_id is None:
+            return
+        other = self.clusters[other_id]
+        if (len(other.members), -other.seq) > (len(cluster.members), -cluster.seq):
+            keep, gone = other, cluster
+        else:
+            keep, gone = cluster, other
+        self._merge(keep, gone)
+
+    def _merge(self, keep, gone):
+        for user_id in gone.members:
+            self.report_cluster[user_id] = keep.id
+        keep.members |= gone.members
+        keep.sum_lat += gone.sum_lat
+        keep.sum_lng += gone.sum_lng
+        keep.delay_total += gone.delay_total
+        keep.delay_count += gone.delay_count
+        keep.last_updated = max(keep.last_updated, gone.last_updated)
+        gone.members = set()
+        self._drop_cluster(gone)
+        self._centroid_moved(keep)
+
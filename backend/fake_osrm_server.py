@@ -0,0 +1,91 @@
+"""
+Local stand-in for the OSRM /route/v1/driving endpoint.
+
+Answers with a straight-line polyline through the requested coordinates
+(a few interpolated points per leg) after an optional artificial latency,
+so generate_shapes.py can be run and timed without hitting the public
+server:
+
+    python fake_osrm_server.py --port 5001 --latency 0.3
+    python generate_shapes.py --osrm http://localhost:5001 --delay 0
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import polyline
+
+POINTS_PER_LEG = 5
+
+
+def fake_route(coords):
+    """[(lon, lat), ...] -> [(lat, lon), ...] along straight legs."""
+    path = []
+    for (lon_a, lat_a), (lon_b, lat_b) in zip(coords, coords[1:]):
+        for i in range(POINTS_PER_LEG):
+            t = i / POINTS_PER_LEG
+            path.append((lat_a + (lat_b - lat_a) * t, lon_a + (lon_b - lon_a) * t))
+    lon, lat = coords[-1]
+    path.append((lat, lon))
+    return path
+
+
+def make_handler(latency_seconds, counter):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with counter['lock']:
+                counter['requests'] += 1
+            path = urlsplit(self.path).path # urlparse would split off ";..." as params
+            prefix = "/route/v1/driving/"
+            if not path.startswith(prefix):
+                self.send_error(404)
+                return
+            try:
+                coords = [tuple(float(x) for x in pair.split(',')) for pair in path[len(prefix):].split(';')]
+            except ValueError:
+                self.send_error(400)
+                return
+            if latency_seconds:
+                time.sleep(latency_seconds)
+
+            if len(coords) < 2:
+                body = {"code": "InvalidQuery", "routes": []}
+            else:
+                body = {"code": "Ok", "routes": [{"geometry": polyline.encode(fake_route(coords))}]}
+            content = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(port, latency_seconds=0.0):
+    """Serve on a background thread. Returns (server, counter)."""
+    counter = {"requests": 0, "lock": threading.Lock()}
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency_seconds, counter))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, counter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a fake OSRM route endpoint.')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency', type=float, default=0.3, help='Seconds to wait before each answer')
+    args = parser.parse_args()
+
+    start_server(args.port, args.latency)
+    print(f"Fake OSRM: http://localhost:{args.port} (latency {args.latency}s)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
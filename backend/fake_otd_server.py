@@ -0,0 +1,145 @@
+"""
+Local stand-in for the OTD VehiclePositions feed.
+
+Serves a synthetic GTFS-realtime FeedMessage that changes every few seconds,
+with ETag / If-None-Match support, so the /api/live-buses poller can be
+tested and benchmarked offline:
+
+    python fake_otd_server.py --vehicles 3000 --port 8081
+    OTD_URL=http://localhost:8081/VehiclePositions.pb uvicorn main:app
+
+Use --dump feed.pb to write one snapshot to a file instead of serving.
+"""
+import argparse
+import hashlib
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+from google.transit import gtfs_realtime_pb2
+
+GTFS_FOLDER = "../GTFS"
+
+# Delhi bounding box
+MIN_LAT, MAX_LAT = 28.40, 28.88
+MIN_LNG, MAX_LNG = 76.84, 77.35
+
+
+class FakeFeed:
+    def __init__(self, vehicles, unknown_ratio, seed):
+        rng = random.Random(seed)
+        trip_ids = load_trip_ids()
+        self.vehicles = []
+        for i in range(vehicles):
+            if trip_ids and rng.random() >= unknown_ratio:
+                trip_id = rng.choice(trip_ids)
+            else:
+                # Live ids the static feed doesn't know (see debug_log.txt)
+                trip_id = f"{rng.randint(1000, 9999)}_0_{rng.randint(0, 30)}"
+            self.vehicles.append({
+                "id": f"DL1PC{i:04d}",
+                "trip_id": trip_id,
+                "lat": rng.uniform(MIN_LAT, MAX_LAT),
+                "lng": rng.uniform(MIN_LNG, MAX_LNG),
+                "speed": rng.uniform(0, 15), # m/s
+            })
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.content = b""
+        self.etag = ""
+        self.version = 0
+        self.step()
+
+    def step(self):
+        """Move every vehicle a little and rebuild the encoded feed."""
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.timestamp = int(time.time())
+        for v in self.vehicles:
+            v["lat"] += self.rng.uniform(-0.0005, 0.0005)
+            v["lng"] += self.rng.uniform(-0.0005, 0.0005)
+            entity = feed.entity.add()
+            entity.id = v["id"]
+            entity.vehicle.trip.trip_id = v["trip_id"]
+            entity.vehicle.position.latitude = v["lat"]
+            entity.vehicle.position.longitude = v["lng"]
+            entity.vehicle.position.speed = v["speed"]
+            entity.vehicle.timestamp = feed.header.timestamp
+        content = feed.SerializeToString()
+        with self.lock:
+            self.content = content
+            self.etag = '"' + hashlib.md5(content).hexdigest() + '"'
+            self.version += 1
+
+
+def load_trip_ids():
+    trips_path = os.path.join(GTFS_FOLDER, 'trips.txt')
+    if not os.path.exists(trips_path):
+        return []
+    return pd.read_csv(trips_path, usecols=['trip_id'])['trip_id'].astype(str).tolist()
+
+
+def make_handler(feed):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with feed.lock:
+                content, etag = feed.content, feed.etag
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-protobuf")
+            self.send_header("Content-Length", str(len(content)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass # Quiet; this gets hit a lot in benchmarks
+
+    return Handler
+
+
+def start_server(feed, port, update_seconds):
+    """Serve `feed` on a background thread. Returns the server."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(feed))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def updater():
+        while True:
+            time.sleep(update_seconds)
+            feed.step()
+
+    if update_seconds > 0:
+        threading.Thread(target=updater, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a fake OTD VehiclePositions feed.')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--vehicles', type=int, default=3000, help='Number of vehicles in the feed')
+    parser.add_argument('--unknown-ratio', type=float, default=0.2, help='Share of trip ids missing from trips.txt')
+    parser.add_argument('--update-seconds', type=float, default=10.0, help='How often positions change')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dump', type=str, help='Write one feed snapshot to this file and exit')
+    args = parser.parse_args()
+
+    feed = FakeFeed(args.vehicles, args.unknown_ratio, args.seed)
+    if args.dump:
+        with open(args.dump, 'wb') as f:
+            f.write(feed.content)
+        print(f"Wrote {len(feed.vehicles)} vehicles ({len(feed.content)} bytes) to {args.dump}")
+    else:
+        start_server(feed, args.port, args.update_seconds)
+        print(f"Fake OTD feed: http://localhost:{args.port}/VehiclePositions.pb ({args.vehicles} vehicles)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,206 @@
+"""
+Local stand-in for Redis, for running several workers with STATE_BACKEND=redis
+without installing Redis:
+
+    python fake_redis_server.py --port 6390
+    STATE_BACKEND=redis STATE_REDIS_URL=redis://127.0.0.1:6390/0 \
+        uvicorn main:app --workers 4
+
+Single process, in memory, and only the commands state_store.py uses.
+There is no Lua: EVAL runs the Python twin of each script state_store.py
+sends, looked up by the script text (one command at a time, so it is
+atomic like the real thing).
+"""
+import argparse
+import asyncio
+import time
+
+from state_store import RENEW_LEASE_SCRIPT
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.expires = {} # key -> monotonic deadline
+        self.scripts = {RENEW_LEASE_SCRIPT: self._renew_lease}
+
+    def _alive(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and time.monotonic() >= deadline:
+            self.data.pop(key, None)
+            del self.expires[key]
+        return key in self.data
+
+    def execute(self, args):
+        command = args[0].decode().upper()
+        handler = getattr(self, f"cmd_{command.lower()}", None)
+        if handler is None:
+            return RuntimeError(f"ERR unknown command '{command}'")
+        try:
+            return handler(*args[1:])
+        except (TypeError, ValueError) as e:
+            return RuntimeError(f"ERR {e}")
+
+    def cmd_ping(self, *args):
+        return "PONG"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_get(self, key):
+        return self.data.get(key) if self._alive(key) else None
+
+    def cmd_set(self, key, value, *options):
+        options = [o.decode().upper() for o in options]
+        exists = self._alive(key)
+        if "NX" in options and exists:
+            return None
+        if "XX" in options and not exists:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if "PX" in options:
+            ms = int(options[options.index("PX") + 1])
+            self.expires[key] = time.monotonic() + ms / 1000.0
+        return "OK"
+
+    def cmd_pexpire(self, key, ms):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.monotonic() + int(ms) / 1000.0
+        return 1
+
+    def cmd_eval(self, script, numkeys, *args):
+        handler = self.scripts.get(script.decode())
+        if handler is None:
+            return RuntimeError("ERR fake redis only runs the scripts state_store.py uses")
+        n = int(numkeys)
+        return handler(args[:n], args[n:])
+
+    def _renew_lease(self, keys, argv):
+        if self.cmd_get(keys[0]) == argv[0]:
+            return self.cmd_pexpire(keys[0], argv[1])
+        return 0
+
+    def cmd_incr(self, key):
+        value = int(self.cmd_get(key) or 0) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    def cmd_rpush(self, key, *values):
+        if not self._alive(key):
+            self.data[key] = []
+        items = self.data[key]
+        items.extend(values)
+        return len(items)
+
+    def cmd_lpop(self, key, count=None):
+        items = self.data.get(key) if self._alive(key) else None
+        if not items:
+            return None
+        if count is None:
+            return items.pop(0)
+        n = int(count)
+        popped, self.data[key] = items[:n], items[n:]
+        return popped
+
+    def cmd_llen(self, key):
+        return len(self.data.get(key, [])) if self._alive(key) else 0
+
+    def cmd_hset(self, key, *pairs):
+        table = self.data.setdefault(key, {})
+        added = 0
+        for i in range(0, len(pairs), 2):
+            if pairs[i] not in table:
+                added += 1
+            table[pairs[i]] = pairs[i + 1]
+        return added
+
+    def cmd_hdel(self, key, *fields):
+        table = self.data.get(key, {})
+        return sum(1 for f in fields if table.pop(f, None) is not None)
+
+    def cmd_hlen(self, key):
+        return len(self.data.get(key, {}))
+
+    def cmd_hgetall(self, key):
+        flat = []
+        for field, value in self.data.get(key, {}).items():
+            flat.extend((field, value))
+        return flat
+
+
+def encode(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, RuntimeError):
+        return f"-{reply}\r\n".encode()
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
+    raise TypeError(type(reply))
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.split() # Inline command (e.g. from telnet)
+    args = []
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+def make_handler(store):
+    async def handle(reader, writer):
+        try:
+            while True:
+                args = await read_command(reader)
+                if not args:
+                    break
+                writer.write(encode(store.execute(args)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(port):
+    server = await asyncio.start_server(make_handler(FakeRedis()), "127.0.0.1", port)
+    print(f"Fake Redis listening on 127.0.0.1:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a tiny in-memory Redis stand-in.')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,113 +1,261 @@
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 import polyline
 import json
 import os
 import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 GTFS_FOLDER = "../GTFS"
 OUTPUT_FILE = "route_shapes.json"
+SEGMENT_CACHE_FILE = "route_segments.cache.jsonl" # One routed stop pair per line
+OSRM_URL = os.environ.get("OSRM_URL", "http://router.project-osrm.org")
 
-def generate_shapes():
+def load_gtfs(gtfs_folder):
+    routes_df = pd.read_csv(os.path.join(gtfs_folder, 'routes.txt'), usecols=['route_id'])
+    trips_df = pd.read_csv(os.path.join(gtfs_folder, 'trips.txt'), usecols=['route_id', 'trip_id'])
+    stop_times_df = pd.read_csv(os.path.join(gtfs_folder, 'stop_times.txt'), usecols=['trip_id', 'stop_id', 'stop_sequence'])
+    stops_df = pd.read_csv(os.path.join(gtfs_folder, 'stops.txt'), usecols=['stop_id', 'stop_lat', 'stop_lon'])
+    return routes_df, trips_df, stop_times_df, stops_df
+
+def plan_routes(routes_df, trips_df, stop_times_df, stops_df):
+    """
+    Pick one representative trip per route and return
+    {route_id: [(stop_id, lat, lon), ...]}.
+
+    Everything is grouped once up front instead of filtering the full
+    trips / stop_times tables for every route. The representative trip is
+    the one with the most stops (ties -> smallest trip_id), so reruns pick
+    the same trip.
+    """
+    # Stops per trip, in order
+    stop_times_df = stop_times_df.sort_values(['trip_id', 'stop_sequence'], kind='stable')
+    stop_counts = stop_times_df.groupby('trip_id').size().rename('stop_count')
+
+    # Longest trip per route
+    trips = trips_df.join(stop_counts, on='trip_id', how='inner')
+    trips['trip_key'] = trips['trip_id'].astype(str)
+    trips = trips.sort_values(['route_id', 'stop_count', 'trip_key'], ascending=[True, False, True])
+    best_trips = trips.drop_duplicates('route_id', keep='first')
+
+    # Coordinates of those trips only
+    stops_map = stops_df.set_index('stop_id')[['stop_lat', 'stop_lon']]
+    best_stop_times = stop_times_df[stop_times_df['trip_id'].isin(best_trips['trip_id'])]
+    best_stop_times = best_stop_times.join(stops_map, on='stop_id', how='inner')
+    coords_by_trip = {
+        trip_id: list(zip(group['stop_id'].astype(str), group['stop_lat'], group['stop_lon']))
+        for trip_id, group in best_stop_times.groupby('trip_id', sort=False)
+    }
+
+    known_routes = set(routes_df['route_id'])
+    plan = {}
+    for route_id, trip_id in zip(best_trips['route_id'], best_trips['trip_id']):
+        stops = coords_by_trip.get(trip_id, [])
+        if route_id in known_routes and len(stops) >= 2:
+            plan[str(route_id)] = stops
+    return plan
+
+def stop_pairs(stops):
+    """Consecutive (a, b) stop pairs of a trip, skipping repeats of the same stop."""
+    return [(a, b) for a, b in zip(stops, stops[1:]) if a[0] != b[0]]
+
+class SegmentCache:
+    """
+    Routed geometry between two consecutive stops, keyed by (stop_a, stop_b).
+
+    Routes in Delhi share long corridors, so the same stop pair shows up in
+    many routes; each pair is routed once and every route is assembled from
+    cached segments. Entries are appended to a JSONL file as they arrive,
+    which also makes an interrupted run resumable. An entry is ignored if
+    either stop has moved since it was routed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = {} # (stop_a, stop_b) -> (coords, encoded polyline)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._file = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # Half-written last line from a crash
+                    self.segments[(entry['a'], entry['b'])] = (entry['coords'], entry['geometry'])
+
+    def __len__(self):
+        return len(self.segments)
+
+    def has(self, a, b):
+        entry = self.segments.get((a[0], b[0]))
+        return entry is not None and _same_coords(entry[0], (a[1], a[2], b[1], b[2]))
+
+    def get(self, a, b):
+        """Cached path for stop tuples a -> b ((stop_id, lat, lon)), or None."""
+        entry = self.segments.get((a[0], b[0]))
+        if entry is None:
+            self.misses += 1
+            return None
+        if not _same_coords(entry[0], (a[1], a[2], b[1], b[2])):
+            self.stale += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return polyline.decode(entry[1])
+
+    def put(self, a, b, path):
+        coords = [a[1], a[2], b[1], b[2]]
+        geometry = polyline.encode(path)
+        with self.lock:
+            self.segments[(a[0], b[0])] = (coords, geometry)
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps({"a": a[0], "b": b[0], "coords": coords, "geometry": geometry}) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "segments": len(self.segments),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+def _same_coords(cached, current):
+    return all(abs(x - y) < 1e-6 for x, y in zip(cached, current))
+
+def assemble_shape(stops, cache):
+    """Join the cached segments of a route, or None if any is missing."""
+    shape = []
+    for a, b in stop_pairs(stops):
+        path = cache.get(a, b)
+        if not path:
+            return None
+        # Segments share their end/start stop
+        shape.extend(path[1:] if shape else path)
+    return shape
+
+class ShapeRouter:
+    """OSRM client shared by the worker threads (pooled session, optional delay)."""
+
+    def __init__(self, base_url, workers, delay_seconds=0.0, timeout_seconds=30.0):
+        self.base_url = base_url.rstrip('/')
+        self.delay_seconds = delay_seconds
+        self.timeout_seconds = timeout_seconds
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def route(self, coords):
+        # OSRM expects Lon,Lat
+        coordinates_string = ";".join(f"{lon},{lat}" for lat, lon in coords)
+        url = f"{self.base_url}/route/v1/driving/{coordinates_string}?overview=full&geometries=polyline"
+        if self.delay_seconds:
+            # Be nice to the free API
+            time.sleep(self.delay_seconds)
+        r = self.session.get(url, timeout=self.timeout_seconds)
+        if r.status_code != 200:
+            raise RuntimeError(f"HTTP {r.status_code}")
+        data = r.json()
+        if 'routes' not in data or len(data['routes']) == 0:
+            return None
+        return polyline.decode(data['routes'][0]['geometry']) # [(lat, lng), ...]
+
+def generate_shapes(gtfs_folder=GTFS_FOLDER, osrm_url=OSRM_URL, workers=4, delay_seconds=0.2,
+                    output_file=OUTPUT_FILE, cache_file=SEGMENT_CACHE_FILE, limit=None):
     print("Loading GTFS data...")
     try:
-        routes_df = pd.read_csv(os.path.join(GTFS_FOLDER, 'routes.txt'))
-        trips_df = pd.read_csv(os.path.join(GTFS_FOLDER, 'trips.txt'))
-        stop_times_df = pd.read_csv(os.path.join(GTFS_FOLDER, 'stop_times.txt'))
-        stops_df = pd.read_csv(os.path.join(GTFS_FOLDER, 'stops.txt'))
+        routes_df, trips_df, stop_times_df, stops_df = load_gtfs(gtfs_folder)
     except Exception as e:
         print(f"Error loading GTFS files: {e}")
         return
 
-    # Create a map of stop_id -> (lat, lon)
-    stops_map = stops_df.set_index('stop_id')[['stop_lat', 'stop_lon']].to_dict('index')
+    plan = plan_routes(routes_df, trips_df, stop_times_df, stops_df)
+    if limit is not None:
+        plan = dict(list(plan.items())[:limit])
+    print(f"Found {len(routes_df)} routes, {len(plan)} with a usable trip.")
+
+    # Only stop pairs nobody has routed yet go to OSRM, each one once
+    cache = SegmentCache(cache_file)
+    todo = {}
+    total_pairs = 0
+    for stops in plan.values():
+        for a, b in stop_pairs(stops):
+            total_pairs += 1
+            if (a[0], b[0]) not in todo and not cache.has(a, b):
+                todo[(a[0], b[0])] = (a, b)
+    print(f"{total_pairs} stop pairs, {len(todo)} unique pairs to route ({len(cache)} segments cached in {cache_file}).")
+
+    router = ShapeRouter(osrm_url, workers, delay_seconds)
+    total = len(todo)
+    done = 0
+    failed = 0
+    started = time.perf_counter()
 
-    # Get unique routes
-    unique_route_ids = routes_df['route_id'].unique()
-    print(f"Found {len(unique_route_ids)} routes.")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(router.route, [(a[1], a[2]), (b[1], b[2])]): (a, b)
+            for a, b in todo.values()
+        }
+        for future in as_completed(futures):
+            a, b = futures[future]
+            done += 1
+            try:
+                path = future.result()
+            except Exception as e:
+                path = None
+                print(f"[{done}/{total}] Error for segment {a[0]} -> {b[0]}: {e}")
+            if path is None:
+                failed += 1
+                continue
+            cache.put(a, b, path)
+            if done % 500 == 0 or done == total:
+                print(f"[{done}/{total}] segments routed")
+    cache.close()
+    routed_time = time.perf_counter() - started
 
     shapes_data = {}
-    
-    # Limit for testing/demo to avoid hitting OSRM rate limits too hard
-    # In production, we might run this slowly over time or for all routes
-    # Let's try to do it for a reasonable number, or all if we add delays
-    
-    count = 0
-    total = len(unique_route_ids)
-    
-    for route_id in unique_route_ids:
-        count += 1
-        route_id_str = str(route_id)
-        
-        # Find a representative trip for this route
-        # We prefer a trip with the most stops to get the full shape
-        route_trips = trips_df[trips_df['route_id'] == route_id]
-        if route_trips.empty:
-            continue
-            
-        # Pick the first trip for now (optimally, pick the longest one)
-        trip_id = route_trips.iloc[0]['trip_id']
-        
-        # Get stops for this trip
-        trip_stops = stop_times_df[stop_times_df['trip_id'] == trip_id].sort_values('stop_sequence')
-        
-        if trip_stops.empty:
+    for route_id, stops in plan.items():
+        shape = assemble_shape(stops, cache)
+        if shape is None:
+            print(f"Skipping route {route_id}: missing segments (rerun to retry)")
             continue
-            
-        coords = []
-        for stop_id in trip_stops['stop_id']:
-            if stop_id in stops_map:
-                lat = stops_map[stop_id]['stop_lat']
-                lon = stops_map[stop_id]['stop_lon']
-                coords.append(f"{lon},{lat}") # OSRM expects Lon,Lat
-        
-        if len(coords) < 2:
-            continue
-            
-        # OSRM URL
-        # Split into chunks if too long (OSRM usually handles ~100 points, but let's be safe)
-        # For simplicity, we'll try sending all. If it fails, we might need to simplify.
-        # Actually, standard OSRM demo server might reject very long URLs.
-        # Let's take a subsample if it's huge, or just try.
-        
-        # Optimization: Take every nth stop if there are too many, to keep URL short
-        # But we want precision.
-        
-        coordinates_string = ";".join(coords)
-        url = f"http://router.project-osrm.org/route/v1/driving/{coordinates_string}?overview=full&geometries=polyline"
-        
-        try:
-            # Be nice to the free API
-            time.sleep(0.2) 
-            
-            r = requests.get(url)
-            if r.status_code != 200:
-                print(f"[{count}/{total}] Failed for route {route_id}: {r.status_code}")
-                continue
-                
-            data = r.json()
-            
-            if 'routes' in data and len(data['routes']) > 0:
-                encoded_geometry = data['routes'][0]['geometry']
-                decoded_path = polyline.decode(encoded_geometry) # [(lat, lng), ...]
-                shapes_data[route_id_str] = decoded_path
-                print(f"[{count}/{total}] Generated shape for route {route_id} ({len(decoded_path)} points)")
-            else:
-                print(f"[{count}/{total}] No route found for {route_id}")
-                
-        except Exception as e:
-            print(f"[{count}/{total}] Error for route {route_id}: {e}")
-            
-        # Save periodically
-        if count % 10 == 0:
-            with open(OUTPUT_FILE, 'w') as f:
-                json.dump(shapes_data, f)
-                
+        shapes_data[route_id] = shape
+
     # Final save
-    with open(OUTPUT_FILE, 'w') as f:
+    with open(output_file, 'w') as f:
         json.dump(shapes_data, f)
-    
-    print(f"Finished! Saved shapes for {len(shapes_data)} routes to {OUTPUT_FILE}")
+
+    stats = cache.stats()
+    print(f"Routed {total - failed}/{total} new segments in {routed_time:.1f}s ({failed} failed)")
+    print(f"Segment cache: {stats['segments']} segments, {stats['hits']} hits / {stats['misses']} misses "
+          f"({stats['stale']} stale), {total_pairs - total} of {total_pairs} stop pairs needed no request")
+    print(f"Finished! Saved shapes for {len(shapes_data)} routes to {output_file}")
 
 if __name__ == "__main__":
-    generate_shapes()
+    parser = argparse.ArgumentParser(description='Generate route shapes from GTFS using OSRM.')
+    parser.add_argument('--gtfs', type=str, default=GTFS_FOLDER, help='GTFS folder')
+    parser.add_argument('--osrm', type=str, default=OSRM_URL, help='OSRM base URL (e.g. a local osrm-routed)')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent OSRM requests')
+    parser.add_argument('--delay', type=float, default=0.2, help='Pause before each request, per worker')
+    parser.add_argument('--limit', type=int, help='Only build this many routes (for testing)')
+    parser.add_argument('--output', type=str, default=OUTPUT_FILE)
+    parser.add_argument('--cache', type=str, default=SEGMENT_CACHE_FILE, help='Segment cache file')
+    args = parser.parse_args()
+
+    generate_shapes(args.gtfs, args.osrm, args.workers, args.delay, args.output, args.cache, args.limit)
@@ -0,0 +1,281 @@
+"""
+The static GTFS data as one immutable object, and reloading it live.
+
+build_gtfs_dataset() reads final_merged_with_stops.csv + the GTFS folder
+and derives every lookup table and index from them. Nothing in a
+GtfsDataset is changed after it is built: a reload builds a whole new one
+off the event loop and the server switches to it with one assignment, so a
+request holding the old one keeps a consistent view until it finishes.
+"""
+import asyncio
+import os
+import threading
+import time
+
+import numpy as np
+
+import gtfs_snapshot
+from schedule import build_route_schedules, build_stop_timetable
+from trip_stops import TripStopTable
+
+
+class GtfsDataset:
+    """Static data + indexes. Treat every attribute as read-only."""
+
+    def __init__(self, trip_to_route=None, route_id_to_name=None, trip_to_route_id=None, merged=None,
+                 trip_stops=None, route_schedules=None, stop_timetable=None, network=None,
+                 stamp=None, build_seconds=0.0, version=0, trip_direction=None):
+        self.trip_to_route = trip_to_route if trip_to_route is not None else {} # trip_id -> route name
+        self.route_id_to_name = route_id_to_name if route_id_to_name is not None else {} # route_id -> "505"
+        self.trip_to_route_id = trip_to_route_id if trip_to_route_id is not None else {} # trip_id -> route_id
+        self.trip_direction = trip_direction if trip_direction is not None else {} # trip_id -> "0" / "1", if trips.txt has it
+        self.merged = merged # snapshot columns (memory-mapped) the indexes are built from
+        self.trip_stops = trip_stops if trip_stops is not None else TripStopTable.empty()
+        self.route_schedules = route_schedules if route_schedules is not None else {}
+        self.stop_timetable = stop_timetable # StopTimetable or None
+        self.network = network # journey.TransitNetwork, once built
+        self.stamp = stamp # source_stamp() of the files it was built from
+        self.build_seconds = build_seconds
+        self.built_at = time.time()
+        self.version = version
+
+    def route_name(self, route_id):
+        """Display name of a route_id ("Route <id>" if it has none)."""
+        name = self.route_id_to_name.get(route_id)
+        return name if isinstance(name, str) else f"Route {route_id}"
+
+    def trip_route_id(self, trip_id):
+        """route_id of a (live) trip id; unknown trips fall back to the id's prefix like TripResolver."""
+        route_id = self.trip_to_route_id.get(trip_id)
+        return route_id if route_id is not None else trip_id.split('_')[0]
+
+    def with_network(self, network):
+        """Same data plus a journey planner network (a new object; this one is left alone)."""
+        copy = GtfsDataset.__new__(GtfsDataset)
+        copy.__dict__.update(self.__dict__)
+        copy.network = network
+        return copy
+
+
+def source_stamp(paths):
+    """(path, mtime_ns, size) of each file that exists; changes when any of them does."""
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamp.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
+
+
+def gtfs_sources(stops_csv_path, gtfs_folder, extra=()):
+    return [stops_csv_path, os.path.join(gtfs_folder, 'routes.txt'), os.path.join(gtfs_folder, 'trips.txt'), *extra]
+
+
+def load_route_maps(gtfs_folder):
+    """
+    routes.txt + trips.txt -> (route_id_to_name, trip_to_route_id, trip_to_route,
+    trip_direction). Empty maps if the folder or either file is missing.
+    """
+    if not os.path.exists(gtfs_folder):
+        print(f"Warning: GTFS folder not found at {gtfs_folder}. Skipping static data load.")
+        return {}, {}, {}, {}
+
+    # A. Load Routes (Maps route_id -> "505")
+    routes_path = os.path.join(gtfs_folder, 'routes.txt')
+    trips_path = os.path.join(gtfs_folder, 'trips.txt')
+
+    if not os.path.exists(routes_path) or not os.path.exists(trips_path):
+        print("Warning: routes.txt or trips.txt not found. Skipping static data load.")
+        return {}, {}, {}, {}
+
+    # Check for LFS pointer (simple check: file size < 200 bytes)
+    if os.path.getsize(routes_path) < 200 or os.path.getsize(trips_path) < 200:
+        print("Warning: GTFS files appear to be Git LFS pointers. Skipping static data load.")
+        # Raise exception to trigger fallback
+        raise Exception("GTFS files are LFS pointers")
+
+    routes = gtfs_snapshot.load_routes(routes_path)
+
+    # Convert to dictionary: {'route_101': '505', ...}
+    # Missing names stay NaN, like the pandas map they come from
+    route_id_to_name = {
+        str(route_id): (float('nan') if missing else str(name))
+        for route_id, name, missing in zip(routes['route_id'], routes['route_name'], routes['route_name_missing'])
+    }
+
+    # B. Load Trips (Maps trip_id -> route_id)
+    trips = gtfs_snapshot.load_trips(trips_path)
+
+    # C. CREATE THE MASTER LOOKUP (trip_id -> "505")
+    trip_to_route_id = {str(trip_id): str(route_id) for trip_id, route_id in zip(trips['trip_id'], trips['route_id'])}
+    trip_to_route = {
+        trip_id: route_id_to_name.get(route_id, float('nan'))
+        for trip_id, route_id in trip_to_route_id.items()
+    }
+    trip_direction = {str(trip_id): str(d) for trip_id, d in zip(trips['trip_id'], trips['direction_id']) if d}
+    return route_id_to_name, trip_to_route_id, trip_to_route, trip_direction
+
+
+def build_gtfs_dataset(stops_csv_path, gtfs_folder, version=0, extra_sources=(), strict=False):
+    """
+    Load everything into a new GtfsDataset (what load_gtfs_data used to do
+    to the globals).
+
+    The startup load makes do with whatever it can read. With strict=True
+    (reloads) any load error, or a result without stops, routes or trips,
+    raises instead - a half-written CSV must not replace good data.
+    """
+    load_started = time.perf_counter()
+    stamp = source_stamp(gtfs_sources(stops_csv_path, gtfs_folder, extra_sources))
+    trip_to_route, route_id_to_name, trip_to_route_id, trip_direction = {}, {}, {}, {}
+    merged = trip_stops = stop_timetable = None
+    route_schedules = {}
+    try:
+        print("Loading Static GTFS Data... this might take a few seconds.")
+
+        # 1. Load Final Merged Stops (The "Gold" Data)
+        if os.path.exists(stops_csv_path):
+            print(f"Loading {stops_csv_path}...")
+            # Memory-mapped columns from the binary snapshot (compiled from
+            # the CSV on first run, already sorted by trip_id, arrival_time)
+            merged = gtfs_snapshot.load_merged_stops(stops_csv_path)
+
+            # Create optimized lookup: trip_id -> stops
+            # Columnar arrays shared with the snapshot; each trip is a
+            # contiguous slice of rows, no per-stop dicts
+            trip_stops = TripStopTable.from_snapshot(merged)
+            print(f"Loaded {len(trip_stops)} trips with stop sequences.")
+
+            # Per-route stop/arrival arrays for the geofence + delay check
+            route_schedules = build_route_schedules(merged)
+            print(f"Indexed schedules for {len(route_schedules)} routes.")
+
+            # Per-stop arrivals for /api/stops/{stop_id}/arrivals
+            stop_timetable = build_stop_timetable(merged)
+            print(f"Indexed arrivals for {len(stop_timetable)} stops.")
+        else:
+            print(f"Warning: {stops_csv_path} not found. Enhanced features will be disabled.")
+
+        route_id_to_name, trip_to_route_id, trip_to_route, trip_direction = load_route_maps(gtfs_folder)
+        if trip_to_route:
+            print(f"Loaded {len(trip_to_route)} trip mappings. Ready to serve!")
+
+    except Exception as e:
+        print(f"Error loading GTFS data: {e}")
+        if strict:
+            raise
+        # Fallback: If we have the stops but failed to load routes/trips,
+        # populate the route map from the stops' unique route_ids
+        if merged is not None and not route_id_to_name:
+            print("Populating Route Map from Stops Data (Fallback)...")
+            route_ids = merged.get('route_id__values')
+            if route_ids is None: # Not dictionary-encoded
+                route_ids = np.unique(merged['route_id'])
+            for rid in route_ids:
+                route_id_to_name[str(rid)] = f"Route {rid}"
+            print(f"Fallback: Loaded {len(route_id_to_name)} routes.")
+
+    if strict and not (trip_stops is not None and len(trip_stops) and route_id_to_name and trip_to_route):
+        raise ValueError(f"GTFS data incomplete: {len(trip_stops) if trip_stops is not None else 0} trips with stops, "
+                         f"{len(route_id_to_name)} routes, {len(trip_to_route)} trip mappings")
+
+    # Whatever we ended up with becomes the dataset (empty maps if the GTFS
+    # folder is missing)
+    return GtfsDataset(
+        trip_to_route=trip_to_route,
+        route_id_to_name=route_id_to_name,
+        trip_to_route_id=trip_to_route_id,
+        trip_direction=trip_direction,
+        merged=merged,
+        trip_stops=trip_stops,
+        route_schedules=route_schedules,
+        stop_timetable=stop_timetable,
+        stamp=stamp,
+        build_seconds=time.perf_counter() - load_started,
+        version=version,
+    )
+
+
+class GtfsReloader:
+    """
+    Rebuilds the dataset when its source files change (watch()) or on
+    request (reload()), one build at a time.
+
+    `build(version)` returns a complete GtfsDataset, or raises (the served
+    one stays); `install(dataset)` swaps it in. Both run in a worker thread,
+    never on the event loop.
+    """
+
+    def __init__(self, build, install, sources, current_stamp):
+        self.build = build
+        self.install = install
+        self.sources = sources # callable -> list of paths to watch
+        self.stamp = current_stamp
+        self.lock = threading.Lock()
+        self.version = 0
+        self.reloads = 0
+        self.last_reason = None
+        self.last_build_seconds = None
+        self.last_reload_at = None
+        self.last_error = None
+
+    @property
+    def building(self):
+        return self.lock.locked()
+
+    def reload(self, reason="manual"):
+        """Build and install a new dataset. Returns stats, or None if a build is already running."""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            started = time.perf_counter()
+            stamp = source_stamp(self.sources())
+            try:
+                dataset = self.build(self.version + 1)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"GTFS reload ({reason}) failed, keeping version {self.version}: {e}")
+                raise
+            self.install(dataset)
+            self.version = dataset.version
+            self.stamp = stamp
+            self.reloads += 1
+            self.last_reason = reason
+            self.last_error = None
+            self.last_build_seconds = time.perf_counter() - started
+            self.last_reload_at = time.time()
+            print(f"GTFS reload ({reason}): version {self.version} in {self.last_build_seconds:.2f}s")
+            return self.stats()
+        finally:
+            self.lock.release()
+
+    async def watch(self, interval_seconds=30.0):
+        """Poll the source files; reload once a change has settled for one interval."""
+        pending = None
+        while True:
+            await asyncio.sleep(interval_seconds)
+            stamp = source_stamp(self.sources())
+            if stamp == self.stamp:
+                pending = None
+                continue
+            if stamp != pending:
+                pending = stamp # Still being written? Look again next time
+                continue
+            try:
+                await asyncio.to_thread(self.reload, "file change")
+            except Exception:
+                self.stamp = stamp # Don't retry the same broken files every tick
+            pending = None
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "reloads": self.reloads,
+            "building": self.building,
+            "last_reason": self.last_reason,
+            "last_build_seconds": round(self.last_build_seconds, 3) if self.last_build_seconds is not None else None,
+            "last_reload_at": self.last_reload_at,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,216 @@
+"""
+Versioned binary snapshots of the static GTFS inputs.
+
+Each snapshot is a directory of .npy column arrays plus a meta.json, keyed by
+a hash of the source files. Loading memory-maps the arrays, so start-up skips
+CSV parsing and sorting, and several workers on one machine share the same
+page cache instead of each holding a private copy. A snapshot is rebuilt only
+when one of its source files changes.
+
+    python gtfs_snapshot.py        # compile ahead of time (e.g. before deploy)
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_VERSION = 3 # Bump when the on-disk layout changes
+CACHE_DIR = os.environ.get("GTFS_CACHE_DIR", ".gtfs_cache")
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def sources_key(paths):
+    h = hashlib.sha1(f"v{SNAPSHOT_VERSION}".encode())
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        h.update(file_digest(path).encode())
+    return h.hexdigest()[:16]
+
+
+def to_columns(df):
+    """
+    DataFrame -> {name: array}.
+
+    Text columns are dictionary-encoded: `name` holds int32 codes (-1 for
+    missing) and `name__values` the distinct strings as a fixed-width array,
+    so everything can be memory-mapped and repeated values (stop names,
+    times, trip ids) are stored once.
+    """
+    columns = {}
+    for name in df.columns:
+        series = df[name]
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            columns[name] = series.to_numpy()
+        else:
+            codes, uniques = pd.factorize(series)
+            columns[name] = codes.astype(np.int32)
+            columns[f"{name}__values"] = np.asarray(uniques, dtype=str)
+    return columns
+
+
+def to_dataframe(columns):
+    """Inverse of to_columns: dictionary-encoded columns come back as Categoricals."""
+    data = {}
+    for name, values in columns.items():
+        if name.startswith('_') or name.endswith('__values'):
+            continue
+        categories = columns.get(f"{name}__values")
+        if categories is not None:
+            data[name] = pd.Categorical.from_codes(values, categories=categories)
+        else:
+            data[name] = values
+    return pd.DataFrame(data)
+
+
+def load_snapshot(name, source_paths, build):
+    """
+    Return {column: array} for snapshot `name`, memory-mapped read-only.
+
+    `build()` is called to produce the columns when there is no snapshot for
+    the current contents of `source_paths`.
+    """
+    key = sources_key(source_paths)
+    snapshot_dir = os.path.join(CACHE_DIR, f"{name}-{key}")
+    meta_path = os.path.join(snapshot_dir, "meta.json")
+
+    if not os.path.exists(meta_path):
+        started = time.perf_counter()
+        columns = build()
+        write_snapshot(name, snapshot_dir, columns, source_paths)
+        print(f"Compiled {name} snapshot in {time.perf_counter() - started:.2f}s")
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return {
+        column: np.load(os.path.join(snapshot_dir, f"{column}.npy"), mmap_mode='r')
+        for column in meta["columns"]
+    }
+
+
+def write_snapshot(name, snapshot_dir, columns, source_paths):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write into a temp dir and rename, so a reader never sees half a snapshot
+    tmp_dir = f"{snapshot_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for column, values in columns.items():
+        np.save(os.path.join(tmp_dir, f"{column}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({
+            "name": name,
+            "version": SNAPSHOT_VERSION,
+            "sources": [os.path.basename(p) for p in source_paths],
+            "columns": list(columns),
+            "created": time.time(),
+        }, f)
+    try:
+        os.rename(tmp_dir, snapshot_dir)
+    except OSError:
+        # Another worker got there first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Drop older snapshots of the same data
+    for entry in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, entry)
+        if entry.startswith(f"{name}-") and path != snapshot_dir and ".tmp" not in entry:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def parse_gtfs_times(values):
+    """HH:MM:SS strings -> int32 seconds (hours may exceed 24; bad values -> 0)."""
+    parts = pd.Series(values, dtype=object).astype(str).str.split(':', expand=True)
+    if parts.shape[1] < 3:
+        return np.zeros(len(values), dtype=np.int32)
+    h, m, sec = (pd.to_numeric(parts[i], errors='coerce') for i in range(3))
+    seconds = (h * 3600 + m * 60 + sec).fillna(0)
+    return seconds.to_numpy(dtype=np.int32)
+
+
+# --- Builders for the files main.py loads ---
+
+def build_merged_stops(stops_csv_path):
+    """
+    Merged stop times sorted by trip, plus CSR offsets of each trip's rows
+    and arrival_time pre-parsed to seconds.
+    """
+    df = pd.read_csv(stops_csv_path)
+    df = df.sort_values(by=['trip_id', 'arrival_time'], kind='stable').reset_index(drop=True)
+    columns = to_columns(df)
+
+    # Parse each distinct time string once, then expand through the codes
+    codes = columns['arrival_time']
+    unique_seconds = parse_gtfs_times(columns['arrival_time__values'])
+    columns['arrival_seconds'] = np.where(codes >= 0, unique_seconds[codes], 0).astype(np.int32)
+
+    trip_keys = df['trip_id'].astype(str).to_numpy(dtype=str)
+    starts = np.flatnonzero(np.r_[True, trip_keys[1:] != trip_keys[:-1]]) if len(df) else np.array([], dtype=np.int64)
+    columns['_trip_ids'] = trip_keys[starts]
+    columns['_trip_offsets'] = np.append(starts, len(df)).astype(np.int64)
+    return columns
+
+
+def build_routes(routes_path):
+    routes_df = pd.read_csv(routes_path, usecols=['route_id', 'route_short_name', 'route_long_name'])
+    # Handle missing short names
+    routes_df['route_name'] = routes_df['route_short_name'].fillna(routes_df['route_long_name'])
+    return {
+        'route_id': routes_df['route_id'].astype(str).to_numpy(dtype=str),
+        'route_name': routes_df['route_name'].astype(str).to_numpy(dtype=str),
+        'route_name_missing': routes_df['route_name'].isna().to_numpy(),
+    }
+
+
+def build_trips(trips_path):
+    # direction_id is optional in GTFS; "" where it's missing
+    trips_df = pd.read_csv(trips_path, usecols=lambda c: c in ('trip_id', 'route_id', 'direction_id'),
+                           dtype={'direction_id': 'Int64'})
+    if 'trip_id' not in trips_df or 'route_id' not in trips_df:
+        raise ValueError(f"{trips_path} needs trip_id and route_id columns")
+    if 'direction_id' in trips_df:
+        direction = trips_df['direction_id'].astype('string').fillna('')
+    else:
+        direction = pd.Series('', index=trips_df.index)
+    return {
+        'trip_id': trips_df['trip_id'].astype(str).to_numpy(dtype=str),
+        'route_id': trips_df['route_id'].astype(str).to_numpy(dtype=str),
+        'direction_id': direction.to_numpy(dtype=str),
+    }
+
+
+def load_merged_stops(stops_csv_path):
+    return load_snapshot("merged_stops", [stops_csv_path], lambda: build_merged_stops(stops_csv_path))
+
+
+def load_routes(routes_path):
+    return load_snapshot("routes", [routes_path], lambda: build_routes(routes_path))
+
+
+def load_trips(trips_path):
+    return load_snapshot("trips", [trips_path], lambda: build_trips(trips_path))
+
+
+if __name__ == "__main__":
+    started = time.perf_counter()
+    for loader, path in [
+        (load_merged_stops, "../final_merged_with_stops.csv"),
+        (load_routes, "../GTFS/routes.txt"),
+        (load_trips, "../GTFS/trips.txt"),
+    ]:
+        if os.path.exists(path):
+            columns = loader(path)
+            rows = len(next(iter(columns.values()))) if columns else 0
+            print(f"{path}: {rows} rows, {len(columns)} columns")
+        else:
+            print(f"{path}: not found, skipped")
+    print(f"Snapshots ready in {time.perf_counter() - started:.2f}s ({CACHE_DIR})")
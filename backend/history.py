@@ -0,0 +1,305 @@
+"""
+Append-only history of accepted reports and published virtual buses.
+
+Rows are queued in memory by record_report() / record_buses() (a deque
+append on the request path) and written by a background flusher, one block
+per kind and partition per flush. Layout:
+
+    history/20261017-09/reports-<pid>.seg     (UTC hour partitions)
+    history/20261017-09/buses-<pid>.seg
+
+A .seg file is a sequence of blocks: BLOCK header (magic, rows, payload
+bytes) then the block's columns one after another - numbers as raw
+little-endian arrays, text dictionary-encoded (int32 codes + the distinct
+values as JSON). Files are only ever appended to, and each worker process
+writes its own, so there is no locking between writers. A block cut short by
+a crash is skipped when reading.
+
+read_history() loads a time range back as numpy columns; replay_history.py
+feeds it through the clustering pipeline.
+"""
+import asyncio
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import numpy as np
+
+from metrics import Histogram
+
+HISTORY_FLUSH_SECONDS = Histogram("dsatm_history_flush_seconds", "Time to write one batch of history blocks")
+
+MAGIC = b"HSB1"
+BLOCK = struct.Struct("<4sII") # magic, rows, payload bytes
+PARTITION_FORMAT = "%Y%m%d-%H"
+PARTITION_SECONDS = 3600
+
+# Column name -> numpy dtype, or "str" for dictionary-encoded text
+SCHEMAS = {
+    "reports": [("t", "<f8"), ("user_id", "str"), ("route_id", "str"), ("lat", "<f8"), ("lng", "<f8"),
+                ("speed", "<f4")],
+    "buses": [("t", "<f8"), ("id", "str"), ("route_id", "str"), ("lat", "<f8"), ("lng", "<f8"),
+              ("passenger_count", "<i4"), ("confidence", "<f4"), ("delay_minutes", "<f4"), ("speed_kmh", "<f4")],
+}
+
+
+def partition_name(t):
+    return datetime.fromtimestamp(t, timezone.utc).strftime(PARTITION_FORMAT)
+
+
+def partition_start(name):
+    try:
+        return datetime.strptime(name, PARTITION_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None # Not one of ours
+
+
+def encode_block(kind, rows):
+    """rows: list of tuples in SCHEMAS[kind] order -> one block (bytes)."""
+    parts = []
+    columns = list(zip(*rows))
+    for (name, dtype), values in zip(SCHEMAS[kind], columns):
+        if dtype == "str":
+            codes, uniques = {}, []
+            for value in values:
+                if value not in codes:
+                    codes[value] = len(uniques)
+                    uniques.append(value)
+            blob = json.dumps(uniques, separators=(",", ":")).encode()
+            parts.append(np.fromiter((codes[v] for v in values), dtype="<i4", count=len(values)).tobytes())
+            parts.append(struct.pack("<I", len(blob)))
+            parts.append(blob)
+        else:
+            parts.append(np.asarray(values, dtype=dtype).tobytes())
+    payload = b"".join(parts)
+    return BLOCK.pack(MAGIC, len(rows), len(payload)) + payload
+
+
+def decode_block(kind, rows, payload):
+    columns = {}
+    pos = 0
+    for name, dtype in SCHEMAS[kind]:
+        if dtype == "str":
+            codes = np.frombuffer(payload, dtype="<i4", count=rows, offset=pos)
+            pos += rows * 4
+            (size,) = struct.unpack_from("<I", payload, pos)
+            pos += 4
+            values = np.array(json.loads(payload[pos:pos + size]), dtype=object)
+            pos += size
+            columns[name] = values[codes] if rows else np.empty(0, dtype=object)
+        else:
+            dt = np.dtype(dtype)
+            columns[name] = np.frombuffer(payload, dtype=dt, count=rows, offset=pos)
+            pos += rows * dt.itemsize
+    return columns
+
+
+def read_segment(path, kind):
+    """Every complete block of one .seg file, as a list of column dicts."""
+    with open(path, "rb") as f:
+        data = f.read()
+    blocks = []
+    pos = 0
+    while pos + BLOCK.size <= len(data):
+        magic, rows, size = BLOCK.unpack_from(data, pos)
+        if magic != MAGIC or pos + BLOCK.size + size > len(data):
+            break # Torn write at the end (or garbage): stop here
+        payload = data[pos + BLOCK.size:pos + BLOCK.size + size]
+        blocks.append(decode_block(kind, rows, payload))
+        pos += BLOCK.size + size
+    return blocks
+
+
+def list_partitions(directory, start=None, end=None):
+    """Partition directories overlapping [start, end), oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    names = []
+    for name in os.listdir(directory):
+        begins = partition_start(name)
+        if begins is None:
+            continue
+        if start is not None and begins + PARTITION_SECONDS <= start:
+            continue
+        if end is not None and begins >= end:
+            continue
+        names.append((begins, name))
+    return [os.path.join(directory, name) for _, name in sorted(names)]
+
+
+def read_history(directory, kind, start=None, end=None):
+    """All `kind` rows with start <= t < end, sorted by t, as {column: array}."""
+    blocks = []
+    for partition in list_partitions(directory, start, end):
+        for name in sorted(os.listdir(partition)):
+            if name.startswith(kind + "-") and name.endswith(".seg"):
+                blocks.extend(read_segment(os.path.join(partition, name), kind))
+    if not blocks:
+        return {name: np.empty(0, dtype=object if dtype == "str" else dtype) for name, dtype in SCHEMAS[kind]}
+    columns = {name: np.concatenate([block[name] for block in blocks]) for name, _ in SCHEMAS[kind]}
+    t = columns["t"]
+    keep = np.ones(len(t), dtype=bool)
+    if start is not None:
+        keep &= t >= start
+    if end is not None:
+        keep &= t < end
+    # Stable: rows with equal times keep the order they were written in
+    order = np.argsort(t[keep], kind="stable")
+    return {name: values[keep][order] for name, values in columns.items()}
+
+
+class HistoryWriter:
+    """
+    Queues history rows and appends them to disk in batches.
+
+    record_*() never touch the disk; run() flushes every `flush_seconds` in
+    a worker thread. At most `max_pending` rows wait in memory - past that,
+    new rows are dropped (and counted) rather than slowing ingest down.
+    Bus snapshots are kept at most every `snapshot_seconds`.
+    """
+
+    def __init__(self, directory="history", flush_seconds=2.0, snapshot_seconds=5.0,
+                 retention_days=7.0, max_pending=500000):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.snapshot_seconds = snapshot_seconds
+        self.retention_days = retention_days
+        self.max_pending = max_pending
+        self.suffix = f"{os.getpid()}.seg"
+        self.lock = threading.Lock() # One flush at a time, so blocks never interleave
+
+        self.pending = {"reports": deque(), "buses": deque()}
+        self.last_snapshot = 0.0
+        self.last_prune = 0.0
+
+        self.recorded = {"reports": 0, "buses": 0}
+        self.written = {"reports": 0, "buses": 0}
+        self.dropped = 0
+        self.bytes_written = 0
+        self.blocks_written = 0
+        self.write_errors = 0 # Failed flushes (their rows were queued again)
+        self.last_error = None
+
+    def _queue(self, kind, rows):
+        queue = self.pending[kind]
+        if len(self.pending["reports"]) + len(self.pending["buses"]) + len(rows) > self.max_pending:
+            self.dropped += len(rows)
+            return
+        queue.extend(rows)
+        self.recorded[kind] += len(rows)
+
+    def record_report(self, report):
+        self._queue("reports", [(report.timestamp, report.user_id, report.route_id, report.lat, report.lng,
+                                 report.speed)])
+
+    def record_buses(self, buses, now):
+        """Snapshot of the published buses (skipped if the last one is too recent)."""
+        if now - self.last_snapshot < self.snapshot_seconds:
+            return
+        self.last_snapshot = now
+        self._queue("buses", [(now, bus.id, bus.route_id, bus.lat, bus.lng, bus.passenger_count, bus.confidence,
+                               bus.delay_minutes, bus.speed_kmh) for bus in buses])
+
+    def flush(self):
+        """
+        Write everything queued so far. Returns the number of rows written.
+        On a write error the rows not written yet go back to the front of
+        their queue for the next flush, and the error is raised.
+        """
+        written = 0
+        with self.lock, HISTORY_FLUSH_SECONDS.time():
+            for kind, queue in self.pending.items():
+                rows = []
+                while queue:
+                    rows.append(queue.popleft())
+                if not rows:
+                    continue
+                by_partition = {}
+                for row in rows:
+                    by_partition.setdefault(partition_name(row[0]), []).append(row)
+                unwritten = list(by_partition.items())
+                try:
+                    while unwritten:
+                        partition, part_rows = unwritten[0]
+                        block = encode_block(kind, part_rows)
+                        path = os.path.join(self.directory, partition)
+                        os.makedirs(path, exist_ok=True)
+                        self._append(os.path.join(path, f"{kind}-{self.suffix}"), block)
+                        unwritten.pop(0)
+                        self.bytes_written += len(block)
+                        self.blocks_written += 1
+                        self.written[kind] += len(part_rows)
+                        written += len(part_rows)
+                except Exception:
+                    self.write_errors += 1
+                    # Oldest first again; rows recorded meanwhile stay behind them
+                    for _, part_rows in reversed(unwritten):
+                        queue.extendleft(reversed(part_rows))
+                    raise
+        return written
+
+    @staticmethod
+    def _append(path, block):
+        with open(path, "ab") as f:
+            start = f.tell()
+            try:
+                f.write(block)
+                f.flush()
+            except Exception:
+                # Don't leave half a block for the next one to land behind
+                try:
+                    f.truncate(start)
+                except OSError:
+                    pass # Readers stop at the torn block
+                raise
+
+    def prune(self, now=None):
+        """Delete partitions older than retention_days (<= 0 keeps everything)."""
+        if self.retention_days <= 0:
+            return 0
+        now = time.time() if now is None else now
+        cutoff = now - self.retention_days * 86400
+        removed = 0
+        for partition in list_partitions(self.directory, end=cutoff - PARTITION_SECONDS):
+            shutil.rmtree(partition, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def _flush_and_prune(self):
+        self.flush()
+        now = time.time()
+        if now - self.last_prune >= PARTITION_SECONDS:
+            self.last_prune = now
+            self.prune(now)
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_seconds)
+                try:
+                    await asyncio.to_thread(self._flush_and_prune)
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = str(e)
+                    print(f"Error writing history to {self.directory}: {e}")
+        finally:
+            # Don't lose the last couple of seconds on shutdown
+            self.flush()
+
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "pending": len(self.pending["reports"]) + len(self.pending["buses"]),
+            "recorded": dict(self.recorded),
+            "written": dict(self.written),
+            "dropped": self.dropped,
+            "blocks_written": self.blocks_written,
+            "write_errors": self.write_errors,
+            "bytes_written": self.bytes_written,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import deque
+
+from metrics import Histogram
+
+INGEST_TICK_SECONDS = Histogram("dsatm_ingest_tick_seconds", "Batch ingest tick time (apply + publish)")
+INGEST_BATCH_REPORTS = Histogram("dsatm_ingest_batch_reports", "Reports applied per batch tick",
+                                 buckets=(0, 1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+
+
+class BatchScheduler:
+    """
+    Bounded ingest queue drained by a background asyncio task.
+
+    `submit()` is called from the request handlers and only appends to a
+    deque, so POSTs return immediately. `run()` wakes up every
+    `tick_seconds` (or early, once `batch_size` reports are waiting), hands
+    the queued reports to `apply_batch` and then calls `publish`, all in a
+    worker thread so the event loop keeps serving reads.
+
+    When the queue holds `high_water` reports, new ones are rejected and
+    counted in `dropped` so clients can back off.
+    """
+
+    def __init__(self, apply_batch, publish, tick_seconds=0.5, batch_size=500, high_water=10000):
+        self.apply_batch = apply_batch
+        self.publish = publish
+        self.tick_seconds = tick_seconds
+        self.batch_size = batch_size
+        self.high_water = high_water
+
+        self.queue = deque()
+        self._loop = None
+        self._wake = None
+
+        # Backpressure / throughput counters
+        self.accepted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.ticks = 0
+        self.max_depth = 0
+        self.last_batch_size = 0
+        self.last_tick_ms = 0.0
+
+    def submit(self, report):
+        """Queue a report. Returns False if the queue is at its high-water mark."""
+        depth = len(self.queue)
+        if depth >= self.high_water:
+            self.dropped += 1
+            return False
+        self.queue.append(report)
+        self.accepted += 1
+        if depth + 1 > self.max_depth:
+            self.max_depth = depth + 1
+        if depth + 1 >= self.batch_size and self._loop is not None:
+            # submit() runs in the threadpool, so wake the loop thread-safely
+            self._loop.call_soon_threadsafe(self._wake.set)
+        return True
+
+    def drain_once(self):
+        """Apply everything queued so far and publish. Returns the batch size."""
+        batch = []
+        queue = self.queue
+        while queue:
+            batch.append(queue.popleft())
+
+        started = time.perf_counter()
+        if batch:
+            self.apply_batch(batch)
+        self.publish()
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+        INGEST_TICK_SECONDS.observe(self.last_tick_ms / 1000)
+        INGEST_BATCH_REPORTS.observe(len(batch))
+
+        self.ticks += 1
+        self.processed += len(batch)
+        self.last_batch_size = len(batch)
+        return len(batch)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.tick_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await asyncio.to_thread(self.drain_once)
+            except Exception as e:
+                print(f"Error in clustering tick: {e}")
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.queue),
+            "high_water": self.high_water,
+            "tick_seconds": self.tick_seconds,
+            "batch_size": self.batch_size,
+            "accepted": self.accepted,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "ticks": self.ticks,
+            "max_depth": self.max_depth,
+            "last_batch_size": self.last_batch_size,
+            "last_tick_ms": round(self.last_tick_ms, 3),
+        }
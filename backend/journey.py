@@ -0,0 +1,587 @@
+"""
+Server-side journey planning over bus trips + the metro (RAPTOR).
+
+RAPTOR works in rounds: round k finds the earliest arrival at every stop
+using at most k vehicles. Each round scans every route that serves a stop
+improved in the previous round, then relaxes walking transfers.
+
+The network is flattened into arrays once (build_network):
+
+  * routes - trips of a bus route that visit the same stops in the same
+    order (a "pattern"), or one direction of a metro line. Trips of a route
+    never overtake each other, so each stop's departures are sorted.
+  * route-stops - the flat list of every route's stops; entry i is the
+    column of times for one stop of one route, and `col_keys` holds
+    `i * KEY_STRIDE + time` sorted, so finding the first catchable trip at
+    a whole batch of route-stops is one searchsorted.
+  * transfers - walking links between stops within TRANSFER_RADIUS_M (bus
+    stop <-> bus stop and bus stop <-> metro station), from a GridIndex.
+
+A round is then a handful of numpy operations over all touched route-stops
+at once, instead of a Python loop per stop. The metro has no timetable in
+`Delhi metro.csv`, so its trips are generated from the station distances
+at a fixed speed and headway.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from schedule import DAY_SECONDS, column_codes
+from spatial import GridIndex, haversine_distance, haversine_np
+from stop_eta import format_seconds
+
+WALK_SPEED_MPS = 1.3 # ~5 km/h, like the frontend planner
+TRANSFER_RADIUS_M = 400 # Walking links between stops
+MAX_TRANSFERS_PER_STOP = 30 # Nearest ones only
+ACCESS_RADIUS_M = 800 # Walk from the origin / to the destination
+METRO_ENTRY_SECONDS = 120 # Security + platform when walking into a station
+
+METRO_SPEED_KMH = 34.0
+METRO_DWELL_SECONDS = 20
+METRO_HEADWAY_SECONDS = 300
+METRO_SERVICE = (6 * 3600, 23 * 3600) # First / last departure from the terminus
+
+KEY_STRIDE = 4 * DAY_SECONDS # Wider than any time of day in the data
+INF = np.int64(1 << 40)
+
+# Trip reconstruction codes, per round and stop
+_INHERIT, _RIDE, _WALK, _ACCESS = 0, 1, 2, 3
+
+
+class TransitNetwork:
+    """Flat arrays for RAPTOR; see the module docstring."""
+
+    def __init__(self, stop_ids, stop_names, stop_lats, stop_lons, stop_is_metro,
+                 route_names, route_is_metro, route_stop_offsets, route_stops,
+                 trip_counts, trip_offsets, trip_labels, time_starts, times,
+                 transfer_offsets, transfer_to, transfer_seconds, build_seconds=0.0):
+        self.stop_ids = stop_ids
+        self.stop_names = stop_names
+        self.stop_lats = stop_lats
+        self.stop_lons = stop_lons
+        self.stop_is_metro = stop_is_metro
+        self.route_names = route_names
+        self.route_is_metro = route_is_metro
+        self.route_stop_offsets = route_stop_offsets # route -> its slice of route_stops
+        self.route_stops = route_stops # route-stop entry -> stop
+        self.trip_counts = trip_counts # route -> number of trips
+        self.trip_offsets = trip_offsets # route -> its slice of trip_labels
+        self.trip_labels = trip_labels
+        self.time_starts = time_starts # route-stop entry -> start of its column in `times`
+        self.times = times
+        self.transfer_offsets = transfer_offsets # stop -> its slice of transfer_to / transfer_seconds
+        self.transfer_to = transfer_to
+        self.transfer_seconds = transfer_seconds
+        self.build_seconds = build_seconds
+
+        entries = len(route_stops)
+        self.entry_route = np.repeat(np.arange(len(trip_counts)), np.diff(route_stop_offsets))
+        self.entry_pos = np.arange(entries) - route_stop_offsets[self.entry_route]
+        # Column of every time, as searchsorted keys (times inside a column are sorted)
+        column = np.repeat(np.arange(entries), trip_counts[self.entry_route])
+        self.col_keys = column.astype(np.int64) * KEY_STRIDE + times
+        # Stop -> route-stop entries that serve it
+        order = np.argsort(route_stops, kind='stable')
+        self.stop_entries = order
+        self.stop_entry_offsets = np.searchsorted(route_stops[order], np.arange(len(stop_ids) + 1))
+
+        self.grid = GridIndex(TRANSFER_RADIUS_M)
+        for i, (lat, lng) in enumerate(zip(stop_lats, stop_lons)):
+            self.grid.insert(i, float(lat), float(lng))
+
+    @property
+    def stop_count(self):
+        return len(self.stop_ids)
+
+    def stats(self):
+        return {
+            "stops": len(self.stop_ids),
+            "metro_stations": int(self.stop_is_metro.sum()),
+            "routes": len(self.trip_counts),
+            "trips": int(self.trip_counts.sum()),
+            "transfers": len(self.transfer_to),
+            "build_seconds": round(self.build_seconds, 2),
+        }
+
+    def stops_near(self, lat, lng, radius_m):
+        """(stop indexes, walking seconds) within radius_m of a point."""
+        found, seconds = [], []
+        for stop, s_lat, s_lng in self.grid.neighbours(lat, lng, radius_m):
+            dist = haversine_distance(lat, lng, s_lat, s_lng)
+            if dist <= radius_m:
+                found.append(stop)
+                seconds.append(self.walk_seconds(dist, self.stop_is_metro[stop]))
+        return np.array(found, dtype=np.int64), np.array(seconds, dtype=np.int64)
+
+    @staticmethod
+    def walk_seconds(dist_m, into_metro=False):
+        return int(dist_m / WALK_SPEED_MPS) + (METRO_ENTRY_SECONDS if into_metro else 0)
+
+
+# --- Building ---
+
+def load_metro_lines(path):
+    """{line: [(station name, lat, lng, km from first station), ...]} in line order."""
+    df = pd.read_csv(path)
+    lines = {}
+    for line, group in df.groupby('Metro Line', sort=False):
+        group = group.sort_values('Dist. From First Station(km)', kind='stable')
+        stations = []
+        for name, km, lat, lng in zip(group['Station Names'], group['Dist. From First Station(km)'],
+                                      group['Latitude'], group['Longitude']):
+            if lng < lat:
+                lat, lng = lng, lat # A few rows have them swapped
+            # "[Conn: Blue]" differs per line at interchanges, so drop it or they never merge
+            name = re.sub(r"\s*\[?Conn:[^\]]*\]?", "", str(name))
+            # Only the "(First Station)" notes; "Paschim Vihar (East)"/"(West)" are two stations
+            name = re.sub(r"\s*\((first|last) station\)", "", name, flags=re.I).strip()
+            stations.append((name, float(lat), float(lng), float(km)))
+        lines[str(line)] = stations
+    return lines
+
+
+def _fifo_chains(times):
+    """Split trips (rows, sorted by first time) into groups where no trip overtakes another."""
+    if len(times) < 2 or (np.diff(times, axis=0) >= 0).all():
+        return [np.arange(len(times))]
+    chains = []
+    for i in range(len(times)):
+        for chain in chains:
+            if (times[i] >= times[chain[-1]]).all():
+                chain.append(i)
+                break
+        else:
+            chains.append([i])
+    return [np.array(chain) for chain in chains]
+
+
+def build_network(merged, route_name, metro_lines=None):
+    """
+    TransitNetwork from the merged-stops snapshot columns (bus trips) plus
+    load_metro_lines() output. `route_name(route_id)` gives bus route labels.
+    """
+    started = time.perf_counter()
+    offsets = np.asarray(merged['_trip_offsets'], dtype=np.int64)
+    trip_ids = merged['_trip_ids']
+    stop_codes, stop_values = column_codes(merged, 'stop_id')
+    route_codes, route_values = column_codes(merged, 'route_id')
+    arrivals = np.asarray(merged['arrival_seconds'], dtype=np.int64)
+    lats = np.asarray(merged['stop_lat'], dtype=np.float64)
+    lons = np.asarray(merged['stop_lon'], dtype=np.float64)
+
+    # Bus stops: one per distinct stop_id, first row wins for name / position
+    first_row = np.full(len(stop_values), -1, dtype=np.int64)
+    rows_by_stop = np.argsort(stop_codes, kind='stable')
+    firsts = np.searchsorted(stop_codes[rows_by_stop], np.arange(len(stop_values)))
+    has_rows = firsts < len(rows_by_stop)
+    first_row[has_rows] = rows_by_stop[firsts[has_rows]]
+    if 'stop_name' in merged:
+        name_codes, name_values = column_codes(merged, 'stop_name')
+        names = [str(name_values[name_codes[row]]) if row >= 0 and name_codes[row] >= 0 else ""
+                 for row in first_row]
+    else:
+        names = [""] * len(stop_values)
+    stop_ids = [str(value) for value in stop_values]
+    stop_names = names
+    stop_lats = [float(lats[row]) if row >= 0 else 0.0 for row in first_row]
+    stop_lons = [float(lons[row]) if row >= 0 else 0.0 for row in first_row]
+    stop_is_metro = [False] * len(stop_values)
+
+    routes = [] # (name, is_metro, stop index array, times (trips x stops), trip labels)
+
+    # Bus patterns: same route, same stop sequence
+    patterns = {}
+    for trip in range(len(offsets) - 1):
+        start, end = offsets[trip], offsets[trip + 1]
+        if end - start < 2:
+            continue
+        key = (int(route_codes[start]), stop_codes[start:end].tobytes())
+        patterns.setdefault(key, []).append(trip)
+    for (route_code, _), trips in patterns.items():
+        trips = np.asarray(trips)
+        count = int(offsets[trips[0] + 1] - offsets[trips[0]])
+        rows = offsets[trips][:, None] + np.arange(count)[None, :]
+        times = np.maximum.accumulate(arrivals[rows], axis=1)
+        order = np.argsort(times[:, 0], kind='stable')
+        times, trips = times[order], trips[order]
+        label = route_name(str(route_values[route_code]))
+        for chain in _fifo_chains(times):
+            routes.append((label, False, stop_codes[rows[0]].astype(np.int64), times[chain],
+                           [str(trip_ids[t]) for t in trips[chain]]))
+
+    # Metro: each line both ways, generated from station distances
+    metro_index = {}
+    for line, stations in (metro_lines or {}).items():
+        indexes = []
+        for name, lat, lng, _ in stations:
+            stop = metro_index.get(name)
+            if stop is None:
+                # Interchanges share a name across lines, so they become one stop
+                stop = len(stop_ids)
+                metro_index[name] = stop
+                stop_ids.append(f"metro:{name}")
+                stop_names.append(f"{name} (Metro)")
+                stop_lats.append(lat)
+                stop_lons.append(lng)
+                stop_is_metro.append(True)
+            indexes.append(stop)
+        if len(indexes) < 2:
+            continue
+        km = np.array([station[3] for station in stations])
+        hops = np.abs(np.diff(km)) / METRO_SPEED_KMH * 3600 + METRO_DWELL_SECONDS
+        departures = np.arange(METRO_SERVICE[0], METRO_SERVICE[1] + 1, METRO_HEADWAY_SECONDS)
+        for direction, stops, hop in (("", indexes, hops), (" (return)", indexes[::-1], hops[::-1])):
+            offsets_s = np.concatenate(([0.0], np.cumsum(hop))).astype(np.int64)
+            times = departures[:, None] + offsets_s[None, :]
+            labels = [f"{line}{direction} {format_seconds(t)[:5]}" for t in departures]
+            routes.append((f"{line}{direction}", True, np.array(stops, dtype=np.int64), times, labels))
+
+    stop_lats = np.array(stop_lats)
+    stop_lons = np.array(stop_lons)
+    stop_is_metro = np.array(stop_is_metro, dtype=bool)
+
+    # Flatten routes; each route's times are stored stop-major (one column per stop)
+    route_stop_offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+    trip_counts = np.zeros(len(routes), dtype=np.int64)
+    trip_offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+    route_stops, columns, labels, time_starts = [], [], [], []
+    time_cursor = 0
+    for r, (_, _, stops, times, trip_labels) in enumerate(routes):
+        trips, count = times.shape
+        route_stop_offsets[r + 1] = route_stop_offsets[r] + count
+        trip_counts[r] = trips
+        trip_offsets[r + 1] = trip_offsets[r] + trips
+        route_stops.append(stops)
+        columns.append(times.T.reshape(-1))
+        labels.extend(trip_labels)
+        time_starts.append(time_cursor + np.arange(count) * trips)
+        time_cursor += trips * count
+
+    transfer_offsets, transfer_to, transfer_seconds = _build_transfers(stop_lats, stop_lons, stop_is_metro)
+    empty = np.empty(0, dtype=np.int64)
+    return TransitNetwork(
+        stop_ids=np.array(stop_ids, dtype=object),
+        stop_names=stop_names,
+        stop_lats=stop_lats,
+        stop_lons=stop_lons,
+        stop_is_metro=stop_is_metro,
+        route_names=[route[0] for route in routes],
+        route_is_metro=np.array([route[1] for route in routes], dtype=bool),
+        route_stop_offsets=route_stop_offsets,
+        route_stops=np.concatenate(route_stops) if routes else empty,
+        trip_counts=trip_counts,
+        trip_offsets=trip_offsets,
+        trip_labels=labels,
+        time_starts=np.concatenate(time_starts) if routes else empty,
+        times=np.concatenate(columns).astype(np.int64) if routes else empty,
+        transfer_offsets=transfer_offsets,
+        transfer_to=transfer_to,
+        transfer_seconds=transfer_seconds,
+        build_seconds=time.perf_counter() - started,
+    )
+
+
+def _build_transfers(lats, lons, is_metro):
+    grid = GridIndex(TRANSFER_RADIUS_M)
+    for i, (lat, lng) in enumerate(zip(lats, lons)):
+        grid.insert(i, float(lat), float(lng))
+    offsets = np.zeros(len(lats) + 1, dtype=np.int64)
+    targets, seconds = [], []
+    for i in range(len(lats)):
+        near = np.array([key for key, _, _ in grid.neighbours(lats[i], lons[i], TRANSFER_RADIUS_M) if key != i],
+                        dtype=np.int64)
+        if len(near):
+            dist = haversine_np(lats[i], lons[i], lats[near], lons[near])
+            keep = np.argsort(dist)[:MAX_TRANSFERS_PER_STOP]
+            keep = keep[dist[keep] <= TRANSFER_RADIUS_M]
+            near, dist = near[keep], dist[keep]
+            targets.append(near)
+            seconds.append((dist / WALK_SPEED_MPS).astype(np.int64) + np.where(is_metro[near], METRO_ENTRY_SECONDS, 0))
+        offsets[i + 1] = offsets[i] + len(near)
+    empty = np.empty(0, dtype=np.int64)
+    return offsets, (np.concatenate(targets) if targets else empty), (np.concatenate(seconds) if seconds else empty)
+
+
+# --- Querying ---
+
+def _gather(offsets, values, keys):
+    """Concatenate values[offsets[k]:offsets[k + 1]] for every k in keys (plus the key of each item)."""
+    starts, ends = offsets[keys], offsets[keys + 1]
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    owner = np.repeat(np.arange(len(keys)), lengths)
+    index = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return values[index], keys[owner]
+
+
+def _lowest_per_stop(stops, values):
+    """Positions of the smallest value for each distinct stop."""
+    order = np.lexsort((values, stops))
+    stops_sorted = stops[order]
+    first = np.r_[True, stops_sorted[1:] != stops_sorted[:-1]]
+    return order[first]
+
+
+def raptor(network, access, depart, max_rides):
+    """
+    Earliest arrivals with 0..max_rides vehicles from a set of access stops.
+
+    access is (stop indexes, walking seconds). Returns per-round arrays
+    (arrival, kind, walked_from, ride_at, ride_alight, ride_board) used by
+    reconstruct(). A walk may beat a ride at the same stop, so the ride that
+    the walk started from is kept apart from the stop's final label.
+    """
+    n = network.stop_count
+    best = np.full(n, INF, dtype=np.int64)
+    rounds = []
+
+    arrival = np.full(n, INF, dtype=np.int64)
+    kind = np.zeros(n, dtype=np.int8)
+    stops, walk = access
+    if len(stops):
+        np.minimum.at(arrival, stops, depart + walk)
+        kind[stops] = _ACCESS
+    best[:] = arrival
+    rounds.append((arrival, kind, None, None, None, None))
+    marked = np.flatnonzero(arrival < INF)
+
+    route_stop_offsets = network.route_stop_offsets
+    for _ in range(max_rides):
+        if not len(marked):
+            break
+        previous = rounds[-1][0]
+        arrival = previous.copy()
+        kind = np.zeros(n, dtype=np.int8)
+        walked_from = np.full(n, -1, dtype=np.int64)
+        ride_at = np.full(n, INF, dtype=np.int64)
+        ride_alight = np.full(n, -1, dtype=np.int64)
+        ride_board = np.full(n, -1, dtype=np.int64)
+
+        # Routes through a marked stop, each scanned from its first marked stop on
+        entries, _ = _gather(network.stop_entry_offsets, network.stop_entries, marked)
+        if not len(entries):
+            break
+        entries = np.sort(entries)
+        routes = network.entry_route[entries]
+        first = np.r_[True, routes[1:] != routes[:-1]]
+        starts, routes = entries[first], routes[first]
+        ends = route_stop_offsets[routes + 1]
+        lengths = ends - starts
+        segment = np.repeat(np.arange(len(starts)), lengths)
+        entry = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        entry_route = network.entry_route[entry]
+        trips = network.trip_counts[entry_route]
+        stop = network.route_stops[entry]
+
+        # First catchable trip at every route-stop (trips run in order, so
+        # one searchsorted per column, all columns at once)
+        ready = previous[stop]
+        column_start = network.time_starts[entry]
+        catch = np.searchsorted(network.col_keys, entry * KEY_STRIDE + np.minimum(ready, KEY_STRIDE - 1)) - column_start
+        catch = np.where(ready < INF, np.minimum(catch, trips), trips)
+
+        # Best trip boarded strictly before each stop of the segment: a
+        # segmented running minimum, done as a running maximum of
+        # segment * big + (limit - trip) * width + boarding entry
+        width = np.int64(len(network.route_stops) + 1)
+        limit = np.int64(network.trip_counts.max() + 1)
+        big = (limit + 1) * width
+        key = segment * big + (limit - catch) * width + entry
+        running = np.maximum.accumulate(key)
+        carried = np.r_[np.int64(-1), running[:-1]]
+        same_segment = np.r_[False, segment[1:] == segment[:-1]]
+        local = carried - segment * big
+        trip = limit - local // width
+        board = local % width
+        riding = same_segment & (trip < trips)
+        if riding.any():
+            entry, stop, trip, board = entry[riding], stop[riding], trip[riding], board[riding]
+            at = network.times[network.time_starts[entry] + trip]
+            better = at < best[stop]
+            entry, stop, trip, board, at = entry[better], stop[better], trip[better], board[better], at[better]
+            if len(stop):
+                win = _lowest_per_stop(stop, at)
+                entry, stop, trip, board, at = entry[win], stop[win], trip[win], board[win], at[win]
+                arrival[stop] = at
+                best[stop] = at
+                kind[stop] = _RIDE
+                ride_at[stop] = at
+                ride_alight[stop] = entry
+                ride_board[stop] = board * limit + trip
+        ridden = np.flatnonzero(kind == _RIDE)
+
+        # Walking transfers from stops just reached by a vehicle
+        targets, sources = _gather(network.transfer_offsets, network.transfer_to, ridden)
+        if len(targets):
+            walk, _ = _gather(network.transfer_offsets, network.transfer_seconds, ridden)
+            at = ride_at[sources] + walk
+            better = at < best[targets]
+            targets, sources, at = targets[better], sources[better], at[better]
+            if len(targets):
+                win = _lowest_per_stop(targets, at)
+                targets, sources, at = targets[win], sources[win], at[win]
+                arrival[targets] = at
+                best[targets] = at
+                kind[targets] = _WALK
+                walked_from[targets] = sources
+        rounds.append((arrival, kind, walked_from, ride_at, ride_alight, ride_board))
+        marked = np.flatnonzero(kind != _INHERIT)
+    return rounds, np.int64(network.trip_counts.max() + 1) if len(network.trip_counts) else np.int64(1)
+
+
+def reconstruct(network, rounds, limit, k, stop):
+    """Legs (oldest first) of the round-k journey ending at `stop`."""
+    legs = []
+    while True:
+        arrival, kind, walked_from, ride_at, ride_alight, ride_board = rounds[k]
+        code = kind[stop]
+        if code == _INHERIT:
+            k -= 1
+            continue
+        if code == _ACCESS:
+            return stop, legs[::-1]
+        if code == _WALK:
+            source = int(walked_from[stop])
+            legs.append(("walk", source, stop, int(ride_at[source]), int(arrival[stop])))
+            stop = source # Reached by a vehicle in this same round
+        alight = int(ride_alight[stop])
+        board, trip = divmod(int(ride_board[stop]), int(limit))
+        route = int(network.entry_route[alight])
+        board_stop = int(network.route_stops[board])
+        depart = int(network.times[network.time_starts[board] + trip])
+        legs.append(("ride", route, trip, board, alight, board_stop, stop, depart, int(ride_at[stop])))
+        stop = board_stop
+        k -= 1
+
+
+class JourneyPlanner:
+    """
+    Plans journeys on the current TransitNetwork (`network()`, None until
+    one is built), caching answers per origin/destination (rounded to
+    ~10 m) and departure minute.
+    """
+
+    def __init__(self, network, cache_size=1024):
+        self.network_source = network
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.last_query_ms = 0.0
+
+    @property
+    def network(self):
+        return self.network_source()
+
+    def plan(self, from_lat, from_lng, to_lat, to_lng, depart, max_transfers=3):
+        """Pareto-optimal journeys (fewer vehicles vs earlier arrival), or None if no network yet."""
+        network = self.network
+        if network is None:
+            return None
+        key = (id(network), round(from_lat, 4), round(from_lng, 4), round(to_lat, 4), round(to_lng, 4),
+               int(depart) // 60, max_transfers)
+        with self.lock:
+            cached = self.cache.get(key)
+            # Answers from a network that has since been replaced age out of the LRU
+            if cached is not None and cached[0] is network:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+        self.misses += 1
+
+        started = time.perf_counter()
+        result = self._plan(network, from_lat, from_lng, to_lat, to_lng, int(depart), max_transfers)
+        self.last_query_ms = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.cache[key] = (network, result)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def _plan(self, network, from_lat, from_lng, to_lat, to_lng, depart, max_transfers):
+        access = network.stops_near(from_lat, from_lng, ACCESS_RADIUS_M)
+        egress_stops, egress_walk = network.stops_near(to_lat, to_lng, ACCESS_RADIUS_M)
+        egress_walk = egress_walk - np.where(network.stop_is_metro[egress_stops], METRO_ENTRY_SECONDS, 0)
+        rounds, limit = raptor(network, access, depart, max_transfers + 1)
+
+        journeys = []
+        direct_m = haversine_distance(from_lat, from_lng, to_lat, to_lng)
+        best_arrival = depart + int(direct_m / WALK_SPEED_MPS)
+        if direct_m <= 2 * ACCESS_RADIUS_M:
+            journeys.append(self._walk_only(from_lat, from_lng, to_lat, to_lng, depart, best_arrival, direct_m))
+        else:
+            best_arrival = INF
+        if len(egress_stops):
+            for k in range(1, len(rounds)):
+                at = rounds[k][0][egress_stops] + egress_walk
+                i = int(np.argmin(at))
+                if at[i] >= best_arrival:
+                    continue
+                best_arrival = int(at[i])
+                origin, legs = reconstruct(network, rounds, limit, k, int(egress_stops[i]))
+                journeys.append(self._describe(network, from_lat, from_lng, to_lat, to_lng, depart,
+                                               origin, legs, int(egress_stops[i]), int(egress_walk[i])))
+        return {"departure": format_seconds(depart)[:5], "journeys": journeys}
+
+    @staticmethod
+    def _place(network, stop):
+        return {"name": network.stop_names[stop], "stop_id": str(network.stop_ids[stop]),
+                "lat": float(network.stop_lats[stop]), "lng": float(network.stop_lons[stop])}
+
+    def _walk_only(self, from_lat, from_lng, to_lat, to_lng, depart, arrive, distance):
+        leg = {"type": "walk", "from": {"lat": from_lat, "lng": from_lng}, "to": {"lat": to_lat, "lng": to_lng},
+               "depart": format_seconds(depart)[:5], "arrive": format_seconds(arrive)[:5],
+               "duration_minutes": round((arrive - depart) / 60, 1), "distance_m": round(distance)}
+        return {"arrival": leg["arrive"], "duration_minutes": leg["duration_minutes"], "transfers": 0, "legs": [leg]}
+
+    def _describe(self, network, from_lat, from_lng, to_lat, to_lng, depart, origin, legs, last_stop, egress_s):
+        if legs and legs[-1][0] == "walk":
+            # Transfer walk straight into the egress walk: walk directly instead
+            last_stop = legs.pop()[1]
+            egress_s = TransitNetwork.walk_seconds(
+                haversine_distance(network.stop_lats[last_stop], network.stop_lons[last_stop], to_lat, to_lng))
+        out = []
+        walk_to = TransitNetwork.walk_seconds(
+            haversine_distance(from_lat, from_lng, network.stop_lats[origin], network.stop_lons[origin]),
+            network.stop_is_metro[origin])
+        first_arrival = depart + walk_to
+        out.append({"type": "walk", "from": {"lat": from_lat, "lng": from_lng}, "to": self._place(network, origin),
+                    "depart": format_seconds(depart)[:5], "arrive": format_seconds(first_arrival)[:5],
+                    "duration_minutes": round(walk_to / 60, 1)})
+        rides = 0
+        for leg in legs:
+            if leg[0] == "walk":
+                _, from_stop, to_stop, leave, arrive = leg
+                out.append({"type": "walk", "from": self._place(network, from_stop), "to": self._place(network, to_stop),
+                            "depart": format_seconds(leave)[:5], "arrive": format_seconds(arrive)[:5],
+                            "duration_minutes": round((arrive - leave) / 60, 1)})
+                continue
+            _, route, trip, board, alight, board_stop, alight_stop, leave, arrive = leg
+            rides += 1
+            out.append({"type": "metro" if network.route_is_metro[route] else "bus",
+                        "route": network.route_names[route],
+                        "trip_id": network.trip_labels[network.trip_offsets[route] + trip],
+                        "from": self._place(network, board_stop), "to": self._place(network, alight_stop),
+                        "depart": format_seconds(leave)[:5], "arrive": format_seconds(arrive)[:5],
+                        "stops": int(alight - board), "duration_minutes": round((arrive - leave) / 60, 1)})
+        last_arrival = int(legs[-1][-1]) if legs else first_arrival
+        arrive = last_arrival + egress_s
+        out.append({"type": "walk", "from": self._place(network, last_stop), "to": {"lat": to_lat, "lng": to_lng},
+                    "depart": format_seconds(last_arrival)[:5], "arrive": format_seconds(arrive)[:5],
+                    "duration_minutes": round(egress_s / 60, 1)})
+        return {"arrival": format_seconds(arrive)[:5], "duration_minutes": round((arrive - depart) / 60, 1),
+                "transfers": max(rides - 1, 0), "legs": out}
+
+    def stats(self):
+        network = self.network
+        stats = network.stats() if network is not None else {}
+        stats.update({"cached": len(self.cache), "hits": self.hits, "misses": self.misses,
+                      "last_query_ms": round(self.last_query_ms, 2)})
+        return stats
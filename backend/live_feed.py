@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Counter, Histogram
+
+OTD_FETCH_SECONDS = Histogram("dsatm_otd_fetch_seconds", "OTD feed HTTP request time (200 and 304)")
+OTD_PARSE_SECONDS = Histogram("dsatm_otd_parse_seconds", "OTD feed decode + JSON encode time")
+OTD_POLLS = Counter("dsatm_otd_polls", "OTD feed polls by result", ["result"])
+
+
+class LiveFeedPoller:
+    """
+    Single background fetcher for the OTD realtime feed.
+
+    One pooled session polls `url` every `interval_seconds`, sending
+    If-None-Match / If-Modified-Since so an unchanged feed costs a 304 and no
+    parsing. `decode(content)` turns the protobuf bytes into the bus list,
+    which is kept in memory together with its JSON encoding, so every client
+    gets the same bytes without re-serializing. `on_update(buses)`, if given,
+    is called after each change.
+    """
+
+    def __init__(self, url, decode, interval_seconds=10.0, timeout_seconds=10.0, on_update=None):
+        self.url = url
+        self.decode = decode
+        self.on_update = on_update
+        self.interval_seconds = interval_seconds
+        self.timeout_seconds = timeout_seconds
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.buses = []
+        self.body = b"[]" # JSON encoding of self.buses
+        self.updated_at = None # Last time we had a good copy of the feed (200 or 304)
+        self.changed_at = None # Last time the content actually changed
+        self.etag = None
+        self.last_modified = None
+        self.last_error = None
+        self.running = False
+
+        self.fetches = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.last_fetch_ms = 0.0
+        self.last_parse_ms = 0.0
+
+    def poll_once(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        self.fetches += 1
+        started = time.perf_counter()
+        try:
+            response = self.session.get(self.url, headers=headers, timeout=self.timeout_seconds)
+            self.last_fetch_ms = (time.perf_counter() - started) * 1000
+            OTD_FETCH_SECONDS.observe(self.last_fetch_ms / 1000)
+            if response.status_code == 304:
+                OTD_POLLS.labels("not_modified").inc()
+                self.not_modified += 1
+                self.updated_at = time.time()
+                self.last_error = None
+                return False
+            response.raise_for_status()
+
+            started = time.perf_counter()
+            buses = self.decode(response.content)
+            body = json.dumps(buses).encode()
+            self.last_parse_ms = (time.perf_counter() - started) * 1000
+            OTD_PARSE_SECONDS.observe(self.last_parse_ms / 1000)
+        except Exception as e:
+            OTD_POLLS.labels("error").inc()
+            self.errors += 1
+            self.last_error = str(e)
+            print(f"Error fetching data: {e}")
+            return False
+
+        OTD_POLLS.labels("changed").inc()
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        # Swap in the new list in one assignment; readers never see a partial list
+        self.buses, self.body = buses, body
+        self.updated_at = self.changed_at = time.time()
+        self.last_error = None
+        if self.on_update is not None:
+            self.on_update(buses)
+        return True
+
+    async def run(self):
+        self.running = True
+        try:
+            while True:
+                await asyncio.to_thread(self.poll_once)
+                await asyncio.sleep(self.interval_seconds)
+        finally:
+            self.running = False
+
+    def age_seconds(self):
+        if self.updated_at is None:
+            return None
+        return time.time() - self.updated_at
+
+    def stats(self):
+        age = self.age_seconds()
+        return {
+            "url": self.url.split("?")[0], # Don't leak the API key
+            "running": self.running,
+            "interval_seconds": self.interval_seconds,
+            "buses": len(self.buses),
+            "age_seconds": round(age, 3) if age is not None else None,
+            "fetches": self.fetches,
+            "not_modified": self.not_modified,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "last_fetch_ms": round(self.last_fetch_ms, 3),
+            "last_parse_ms": round(self.last_parse_ms, 3),
+        }
@@ -1,16 +1,45 @@
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
 from google.transit import gtfs_realtime_pb2
-import requests
-import pandas as pd
 import os
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import Optional
 import time
-import math
 import json
+import asyncio
+import numpy as np
+import threading
+from contextlib import asynccontextmanager
+from clustering import ClusterEngine
+from ingest import BatchScheduler
+from state_store import RedisStateStore, SharedClusterSync
+from live_feed import LiveFeedPoller
+from trip_resolver import TripResolver
+from shapes import ShapeStore
+from bus_stream import BusStream, BusFilter
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from metrics import REGISTRY, Counter, Gauge, Histogram, CallbackMetric
+from profiler import SamplingProfiler, render_collapsed
+from tracking import BusTracker
+from stop_eta import StopEtas, seconds_of_day
+from rate_limit import TokenBucketLimiter
+from journey import JourneyPlanner, build_network, load_metro_lines
+from gtfs_dataset import GtfsDataset, GtfsReloader, build_gtfs_dataset, gtfs_sources
+from history import HistoryWriter
+from route_analytics import RouteAnalytics
+from prepared import PreparedSnapshot, dump_json
 
-app = FastAPI()
+# Long-running jobs (coroutine functions) started with the app
+BACKGROUND_JOBS = []
+
+@asynccontextmanager
+async def lifespan(app):
+    tasks = [asyncio.create_task(job()) for job in BACKGROUND_JOBS]
+    yield
+    for task in tasks:
+        task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",
@@ -27,14 +56,90 @@ app.add_middleware(
 )
 
 # REPLACE WITH YOUR ACTUAL KEY
-OTD_URL = "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=Njl90zyCwKNqpVkuyF8K0ZNpwTkAbdX4"
+# (set OTD_URL to point at fake_otd_server.py for offline testing)
+OTD_URL = os.environ.get("OTD_URL", "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=Njl90zyCwKNqpVkuyF8K0ZNpwTkAbdX4")
+OTD_POLL_SECONDS = float(os.environ.get("OTD_POLL_SECONDS", "10"))
+UNKNOWN_TRIPS_FLUSH_SECONDS = 30 # How often unmatched trip ids go to unknown_routes.log
 GTFS_FOLDER = "../GTFS" # Relative to backend directory
+STOPS_CSV_PATH = "../final_merged_with_stops.csv"
+METRO_CSV = "../Delhi metro.csv" # Stations per line, for the journey planner
+JOURNEY_CACHE_SIZE = int(os.environ.get("JOURNEY_CACHE_SIZE", "2048")) # Planned origin/destination pairs kept
+
+# Hot-path metrics (served on /metrics; more in live_feed.py / ingest.py)
+REPORTS_RECEIVED = Counter("dsatm_reports_received", "broadcast-location reports by outcome", ["status"])
+CLUSTER_PUBLISH_SECONDS = Histogram("dsatm_cluster_publish_seconds", "cluster_reports() time (expire + publish)")
+GEOFENCE_SECONDS = Histogram("dsatm_geofence_seconds", "Stop match + delay time per route batch (validate_reports)")
+GEOFENCE_REPORTS = Counter("dsatm_geofence_reports", "Reports checked against stops, by result", ["result"])
+SNAPSHOT_RESPONSES = Counter("dsatm_snapshot_responses", "Pre-serialized responses served, by endpoint and result",
+                             ["endpoint", "result"])
+GTFS_LOAD_SECONDS = Gauge("dsatm_gtfs_load_seconds", "Time the last static GTFS load took")
+
+# Static data hot reload (gtfs_dataset.py): the source files are checked
+# every GTFS_WATCH_SECONDS (0 = never); setting ADMIN_TOKEN turns on
+# POST /admin/reload-gtfs (header X-Admin-Token)
+GTFS_WATCH_SECONDS = float(os.environ.get("GTFS_WATCH_SECONDS", "30"))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Follow each bus across cluster changes with a Kalman track (tracking.py);
+# /api/virtual-buses (filtered or not) and its SSE stream then extrapolate
+# positions, refreshed every PREDICTION_STEP_SECONDS, without re-clustering
+TRACKING_ENABLED = os.environ.get("TRACKING_ENABLED", "1") == "1"
+PREDICTION_STEP_SECONDS = float(os.environ.get("PREDICTION_STEP_SECONDS", "0.5"))
+
+# Reports further than this from their route's shape (route_shapes.json) are
+# dropped at ingest; 0 turns the check off. Routes without a shape always pass
+OFF_ROUTE_MAX_M = float(os.environ.get("OFF_ROUTE_MAX_M", "200"))
+
+# Neighbouring buses going the same way closer than this along their route
+# count as bunched
+# (/api/routes/{route_id}/analytics, /api/bunching)
+BUNCHING_GAP_M = float(os.environ.get("BUNCHING_GAP_M", "300"))
+
+# /api/stops/{stop_id}/arrivals answers are reused for this long per stop
+STOP_ETA_TTL_SECONDS = float(os.environ.get("STOP_ETA_TTL_SECONDS", "10"))
+
+# Opt-in: PROFILER_ENABLED=1 turns on /debug/profile
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+
+# Static GTFS data - route maps, stops, per-route schedules, per-stop
+# timetable (gtfs_dataset.GtfsDataset). Replaced whole on reload, never
+# mutated: read it into a local once if you need more than one field
+GTFS = GtfsDataset()
+TRIP_RESOLVER = TripResolver(lambda: GTFS) # Live trip_id -> route name, memoized per dataset
+
+GEOFENCE_RADIUS_M = 50 # "User is at a stop" radius
+CLUSTER_RADIUS_M = 50 # Reports closer than this are the same bus
+REPORT_TTL_SECONDS = 300 # Reports older than 5 minutes are dropped
 
-# Global variable to store the map
-TRIP_TO_ROUTE_MAP = {}
-ROUTE_ID_TO_NAME_MAP = {}
-STOPS_DF = None # Pandas DataFrame
-TRIP_STOPS = {} # Dict[trip_id, List[Dict]]
+# Ingest mode: "sync" clusters inside the request, "batch" queues reports
+# and re-clusters on a background tick.
+INGEST_MODE = os.environ.get("INGEST_MODE", "sync")
+CLUSTER_TICK_SECONDS = float(os.environ.get("CLUSTER_TICK_SECONDS", "0.5"))
+CLUSTER_BATCH_SIZE = int(os.environ.get("CLUSTER_BATCH_SIZE", "500")) # Tick early after N reports
+INGEST_QUEUE_HIGH_WATER = int(os.environ.get("INGEST_QUEUE_HIGH_WATER", "10000"))
+
+# Riders held by the clustering engine; past this the stalest one is evicted
+MAX_ACTIVE_REPORTS = int(os.environ.get("MAX_ACTIVE_REPORTS", "50000"))
+# Token buckets on broadcast-location (rate <= 0 turns one off). Per worker
+# process, like the queue high-water mark. Turn both off for mock_bus.py
+# --load throughput runs, whose riders report faster than 1/s
+USER_REPORTS_PER_SECOND = float(os.environ.get("USER_REPORTS_PER_SECOND", "1"))
+USER_REPORT_BURST = float(os.environ.get("USER_REPORT_BURST", "5"))
+ROUTE_REPORTS_PER_SECOND = float(os.environ.get("ROUTE_REPORTS_PER_SECOND", "100"))
+ROUTE_REPORT_BURST = float(os.environ.get("ROUTE_REPORT_BURST", "500"))
+
+# Opt-in: HISTORY_ENABLED=1 appends accepted reports and virtual bus
+# snapshots to HISTORY_DIR (history.py) for offline replay with replay_history.py
+HISTORY_ENABLED = os.environ.get("HISTORY_ENABLED", "0") == "1"
+HISTORY_DIR = os.environ.get("HISTORY_DIR", "history")
+HISTORY_FLUSH_SECONDS = float(os.environ.get("HISTORY_FLUSH_SECONDS", "2"))
+HISTORY_SNAPSHOT_SECONDS = float(os.environ.get("HISTORY_SNAPSHOT_SECONDS", "5")) # Bus snapshots at most this often
+HISTORY_RETENTION_DAYS = float(os.environ.get("HISTORY_RETENTION_DAYS", "7")) # 0 keeps everything
+
+# Where live reports and virtual buses live: "memory" (this process only) or
+# "redis" (shared by every worker; see state_store.py / fake_redis_server.py)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_REDIS_URL = os.environ.get("STATE_REDIS_URL", "redis://127.0.0.1:6379/0")
 
 # --- Virtual Bus Stores ---
 class UserReport(BaseModel):
@@ -44,8 +149,8 @@ class UserReport(BaseModel):
     lng: float
     timestamp: float
     speed: float = 0.0 # Optional, default 0
-    last_stop_id: str = None # Optional, for sequence check
-    last_stop_time: float = None # Optional
+    last_stop_id: Optional[str] = None # Optional, for sequence check
+    last_stop_time: Optional[float] = None # Optional
 
 class VirtualBus(BaseModel):
     id: str
@@ -57,267 +162,289 @@ class VirtualBus(BaseModel):
     confidence: float # 0.0 to 1.0
     last_updated: float
     delay_minutes: float = 0.0 # Estimated delay
+    delay_count: int = 0 # Reports validated against a stop (0: delay_minutes is unknown, not on time)
     status: str = "On Time" # On Time, Late, Early
+    speed_kmh: float = 0.0 # Smoothed speed from the bus track (0 when tracking is off)
 
 # In-memory stores
-USER_REPORTS: List[UserReport] = []
-VIRTUAL_BUSES: List[VirtualBus] = []
+# Live reports are owned by CLUSTER_ENGINE (created below, once the
+# validator exists). VIRTUAL_BUSES is the last published snapshot: a tuple
+# that is replaced, never mutated, so readers don't need a lock.
+VIRTUAL_BUSES = ()
+# Snapshot + deltas of VIRTUAL_BUSES for the SSE clients (see bus_stream.py)
+VIRTUAL_STREAM = BusStream("virtual-buses")
 
-def load_gtfs_data():
-    global TRIP_TO_ROUTE_MAP, ROUTE_ID_TO_NAME_MAP, STOPS_DF, TRIP_STOPS
-    try:
-        print("Loading Static GTFS Data... this might take a few seconds.")
-        
-        # 1. Load Final Merged Stops (The "Gold" Data)
-        stops_csv_path = "../final_merged_with_stops.csv"
-        if os.path.exists(stops_csv_path):
-            print(f"Loading {stops_csv_path}...")
-            STOPS_DF = pd.read_csv(stops_csv_path)
-            
-            # Create optimized lookup: trip_id -> list of stops
-            # We group by trip_id and convert to list of dicts for fast iteration
-            # Ensure sorting by arrival_time if not already
-            STOPS_DF = STOPS_DF.sort_values(by=['trip_id', 'arrival_time'])
-            
-            # Grouping
-            grouped = STOPS_DF.groupby('trip_id')
-            for trip_id, group in grouped:
-                TRIP_STOPS[str(trip_id)] = group.to_dict('records')
-                
-            print(f"Loaded {len(TRIP_STOPS)} trips with stop sequences.")
-        else:
-            print(f"Warning: {stops_csv_path} not found. Enhanced features will be disabled.")
-
-        if not os.path.exists(GTFS_FOLDER):
-            print(f"Warning: GTFS folder not found at {GTFS_FOLDER}. Skipping static data load.")
-            return
-
-        # A. Load Routes (Maps route_id -> "505")
-        routes_path = os.path.join(GTFS_FOLDER, 'routes.txt')
-        trips_path = os.path.join(GTFS_FOLDER, 'trips.txt')
-
-        if not os.path.exists(routes_path) or not os.path.exists(trips_path):
-             print("Warning: routes.txt or trips.txt not found. Skipping static data load.")
-             return
-
-        # Check for LFS pointer (simple check: file size < 200 bytes)
-        if os.path.getsize(routes_path) < 200 or os.path.getsize(trips_path) < 200:
-             print("Warning: GTFS files appear to be Git LFS pointers. Skipping static data load.")
-             # Raise exception to trigger fallback
-             raise Exception("GTFS files are LFS pointers")
-
-        routes_df = pd.read_csv(routes_path, usecols=['route_id', 'route_short_name', 'route_long_name'])
-        
-        # Handle missing short names
-        routes_df['route_name'] = routes_df['route_short_name'].fillna(routes_df['route_long_name'])
-        
-        # Convert to dictionary: {'route_101': '505', ...}
-        # Ensure route_id is string for consistent lookup
-        routes_df['route_id'] = routes_df['route_id'].astype(str)
-        ROUTE_ID_TO_NAME_MAP = dict(zip(routes_df.route_id, routes_df.route_name))
-        
-        # B. Load Trips (Maps trip_id -> route_id)
-        trips_df = pd.read_csv(trips_path, usecols=['trip_id', 'route_id'])
-        
-        # C. CREATE THE MASTER LOOKUP (trip_id -> "505")
-        trips_df['route_id'] = trips_df['route_id'].astype(str)
-        trips_df['bus_number'] = trips_df['route_id'].map(ROUTE_ID_TO_NAME_MAP)
-        
-        # Convert to final dictionary
-        TRIP_TO_ROUTE_MAP = dict(zip(trips_df.trip_id, trips_df.bus_number))
-        
-        print(f"Loaded {len(TRIP_TO_ROUTE_MAP)} trip mappings. Ready to serve!")
-        
-    except Exception as e:
-        print(f"Error loading GTFS data: {e}")
-        # Fallback: If we have STOPS_DF but failed to load routes/trips, 
-        # populate ROUTE_ID_TO_NAME_MAP from STOPS_DF unique route_ids
-        if STOPS_DF is not None and not ROUTE_ID_TO_NAME_MAP:
-            print("Populating Route Map from Stops Data (Fallback)...")
-            unique_routes = STOPS_DF['route_id'].unique()
-            for rid in unique_routes:
-                ROUTE_ID_TO_NAME_MAP[str(rid)] = f"Route {rid}"
-            print(f"Fallback: Loaded {len(ROUTE_ID_TO_NAME_MAP)} routes.")
-
-# Load data on startup
-load_gtfs_data()
+def route_display_name(route_id):
+    return GTFS.route_name(route_id)
+
+# Next arrivals per stop: timetable + live (OTD) / virtual bus delays, see stop_eta.py
+STOP_ETAS = StopEtas(dataset=lambda: GTFS, virtual_buses=lambda: VIRTUAL_BUSES, route_name=route_display_name,
+                     ttl_seconds=STOP_ETA_TTL_SECONDS)
+
+# Bus trips + metro lines flattened for RAPTOR (journey.py); built off the
+# event loop, /api/plan answers 503 until then
+JOURNEY_PLANNER = JourneyPlanner(network=lambda: GTFS.network, cache_size=JOURNEY_CACHE_SIZE)
+
+def build_gtfs(version=0, with_network=False, strict=False):
+    dataset = build_gtfs_dataset(STOPS_CSV_PATH, GTFS_FOLDER, version, extra_sources=[METRO_CSV], strict=strict)
+    if with_network and dataset.merged is not None:
+        # Names from the new dataset, not the one being served
+        metro = load_metro_lines(METRO_CSV) if os.path.exists(METRO_CSV) else {}
+        network = build_network(dataset.merged, dataset.route_name, metro)
+        dataset = dataset.with_network(network)
+    GTFS_LOAD_SECONDS.set(dataset.build_seconds)
+    return dataset
+
+def install_gtfs(dataset):
+    # Everything built from the static data hangs off the dataset (the trip
+    # resolver, stop ETAs and journey planner read it through GTFS), so this
+    # one assignment switches every reader over at once
+    global GTFS
+    GTFS = dataset
+
+# Load data on startup (the journey network follows in the background)
+install_gtfs(build_gtfs())
+
+# Reload when the source files change, or on POST /admin/reload-gtfs
+GTFS_RELOADER = GtfsReloader(
+    build=lambda version: build_gtfs(version, with_network=True, strict=True),
+    install=install_gtfs,
+    sources=lambda: gtfs_sources(STOPS_CSV_PATH, GTFS_FOLDER, [METRO_CSV]),
+    current_stamp=GTFS.stamp,
+)
+if GTFS_WATCH_SECONDS > 0:
+    BACKGROUND_JOBS.append(lambda: GTFS_RELOADER.watch(GTFS_WATCH_SECONDS))
 
 # --- Helper Functions ---
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371000 # Radius of Earth in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
-    
-    a = math.sin(delta_phi / 2.0) ** 2 + \
-        math.cos(phi1) * math.cos(phi2) * \
-        math.sin(delta_lambda / 2.0) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    
-    return R * c
+def validate_reports(route_id, reports):
+    """
+    Strategy A: Check if each user is near a stop (Geofence).
+    Strategy B: Calculate delay based on scheduled arrival.
 
-def get_seconds_from_time(time_str):
-    # HH:MM:SS -> seconds
-    try:
-        h, m, s = map(int, time_str.split(':'))
-        return h * 3600 + m * 60 + s
-    except:
-        return 0
+    Works on every report of one route at once: distances to all of the
+    route's stops and the closest scheduled arrival (over every trip of the
+    route) are a few numpy operations per batch. Returns one
+    (stop_id, delay_minutes) per report; stop_id is None if not at a stop.
+    """
+    no_match = [(None, 0.0)] * len(reports)
+    gtfs = GTFS
+    if not gtfs.trip_stops or not reports:
+        return no_match # No data
+
+    schedule = gtfs.route_schedules.get(str(route_id))
+    if schedule is None:
+        GEOFENCE_REPORTS.labels("unknown_route").inc(len(reports))
+        return no_match
+
+    started = time.perf_counter()
+    # Seconds since local midnight, to compare against the schedule
+    timestamps = np.array([r.timestamp for r in reports], dtype=np.float64)
+    utc_offset = time.localtime(timestamps[0]).tm_gmtoff
+    seconds_of_day = ((timestamps + utc_offset) % 86400).astype(np.int64)
+
+    stop_index, _, _, delay_seconds = schedule.match(
+        [r.lat for r in reports], [r.lng for r in reports], seconds_of_day, GEOFENCE_RADIUS_M
+    )
+
+    results = []
+    for idx, delay in zip(stop_index, delay_seconds):
+        if idx < 0:
+            results.append((None, 0.0))
+        else:
+            # Delay = Actual - Scheduled, for the trip whose arrival is closest
+            results.append((schedule.stop_ids[idx], float(delay) / 60.0))
+    GEOFENCE_SECONDS.observe(time.perf_counter() - started)
+    at_stop = int((stop_index >= 0).sum())
+    GEOFENCE_REPORTS.labels("at_stop").inc(at_stop)
+    GEOFENCE_REPORTS.labels("off_stop").inc(len(reports) - at_stop)
+    return results
 
 def validate_user_and_calculate_delay(report: UserReport):
+    """Single-report form of validate_reports."""
+    return validate_reports(report.route_id, [report])[0]
+
+def build_virtual_bus(cluster):
+    confidence = 1.0 if len(cluster.members) >= 2 else 0.5
+    # Boost confidence for every report validated against a stop
+    confidence = min(1.0, confidence + 0.3 * cluster.delay_count)
+
+    avg_delay = cluster.avg_delay
+
+    status = "On Time"
+    if avg_delay > 5:
+        status = f"Late {int(avg_delay)} min"
+    elif avg_delay < -2:
+        status = "Early"
+
+    route_name = GTFS.route_id_to_name.get(cluster.route_id, f"Route {cluster.route_id}")
+
+    return VirtualBus(
+        id=cluster.id,
+        route_id=cluster.route_id,
+        route_name=route_name,
+        lat=cluster.lat,
+        lng=cluster.lng,
+        passenger_count=len(cluster.members),
+        confidence=confidence,
+        last_updated=cluster.last_updated,
+        delay_minutes=avg_delay,
+        delay_count=cluster.delay_count,
+        status=status
+    )
+
+def track_bus(bus, track):
+    # Cluster bus -> published bus: track id, filtered position and speed
+    lat, lng = track.position()
+    return bus.model_copy(update={
+        "id": track.id, "lat": lat, "lng": lng, "speed_kmh": round(track.speed_mps * 3.6, 1),
+    })
+
+def move_bus(bus, lat, lng):
+    return bus.model_copy(update={"lat": lat, "lng": lng})
+
+HISTORY = None
+if HISTORY_ENABLED:
+    HISTORY = HistoryWriter(HISTORY_DIR, flush_seconds=HISTORY_FLUSH_SECONDS,
+                            snapshot_seconds=HISTORY_SNAPSHOT_SECONDS, retention_days=HISTORY_RETENTION_DAYS)
+    BACKGROUND_JOBS.append(HISTORY.run)
+
+CLUSTER_ENGINE = ClusterEngine(
+    radius_m=CLUSTER_RADIUS_M,
+    ttl_seconds=REPORT_TTL_SECONDS,
+    validator=validate_reports,
+    max_reports=MAX_ACTIVE_REPORTS,
+)
+# Writers (sync requests or the batch tick) take this; readers never do
+CLUSTER_LOCK = threading.Lock()
+
+TRACKER = None
+if TRACKING_ENABLED:
+    # Route shapes come from SHAPE_STORE (route_shapes.json); routes without
+    # one are tracked on the plane
+    TRACKER = BusTracker(line_for=lambda route_id: SHAPE_STORE.line(route_id), retarget=track_bus)
+
+# Headways, bunching and delay percentiles per route, refreshed by
+# cluster_reports() and every OTD poll (route_analytics.py)
+ROUTE_ANALYTICS = RouteAnalytics(line_for=lambda route_id: SHAPE_STORE.line(route_id), bunching_gap_m=BUNCHING_GAP_M)
+
+# Extrapolated copy of VIRTUAL_BUSES: (computed at, source tuple, buses)
+PREDICTED_BUSES = (0.0, None, ())
+
+def current_virtual_buses():
+    """VIRTUAL_BUSES with positions predicted to now (refreshed every PREDICTION_STEP_SECONDS)."""
+    global PREDICTED_BUSES
+    if not predicting():
+        # Followers in the shared backend only have the leader's snapshot
+        return VIRTUAL_BUSES
+    now = time.time()
+    computed_at, source, buses = PREDICTED_BUSES
+    if source is not VIRTUAL_BUSES or now - computed_at >= PREDICTION_STEP_SECONDS:
+        source = VIRTUAL_BUSES
+        buses = tuple(TRACKER.predicted(now, move_bus))
+        PREDICTED_BUSES = (now, source, buses)
+    return buses
+
+# Serialized once per published (or re-predicted) tuple, not per request
+VIRTUAL_BUSES_RESPONSE = PreparedSnapshot(current_virtual_buses, dump_json)
+
+def predicting():
+    return TRACKER is not None and SHARED_STATE is None
+
+def refresh_virtual_stream():
+    # VIRTUAL_STREAM (filtered queries, SSE) holds the predicted buses too,
+    # moved along between publishes like the unfiltered snapshot
+    source = VIRTUAL_BUSES
+    buses = [bus.model_dump() for bus in current_virtual_buses()]
+    with CLUSTER_LOCK:
+        if VIRTUAL_BUSES is source: # Otherwise a publish already streamed newer buses
+            VIRTUAL_STREAM.update(buses)
+
+async def run_virtual_prediction():
+    while True:
+        await asyncio.sleep(PREDICTION_STEP_SECONDS)
+        try:
+            await asyncio.to_thread(refresh_virtual_stream)
+        except Exception as e:
+            print(f"Error refreshing predicted buses: {e}")
+
+def cluster_reports(now=None):
     """
-    Strategy A: Check if user is near a stop (Geofence).
-    Strategy B: Calculate delay based on scheduled arrival.
+    Expire old reports and publish the current virtual buses.
+
+    Reports are clustered incrementally as they arrive (see ClusterEngine),
+    so this only rebuilds the buses whose cluster changed. `now` is only
+    passed by replay_history.py.
     """
-    if not TRIP_STOPS:
-        return None, 0.0 # No data
-        
-    # Find potential trips for this route
-    # Since we only have route_id from user, we need to find a trip that matches 
-    # the current time roughly or just check all trips for this route?
-    # For simplicity/demo: We assume the user might be on ANY trip of this route.
-    # But checking ALL stops of ALL trips is expensive.
-    # Optimization: Filter by route_id first.
-    
-    # We need a Route -> Trips lookup. 
-    # Let's build it on the fly or cache it? Cache is better but for now:
-    
-    potential_matches = []
-    
-    # We iterate through all trips (expensive!) -> TODO: Optimize this lookup
-    # Better: Use STOPS_DF filtered by route_id
-    
-    # Let's try to find the CLOSEST stop in the entire dataset for this route
-    # This is "Geofence Trap"
-    
-    if STOPS_DF is None:
-        return None, 0.0
+    global VIRTUAL_BUSES
+    with CLUSTER_PUBLISH_SECONDS.time():
+        now = time.time() if now is None else now
+        CLUSTER_ENGINE.expire(now)
+        buses = CLUSTER_ENGINE.publish(build_virtual_bus)
+        changed, removed = CLUSTER_ENGINE.last_changed, CLUSTER_ENGINE.last_removed
+        if TRACKER is not None:
+            # Re-key the cluster buses by track, with smoothed positions
+            buses = TRACKER.update(changed, removed, now)
+            changed, removed = TRACKER.last_changed, TRACKER.last_removed
+        VIRTUAL_BUSES = tuple(buses)
+        streamed = TRACKER.predicted(now, move_bus, changed) if predicting() else changed
+        VIRTUAL_STREAM.apply([bus.model_dump() for bus in streamed], removed)
+        ROUTE_ANALYTICS.update_virtual(changed, removed, now)
+        if HISTORY is not None:
+            HISTORY.record_buses(VIRTUAL_BUSES, now)
 
-    # Filter for this route
-    route_stops = STOPS_DF[STOPS_DF['route_id'].astype(str) == str(report.route_id)]
-    
-    if route_stops.empty:
-        return None, 0.0
-        
-    # Find nearest stop
-    # Vectorized distance calculation would be faster, but let's iterate for now (simpler code)
-    min_dist = float('inf')
-    nearest_stop = None
-    
-    for _, stop in route_stops.iterrows():
-        dist = haversine_distance(report.lat, report.lng, stop['stop_lat'], stop['stop_lon'])
-        if dist < min_dist:
-            min_dist = dist
-            nearest_stop = stop
-            
-    # Strategy A: Geofence Trap (50 meters)
-    if min_dist <= 50:
-        # User is at a stop!
-        # Strategy B: Delta Calculation
-        # Calculate Delay
-        
-        # Current time in HH:MM:SS format? No, we have timestamp.
-        # We need to convert current timestamp to HH:MM:SS relative to today?
-        # Or just compare seconds if we assume the schedule is for "today".
-        
-        current_dt = datetime.fromtimestamp(report.timestamp)
-        current_seconds = current_dt.hour * 3600 + current_dt.minute * 60 + current_dt.second
-        
-        scheduled_seconds = get_seconds_from_time(nearest_stop['arrival_time'])
-        
-        # Delay = Actual - Scheduled
-        delay_seconds = current_seconds - scheduled_seconds
-        delay_minutes = delay_seconds / 60.0
-        
-        # Normalize delay (e.g. if it's negative, maybe they are early, or it's the wrong trip)
-        # For this MVP, we take it as is.
-        
-        return nearest_stop['stop_id'], delay_minutes
-        
-    return None, 0.0
-
-def cluster_reports():
-    global VIRTUAL_BUSES, USER_REPORTS
-    current_time = time.time()
-    
-    # 1. Cleanup old reports (> 5 minutes)
-    USER_REPORTS = [r for r in USER_REPORTS if current_time - r.timestamp < 300]
-    
-    # 2. Group by Route ID
-    reports_by_route = {}
-    for report in USER_REPORTS:
-        if report.route_id not in reports_by_route:
-            reports_by_route[report.route_id] = []
-        reports_by_route[report.route_id].append(report)
-        
-    new_virtual_buses = []
-    
-    # 3. Cluster within each route
-    for route_id, reports in reports_by_route.items():
-        # Simple clustering: If reports are within 50m, group them
-        processed = set()
-        
-        for i, r1 in enumerate(reports):
-            if i in processed:
-                continue
-                
-            cluster = [r1]
-            processed.add(i)
-            
-            for j, r2 in enumerate(reports):
-                if j in processed:
-                    continue
-                
-                dist = haversine_distance(r1.lat, r1.lng, r2.lat, r2.lng)
-                if dist < 50: # 50 meters
-                    cluster.append(r2)
-                    processed.add(j)
-            
-            if len(cluster) >= 1: 
-                avg_lat = sum(r.lat for r in cluster) / len(cluster)
-                avg_lng = sum(r.lng for r in cluster) / len(cluster)
-                
-                confidence = 1.0 if len(cluster) >= 2 else 0.5
-                
-                # Calculate average delay from reports in cluster
-                # We check if any report in the cluster has a valid stop match
-                total_delay = 0
-                delay_count = 0
-                
-                for r in cluster:
-                    stop_id, delay = validate_user_and_calculate_delay(r)
-                    if stop_id:
-                        total_delay += delay
-                        delay_count += 1
-                        # Boost confidence if validated against a stop
-                        confidence = min(1.0, confidence + 0.3)
-                
-                avg_delay = total_delay / delay_count if delay_count > 0 else 0.0
-                
-                status = "On Time"
-                if avg_delay > 5:
-                    status = f"Late {int(avg_delay)} min"
-                elif avg_delay < -2:
-                    status = "Early"
-                
-                route_name = ROUTE_ID_TO_NAME_MAP.get(route_id, f"Route {route_id}")
-                
-                v_bus = VirtualBus(
-                    id=f"vbus_{route_id}_{int(current_time)}_{i}",
-                    route_id=route_id,
-                    route_name=route_name,
-                    lat=avg_lat,
-                    lng=avg_lng,
-                    passenger_count=len(cluster),
-                    confidence=confidence,
-                    last_updated=current_time,
-                    delay_minutes=avg_delay,
-                    status=status
-                )
-                new_virtual_buses.append(v_bus)
-                
-    VIRTUAL_BUSES = new_virtual_buses
+def apply_report_batch(reports):
+    with CLUSTER_LOCK:
+        CLUSTER_ENGINE.upsert_many(reports)
+
+def publish_virtual_buses():
+    with CLUSTER_LOCK:
+        cluster_reports()
+
+INGEST_SCHEDULER = BatchScheduler(
+    apply_batch=apply_report_batch,
+    publish=publish_virtual_buses,
+    tick_seconds=CLUSTER_TICK_SECONDS,
+    batch_size=CLUSTER_BATCH_SIZE,
+    high_water=INGEST_QUEUE_HIGH_WATER,
+)
+
+def publish_shared_snapshot():
+    # Leader side: recluster and encode the snapshot for the other workers
+    cluster_reports()
+    return json.dumps([bus.model_dump() for bus in VIRTUAL_BUSES])
+
+def load_shared_snapshot(payload):
+    # Follower side: adopt the leader's snapshot
+    global VIRTUAL_BUSES
+    buses = json.loads(payload)
+    VIRTUAL_BUSES = tuple(VirtualBus(**bus) for bus in buses)
+    VIRTUAL_STREAM.update(buses)
+    ROUTE_ANALYTICS.replace_virtual(VIRTUAL_BUSES)
+
+SHARED_STATE = None
+SHARED_SYNC = None
+if STATE_BACKEND == "redis":
+    SHARED_STATE = RedisStateStore(STATE_REDIS_URL)
+    SHARED_SYNC = SharedClusterSync(
+        store=SHARED_STATE,
+        engine=CLUSTER_ENGINE,
+        lock=CLUSTER_LOCK,
+        parse_report=UserReport.model_validate_json,
+        publish_local=publish_shared_snapshot,
+        load_buses=load_shared_snapshot,
+        tick_seconds=CLUSTER_TICK_SECONDS,
+        batch_size=CLUSTER_BATCH_SIZE,
+    )
+    BACKGROUND_JOBS.append(SHARED_SYNC.run)
+elif INGEST_MODE == "batch":
+    BACKGROUND_JOBS.append(INGEST_SCHEDULER.run)
+if predicting():
+    BACKGROUND_JOBS.append(run_virtual_prediction)
+
+def active_report_count():
+    if SHARED_STATE is not None:
+        return SHARED_STATE.report_count()
+    return len(CLUSTER_ENGINE)
 
 @app.get("/")
 def read_root():
@@ -327,104 +454,460 @@ def read_root():
 def get_data():
     return {"message": "Data from FastAPI backend"}
 
-@app.get("/api/routes")
-def get_routes():
+def prepared_response(request, prepared, endpoint):
+    # Same bytes for every client: 304 if they have them, else the body in
+    # the best encoding they accept
+    headers = {"ETag": prepared.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == prepared.etag:
+        SNAPSHOT_RESPONSES.labels(endpoint, "not_modified").inc()
+        return Response(status_code=304, headers=headers)
+    body, encoding = prepared.encoded(request.headers.get("accept-encoding"))
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    SNAPSHOT_RESPONSES.labels(endpoint, encoding or "identity").inc()
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def sorted_routes(gtfs):
     # Return list of available routes for the dropdown
     # Sort by route name
-    routes = [{"id": k, "name": v} for k, v in ROUTE_ID_TO_NAME_MAP.items()]
+    routes = [{"id": k, "name": v} for k, v in gtfs.route_id_to_name.items()]
     return sorted(routes, key=lambda x: x['name'])
 
+# Rebuilt only when a GTFS reload swaps the dataset
+ROUTES_RESPONSE = PreparedSnapshot(lambda: GTFS, lambda gtfs: dump_json(sorted_routes(gtfs)))
+
+@app.get("/api/routes")
+def get_routes(request: Request):
+    return prepared_response(request, ROUTES_RESPONSE.get(), "routes")
+
+def is_off_route(report):
+    # Snap to the route shape; the segment grid keeps this to a handful of
+    # segments, and points far from the route give up early
+    if OFF_ROUTE_MAX_M <= 0:
+        return False
+    line = SHAPE_STORE.line(report.route_id)
+    if line is None:
+        return False
+    _, off = line.project(report.lat, report.lng, max_off=OFF_ROUTE_MAX_M)
+    return off > OFF_ROUTE_MAX_M
+
+USER_LIMITER = TokenBucketLimiter(USER_REPORTS_PER_SECOND, USER_REPORT_BURST)
+ROUTE_LIMITER = TokenBucketLimiter(ROUTE_REPORTS_PER_SECOND, ROUTE_REPORT_BURST)
+
+def record_history(report):
+    # Queued only; HISTORY.run writes it out in the background
+    if HISTORY is not None:
+        HISTORY.record_report(report)
+
 @app.post("/api/broadcast-location")
 def broadcast_location(report: UserReport):
-    global USER_REPORTS
-    
+    # Flooding clients are turned away before any other work
+    if not USER_LIMITER.allow(report.user_id):
+        REPORTS_RECEIVED.labels("rate_limited").inc()
+        return {"status": "ignored", "reason": "rate_limited", "active_reports": active_report_count()}
+    if not ROUTE_LIMITER.allow(report.route_id):
+        REPORTS_RECEIVED.labels("route_rate_limited").inc()
+        return {"status": "ignored", "reason": "route_rate_limited", "active_reports": active_report_count()}
+
     # FILTER: Ignore high speed (e.g. > 100 km/h) - likely a car
     if report.speed > 100:
-        return {"status": "ignored", "reason": "speed_too_high", "active_reports": len(USER_REPORTS)}
+        REPORTS_RECEIVED.labels("speed_too_high").inc()
+        return {"status": "ignored", "reason": "speed_too_high", "active_reports": active_report_count()}
+
+    if is_off_route(report):
+        REPORTS_RECEIVED.labels("off_route").inc()
+        return {"status": "ignored", "reason": "off_route", "active_reports": active_report_count()}
 
     # Add server timestamp if not provided or trust client? Trust client for now but validate
     report.timestamp = time.time()
     
-    # Remove existing report from this user to prevent duplicates
-    USER_REPORTS = [r for r in USER_REPORTS if r.user_id != report.user_id]
-    
-    USER_REPORTS.append(report)
-    
-    # Trigger clustering
-    cluster_reports()
-    
-    return {"status": "success", "active_reports": len(USER_REPORTS)}
+    if SHARED_STATE is not None:
+        # Whichever worker holds the leader lease clusters it on its next tick
+        if SHARED_STATE.queue_depth() >= INGEST_QUEUE_HIGH_WATER:
+            REPORTS_RECEIVED.labels("queue_full").inc()
+            return {"status": "ignored", "reason": "queue_full", "active_reports": active_report_count()}
+        SHARED_STATE.push_report(report.model_dump_json())
+        record_history(report)
+        REPORTS_RECEIVED.labels("queued").inc()
+        return {"status": "queued", "active_reports": active_report_count()}
+
+    if INGEST_MODE == "batch":
+        # Picked up by the next clustering tick
+        if not INGEST_SCHEDULER.submit(report):
+            REPORTS_RECEIVED.labels("queue_full").inc()
+            return {"status": "ignored", "reason": "queue_full", "active_reports": active_report_count()}
+        record_history(report)
+        REPORTS_RECEIVED.labels("queued").inc()
+        return {"status": "queued", "active_reports": active_report_count()}
+
+    record_history(report)
+    with CLUSTER_LOCK:
+        # Replaces any earlier report from this user and updates only the
+        # cluster(s) it touches
+        CLUSTER_ENGINE.upsert(report)
+
+        # Trigger clustering
+        cluster_reports()
+
+    REPORTS_RECEIVED.labels("success").inc()
+    return {"status": "success", "active_reports": len(CLUSTER_ENGINE)}
 
 @app.get("/api/virtual-buses")
-def get_virtual_buses():
-    # Return buses. Optional: Filter by confidence
-    return VIRTUAL_BUSES
+def get_virtual_buses(request: Request, route_id: Optional[str] = None, routes: Optional[str] = None,
+                      bbox: Optional[str] = None, min_confidence: Optional[float] = None):
+    """
+    All virtual buses, or only those on route_id / routes=ID[,ID...], inside
+    bbox=west,south,east,north and with confidence >= min_confidence.
+    """
+    bus_filter = bus_filter_from_query(VIRTUAL_STREAM, route_id, routes, bbox, min_confidence)
+    if bus_filter is None:
+        return prepared_response(request, VIRTUAL_BUSES_RESPONSE.get(), "virtual_buses")
+    return filtered_buses_response(VIRTUAL_STREAM, bus_filter)
 
-@app.get("/api/shapes")
-def get_shapes():
+@app.get("/api/ingest-stats")
+def get_ingest_stats():
+    # Queue depth and backpressure counters for the batch ingest mode
+    stats = INGEST_SCHEDULER.stats()
+    stats["mode"] = INGEST_MODE
+    stats["state_backend"] = STATE_BACKEND
+    stats["active_reports"] = active_report_count()
+    stats["virtual_buses"] = len(VIRTUAL_BUSES)
+    if TRACKER is not None:
+        stats["tracking"] = TRACKER.stats()
+    stats["stop_etas"] = STOP_ETAS.stats()
+    stats["journey_planner"] = JOURNEY_PLANNER.stats()
+    stats["gtfs"] = gtfs_status()
+    stats["route_analytics"] = ROUTE_ANALYTICS.stats()
+    if HISTORY is not None:
+        stats["history"] = HISTORY.stats()
+    stats["evicted_reports"] = CLUSTER_ENGINE.evicted
+    stats["rate_limits"] = {"user": USER_LIMITER.stats(), "route": ROUTE_LIMITER.stats()}
+    if SHARED_SYNC is not None:
+        stats["queue_depth"] = SHARED_STATE.queue_depth()
+        stats["shared"] = SHARED_SYNC.stats()
+    return stats
+
+def parse_route_list(route):
+    # "12,34" -> ["12", "34"]; None means no route filter
+    if route is None:
+        return None
+    return [r for r in route.split(',') if r]
+
+def parse_bbox(bbox):
+    # "west,south,east,north" -> tuple of floats
+    if bbox is None:
+        return None
     try:
-        if os.path.exists("route_shapes.json"):
-            with open("route_shapes.json", "r") as f:
-                return json.load(f)
-        return {}
-    except Exception as e:
-        print(f"Error loading shapes: {e}")
-        return {}
+        box = tuple(float(v) for v in bbox.split(','))
+    except ValueError:
+        box = ()
+    if len(box) != 4:
+        raise HTTPException(status_code=400, detail="bbox must be west,south,east,north")
+    return box
 
-@app.get("/api/live-buses")
-def get_buses():
+# route_shapes.json, parsed once and reloaded when the file changes
+SHAPE_STORE = ShapeStore("route_shapes.json", tolerance_px=float(os.environ.get("SHAPE_TOLERANCE_PX", "1.0")))
+
+async def build_route_lines():
+    # Cumulative distances + segment grids for every shape, so the first
+    # reports on a route don't pay for building them
+    started = time.perf_counter()
+    count = await asyncio.to_thread(SHAPE_STORE.build_lines)
+    if count:
+        print(f"Route lines built for {count} routes in {time.perf_counter() - started:.2f}s")
+
+BACKGROUND_JOBS.append(build_route_lines)
+
+@app.get("/api/shapes")
+def get_shapes(request: Request, route: Optional[str] = None, bbox: Optional[str] = None,
+               zoom: Optional[int] = None, encoding: str = "polyline"):
+    """
+    Without parameters: every route's full point list, as before.
+
+    route=ID[,ID...] and/or bbox=west,south,east,north select routes, zoom
+    simplifies them for that map zoom; these come back as encoded polylines
+    ({route_id: "..."}), or point lists with encoding=points.
+    """
+    route_ids = parse_route_list(route)
+    box = parse_bbox(bbox)
+    if encoding not in ("polyline", "points"):
+        raise HTTPException(status_code=400, detail="encoding must be polyline or points")
+
+    return prepared_response(request, SHAPE_STORE.get(route_ids, box, zoom, encoding), "shapes")
+
+def decode_vehicle_feed(content):
+    """Parse a VehiclePositions FeedMessage into the /api/live-buses list."""
     feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    
+    bus_list = []
+    
+    for entity in feed.entity:
+        if entity.HasField('vehicle'):
+            live_trip_id = entity.vehicle.trip.trip_id
+            
+            # Memoized trip -> route lookup; unmatched ids are logged by
+            # TRIP_RESOLVER's background flusher, not here
+            route_name = TRIP_RESOLVER.resolve(live_trip_id)
+
+            bus_data = {
+                "id": entity.id,
+                "lat": entity.vehicle.position.latitude,
+                "lng": entity.vehicle.position.longitude,
+                "speed": round(entity.vehicle.position.speed * 3.6, 1), # Convert m/s to km/h
+                "trip_id": live_trip_id,
+                "route": route_name
+            }
+            bus_list.append(bus_data)
+            
+    return bus_list
+
+# Live buses carry a route name ("route"), not a route id, so that's what
+# the stream's route filter matches
+LIVE_STREAM = BusStream("live-buses", route_key="route")
+
+def on_live_update(buses):
+    # Runs on the poller thread whenever the OTD list changes
+    LIVE_STREAM.update(buses)
+    STOP_ETAS.update_live(buses)
+    gtfs = GTFS
+    ROUTE_ANALYTICS.update_live(buses, gtfs.trip_route_id, STOP_ETAS.live_delay, gtfs.trip_direction.get)
+LIVE_FEED = LiveFeedPoller(OTD_URL, decode_vehicle_feed, interval_seconds=OTD_POLL_SECONDS,
+                           on_update=on_live_update)
+BACKGROUND_JOBS.append(LIVE_FEED.run)
+BACKGROUND_JOBS.append(lambda: TRIP_RESOLVER.run_flusher(UNKNOWN_TRIPS_FLUSH_SECONDS))
+
+@app.get("/api/live-buses")
+def get_buses(route_id: Optional[str] = None, routes: Optional[str] = None, bbox: Optional[str] = None):
+    # Served from the poller's cache; no upstream call per client.
+    # Filters work like /api/virtual-buses (no confidence on live buses).
+    if LIVE_FEED.updated_at is None and not LIVE_FEED.running:
+        # App started without its background jobs (e.g. a bare TestClient)
+        LIVE_FEED.poll_once()
+
+    if LIVE_FEED.updated_at is None:
+        raise HTTPException(status_code=503, detail=LIVE_FEED.last_error or "Live feed not loaded yet")
+
+    bus_filter = bus_filter_from_query(LIVE_STREAM, route_id, routes, bbox, None)
+    if bus_filter is not None:
+        return filtered_buses_response(LIVE_STREAM, bus_filter)
+
+    return Response(
+        content=LIVE_FEED.body,
+        media_type="application/json",
+        headers={"X-Feed-Age-Seconds": f"{LIVE_FEED.age_seconds():.1f}"},
+    )
+
+@app.get("/api/live-buses/status")
+def get_live_feed_status():
+    # Cache age and fetch counters for the OTD poller, plus trip match rates
+    stats = LIVE_FEED.stats()
+    stats["trip_resolution"] = TRIP_RESOLVER.stats()
+    return stats
+
+def bus_filter_from_query(stream, route_id, routes, bbox, min_confidence):
+    """BusFilter from the route_id / routes / bbox / min_confidence query params, or None."""
+    route_ids = parse_route_list(routes)
+    if route_id is not None:
+        route_ids = (route_ids or []) + [route_id]
+    if route_ids is not None and stream is LIVE_STREAM:
+        # Live buses only carry the route name; resolve names the way
+        # TRIP_RESOLVER does (unmatched ids become "Route <id>")
+        names = GTFS.route_id_to_name
+        route_ids = [str(names.get(r) or f"Route {r}") for r in route_ids]
+    bus_filter = BusFilter(route_ids, parse_bbox(bbox), min_confidence, stream.route_key)
+    return None if bus_filter.is_empty else bus_filter
+
+def filtered_buses_response(stream, bus_filter):
+    return Response(content=json.dumps(stream.query(bus_filter)), media_type="application/json")
+
+def stream_response(stream, bus_filter):
+    return StreamingResponse(
+        stream.events(bus_filter or BusFilter()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/virtual-buses/stream")
+def stream_virtual_buses(route_id: Optional[str] = None, routes: Optional[str] = None,
+                         bbox: Optional[str] = None, min_confidence: Optional[float] = None):
+    """
+    Server-Sent Events: one "snapshot" event, then "delta" events with
+    added / moved / removed buses as clusters change. Takes the same filters
+    as /api/virtual-buses.
+    """
+    return stream_response(VIRTUAL_STREAM, bus_filter_from_query(VIRTUAL_STREAM, route_id, routes, bbox, min_confidence))
+
+@app.get("/api/live-buses/stream")
+def stream_live_buses(route_id: Optional[str] = None, routes: Optional[str] = None, bbox: Optional[str] = None):
+    # Same as /api/virtual-buses/stream, for the OTD feed
+    return stream_response(LIVE_STREAM, bus_filter_from_query(LIVE_STREAM, route_id, routes, bbox, None))
+
+@app.get("/api/stops/{stop_id}/arrivals")
+def get_stop_arrivals(stop_id: str, limit: int = 5):
+    """
+    Next buses at a stop, soonest first: scheduled time, expected time,
+    ETA in minutes and where the delay came from (live / virtual / schedule).
+    """
+    limit = min(max(limit, 1), 50)
+    payload = STOP_ETAS.arrivals(stop_id, limit)
+    if payload is None:
+        raise HTTPException(status_code=404, detail="Unknown stop_id")
+    return payload
+
+@app.get("/api/routes/{route_id}/analytics")
+def get_route_analytics(route_id: str):
+    """
+    Buses on a route in order along its shape per direction, the gaps /
+    headways between them, bunched pairs and rolling delay percentiles -
+    for virtual (rider) and live (OTD) buses separately. Precomputed; this
+    is a lookup.
+    """
+    analytics = ROUTE_ANALYTICS.route(route_id)
+    if analytics is None:
+        raise HTTPException(status_code=404, detail="No buses seen on this route")
+    return {"route_id": route_id, "route_name": route_display_name(route_id), **analytics}
+
+@app.get("/api/bunching")
+def get_bunching():
+    # Every bunched pair right now, all routes
+    return ROUTE_ANALYTICS.bunching()
+
+async def build_journey_network():
+    # The network for the startup dataset; reloads build their own
+    dataset = GTFS
+    if dataset.merged is None:
+        print("Journey planner disabled: no merged stops file.")
+        return
+    def build():
+        metro = load_metro_lines(METRO_CSV) if os.path.exists(METRO_CSV) else {}
+        return build_network(dataset.merged, dataset.route_name, metro)
+    network = await asyncio.to_thread(build)
+    # Swap under the reloader's lock so a reload can't land in between
+    if not GTFS_RELOADER.lock.acquire(blocking=False):
+        return # A reload is running; it brings its own network
+    try:
+        if GTFS is not dataset:
+            return # A reload got there first
+        install_gtfs(dataset.with_network(network))
+    finally:
+        GTFS_RELOADER.lock.release()
+    print(f"Journey planner ready: {network.stats()}")
+
+BACKGROUND_JOBS.append(build_journey_network)
+
+def parse_clock(value):
+    # "HH:MM" -> seconds since midnight, raises HTTP 400 otherwise
+    try:
+        hours, minutes = value.split(":")
+        return int(hours) * 3600 + int(minutes) * 60
+    except ValueError:
+        raise HTTPException(status_code=400, detail="time must be HH:MM")
+
+@app.get("/api/plan")
+def plan_journey(from_lat: float, from_lng: float, to_lat: float, to_lng: float,
+                 depart: Optional[str] = None, max_transfers: int = 3):
+    """
+    Bus + metro journeys from one point to another, leaving at `depart`
+    (HH:MM, default now). Returns the Pareto set: the fastest journey for
+    each number of transfers that actually saves time, plus walking when
+    the two points are close.
+    """
+    start = parse_clock(depart) if depart else seconds_of_day(time.time())
+    result = JOURNEY_PLANNER.plan(from_lat, from_lng, to_lat, to_lng, start, min(max(max_transfers, 0), 5))
+    if result is None:
+        raise HTTPException(status_code=503, detail="Journey planner is still loading")
+    return result
+
+@app.get("/api/stream-stats")
+def get_stream_stats():
+    return {"virtual_buses": VIRTUAL_STREAM.stats(), "live_buses": LIVE_STREAM.stats()}
+
+# Values that live elsewhere, read when /metrics is scraped
+def ingest_queue_depth():
+    if SHARED_STATE is not None:
+        return SHARED_STATE.queue_depth()
+    return len(INGEST_SCHEDULER.queue)
+
+CallbackMetric("dsatm_ingest_queue_depth", "Reports waiting to be clustered", "gauge", ingest_queue_depth)
+CallbackMetric("dsatm_ingest_dropped", "Reports rejected at the queue high-water mark", "counter",
+               lambda: INGEST_SCHEDULER.dropped)
+CallbackMetric("dsatm_active_reports", "Live rider reports held by the clustering engine", "gauge",
+               lambda: len(CLUSTER_ENGINE))
+CallbackMetric("dsatm_evicted_reports", "Riders evicted at the MAX_ACTIVE_REPORTS cap", "counter",
+               lambda: CLUSTER_ENGINE.evicted)
+CallbackMetric("dsatm_virtual_buses", "Published virtual buses", "gauge", lambda: len(VIRTUAL_BUSES))
+CallbackMetric("dsatm_live_buses", "Buses in the cached OTD feed", "gauge", lambda: len(LIVE_FEED.buses))
+CallbackMetric("dsatm_otd_feed_age_seconds", "Seconds since the OTD feed was last confirmed fresh", "gauge",
+               LIVE_FEED.age_seconds)
+CallbackMetric("dsatm_trip_resolutions", "Live trip id lookups by how they matched", "counter",
+               lambda: [(("trip",), TRIP_RESOLVER.matched_trip), (("route",), TRIP_RESOLVER.matched_route),
+                        (("none",), TRIP_RESOLVER.unmatched)], ["matched"])
+CallbackMetric("dsatm_trip_resolver_cache", "Trip resolver LRU lookups", "counter",
+               lambda: [(("hit",), TRIP_RESOLVER.cache_hits), (("miss",), TRIP_RESOLVER.cache_misses)], ["result"])
+CallbackMetric("dsatm_stream_subscribers", "Open SSE connections", "gauge",
+               lambda: [(("virtual",), VIRTUAL_STREAM.subscribers), (("live",), LIVE_STREAM.subscribers)], ["stream"])
+CallbackMetric("dsatm_gtfs_version", "Version of the static GTFS data being served (bumps on reload)", "gauge",
+               lambda: GTFS.version)
+CallbackMetric("dsatm_gtfs_reloads", "Static GTFS hot reloads completed", "counter", lambda: GTFS_RELOADER.reloads)
+CallbackMetric("dsatm_history_rows", "Rows appended to the history store", "counter",
+               lambda: [((kind,), n) for kind, n in HISTORY.written.items()] if HISTORY is not None else [], ["kind"])
+CallbackMetric("dsatm_history_dropped", "History rows dropped with the write queue full", "counter",
+               lambda: HISTORY.dropped if HISTORY is not None else 0)
+CallbackMetric("dsatm_bunched_pairs", "Same-direction neighbours closer than BUNCHING_GAP_M along their route", "gauge",
+               lambda: [((source,), n) for source, n in ROUTE_ANALYTICS.bunched_pairs.items()], ["source"])
+CallbackMetric("dsatm_stop_eta_cache", "Stop arrival lookups by cache result", "counter",
+               lambda: [(("hit",), STOP_ETAS.hits), (("miss",), STOP_ETAS.misses)], ["result"])
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus text format
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+PROFILER = SamplingProfiler()
+
+@app.get("/debug/profile")
+def get_profile(seconds: float = 10.0, interval_ms: float = 5.0):
+    """
+    Sample every thread for `seconds` and return collapsed stacks
+    (flamegraph.pl / speedscope input). Only with PROFILER_ENABLED=1.
+    """
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler disabled (set PROFILER_ENABLED=1)")
+    if PROFILER.lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    PROFILER.interval_seconds = max(interval_ms, 1.0) / 1000
+    stacks, samples = PROFILER.profile(min(max(seconds, 0.1), 60.0))
+    return PlainTextResponse(render_collapsed(stacks), headers={"X-Profile-Samples": str(samples)})
+
+def gtfs_status():
+    gtfs = GTFS
+    stats = GTFS_RELOADER.stats()
+    stats.update({
+        "serving_version": gtfs.version,
+        "built_at": gtfs.built_at,
+        "build_seconds": round(gtfs.build_seconds, 3),
+        "routes": len(gtfs.route_id_to_name),
+        "trips": len(gtfs.trip_to_route),
+        "journey_network": gtfs.network is not None,
+    })
+    return stats
+
+@app.post("/admin/reload-gtfs")
+async def reload_gtfs(request: Request):
+    """
+    Rebuild the static GTFS data from disk and swap it in. Requests keep
+    being served from the old data while the new one builds. Only with
+    ADMIN_TOKEN set.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints disabled (set ADMIN_TOKEN)")
+    if request.headers.get("x-admin-token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Bad admin token")
     try:
-        response = requests.get(OTD_URL)
-        response.raise_for_status()
-        feed.ParseFromString(response.content)
-        
-        bus_list = []
-        
-        for entity in feed.entity:
-            if entity.HasField('vehicle'):
-                live_trip_id = entity.vehicle.trip.trip_id
-                
-                # Strategy 1: Direct Trip ID Lookup
-                route_name = TRIP_TO_ROUTE_MAP.get(live_trip_id)
-                
-                # Strategy 2: Extract Route ID from Trip ID (e.g. "1879_0_6" -> "1879")
-                if not route_name:
-                    try:
-                        # Assuming format is route_id_...
-                        potential_route_id = live_trip_id.split('_')[0]
-                        route_name = ROUTE_ID_TO_NAME_MAP.get(potential_route_id)
-                        
-                        # If still not found, use the ID itself as a fallback
-                        if not route_name:
-                             route_name = f"Route {potential_route_id}"
-                    except:
-                        pass
-                
-                if not route_name:
-                    route_name = "Unknown Route"
-                
-                # If route_name is NaN (from pandas), replace it
-                if pd.isna(route_name):
-                    route_name = "Unknown Route"
-
-                # DEBUG: Log unknown routes for RCA
-                if route_name == "Unknown Route":
-                     with open("unknown_routes.log", "a") as f:
-                        f.write(f"Unmatched Live Trip ID: '{live_trip_id}'\n")
-
-                bus_data = {
-                    "id": entity.id,
-                    "lat": entity.vehicle.position.latitude,
-                    "lng": entity.vehicle.position.longitude,
-                    "speed": round(entity.vehicle.position.speed * 3.6, 1), # Convert m/s to km/h
-                    "trip_id": live_trip_id,
-                    "route": str(route_name) # Ensure string
-                }
-                bus_list.append(bus_data)
-                
-        return bus_list
-        
+        result = await asyncio.to_thread(GTFS_RELOADER.reload, "admin")
     except Exception as e:
-        print(f"Error fetching data: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail=f"Reload failed, still serving the old data: {e}")
+    if result is None:
+        raise HTTPException(status_code=409, detail="A reload is already running")
+    return gtfs_status()
@@ -1,15 +1,37 @@
+"""
+Ghost rider(s) for /api/broadcast-location.
+
+    python mock_bus.py --route 505              # one rider along a route shape
+    python mock_bus.py --load --buses 500       # load test, many riders at once
+
+Load runs send each simulated rider's reports much faster than a real phone
+(every --interval / --time-scale wall seconds: 1/s with the defaults), which
+is exactly what the server's per-user token bucket (USER_REPORTS_PER_SECOND,
+default 1/s, burst 5) is there to stop. Start the server with the limits off
+for throughput runs, or every rider above 1 report/s is throttled:
+
+    USER_REPORTS_PER_SECOND=0 ROUTE_REPORTS_PER_SECOND=0 uvicorn main:app
+
+Rate-limited answers are counted separately ("rate_limited" in the summary)
+and left out of the latency percentiles.
+"""
 import requests
 import time
 import json
 import sys
 import random
 import argparse
+import asyncio
+import bisect
+import math
+from functools import lru_cache
 
 # Configuration
 API_URL = "http://localhost:8000/api/broadcast-location"
 ROUTES_FILE = "route_shapes.json"
 STOPS_FILE = "../final_merged_with_stops.csv"
 
+@lru_cache(maxsize=1)
 def load_shapes():
     try:
         with open(ROUTES_FILE, 'r') as f:
@@ -18,23 +40,28 @@ def load_shapes():
         print(f"Error: {ROUTES_FILE} not found. Please run generate_shapes.py first.")
         sys.exit(1)
 
-def load_stops(route_id):
+@lru_cache(maxsize=1)
+def load_stops_by_route():
+    # Read once, only the columns we use, grouped by route
     try:
         import pandas as pd
-        df = pd.read_csv(STOPS_FILE)
-        # Filter by route_id
-        route_stops = df[df['route_id'].astype(str) == str(route_id)]
-        if route_stops.empty:
-            print(f"No stops found for route {route_id}")
-            return []
-        return route_stops.to_dict('records')
+        df = pd.read_csv(STOPS_FILE, usecols=['route_id', 'stop_id', 'stop_lat', 'stop_lon'])
+        df['route_id'] = df['route_id'].astype(str)
+        return {route_id: group for route_id, group in df.groupby('route_id')}
     except Exception as e:
         print(f"Error loading stops: {e}")
+        return {}
+
+def load_stops(route_id):
+    route_stops = load_stops_by_route().get(str(route_id))
+    if route_stops is None:
+        print(f"No stops found for route {route_id}")
         return []
+    return route_stops.to_dict('records')
 
 def simulate_trip(user_id, route_id, speed_factor=1.0, offset_lat=0, offset_lng=0, payload_speed=0.0):
     shapes = load_shapes()
-    
+
     # If route_id not provided or not found, pick a random one
     if not route_id or route_id not in shapes:
         available_routes = list(shapes.keys())
@@ -48,7 +75,7 @@ def simulate_trip(user_id, route_id, speed_factor=1.0, offset_lat=0, offset_lng=
 
     path = shapes[route_id] # List of [lat, lng]
     stops = load_stops(route_id)
-    
+
     print(f"👻 Ghost Rider '{user_id}' starting trip on Route {route_id}...")
     print(f"   Path length: {len(path)} points")
     print(f"   Stops found: {len(stops)}")
@@ -60,17 +87,19 @@ def simulate_trip(user_id, route_id, speed_factor=1.0, offset_lat=0, offset_lng=
     step = int(1 * speed_factor)
     if step < 1: step = 1
 
+    session = requests.Session() # Keep-alive instead of a new connection per point
+
     for i in range(0, len(path), step):
         lat, lng = path[i]
-        
+
         # Check if we are near a stop to simulate "stopping"
         # Simple check: if distance to any stop < 50m
         # (This logic is just for visual feedback in the script, the backend does the real check)
-        
+
         # Apply offset (for simulating multiple users on same bus)
         lat += offset_lat
         lng += offset_lng
-        
+
         payload = {
             "user_id": user_id,
             "route_id": route_id,
@@ -79,9 +108,9 @@ def simulate_trip(user_id, route_id, speed_factor=1.0, offset_lat=0, offset_lng=
             "timestamp": time.time(),
             "speed": payload_speed
         }
-        
+
         try:
-            r = requests.post(API_URL, json=payload)
+            r = session.post(API_URL, json=payload)
             if r.status_code == 200:
                 resp = r.json()
                 if resp.get("status") == "ignored":
@@ -98,8 +127,248 @@ def simulate_trip(user_id, route_id, speed_factor=1.0, offset_lat=0, offset_lng=
 
     print(f"🏁 [{user_id}] Trip Complete.")
 
+# --- Load test mode ---
+# Many simulated buses, each carrying a group of riders that report
+# concurrently, at an accelerated clock. Paths come from route_shapes.json
+# if it exists, otherwise from the stop sequence of real trips in the
+# merged stops file, so stop validation runs like it does in production.
+
+class BusPath:
+    """A polyline with cumulative distances, to place a bus at any distance along it."""
+
+    def __init__(self, route_id, points):
+        self.route_id = route_id
+        self.lats = [p[0] for p in points]
+        self.lngs = [p[1] for p in points]
+        self.cum = [0.0]
+        for i in range(1, len(points)):
+            self.cum.append(self.cum[-1] + _approx_distance(self.lats[i - 1], self.lngs[i - 1], self.lats[i], self.lngs[i]))
+
+    @property
+    def length(self):
+        return self.cum[-1]
+
+    def position(self, distance):
+        # Buses loop back to the start when they reach the end
+        if self.length <= 0:
+            return self.lats[0], self.lngs[0]
+        distance %= self.length
+        i = max(bisect.bisect_right(self.cum, distance) - 1, 0)
+        if i >= len(self.cum) - 1:
+            return self.lats[-1], self.lngs[-1]
+        span = self.cum[i + 1] - self.cum[i]
+        t = (distance - self.cum[i]) / span if span > 0 else 0.0
+        return (self.lats[i] + (self.lats[i + 1] - self.lats[i]) * t,
+                self.lngs[i] + (self.lngs[i + 1] - self.lngs[i]) * t)
+
+def _approx_distance(lat1, lng1, lat2, lng2):
+    # Equirectangular; plenty for consecutive path points
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000 * math.hypot(x, y)
+
+def load_bus_paths(count, rng):
+    """`count` random paths: route shapes if we have them, otherwise GTFS trips."""
+    try:
+        with open(ROUTES_FILE, 'r') as f:
+            shapes = json.load(f)
+    except FileNotFoundError:
+        shapes = {}
+    shapes = {r: pts for r, pts in shapes.items() if len(pts) >= 2}
+    if shapes:
+        print(f"Using {len(shapes)} route shapes from {ROUTES_FILE}")
+        route_ids = sorted(shapes)
+        return [BusPath(r, shapes[r]) for r in (rng.choice(route_ids) for _ in range(count))]
+
+    import gtfs_snapshot
+    print(f"No {ROUTES_FILE}; using trip stop sequences from {STOPS_FILE}")
+    merged = gtfs_snapshot.load_merged_stops(STOPS_FILE)
+    offsets = merged['_trip_offsets']
+    route_codes = merged['route_id']
+    route_values = merged.get('route_id__values')
+    paths = []
+    while len(paths) < count:
+        trip = rng.randrange(len(offsets) - 1)
+        start, end = int(offsets[trip]), int(offsets[trip + 1])
+        if end - start < 2:
+            continue
+        code = route_codes[start]
+        route_id = str(route_values[code]) if route_values is not None else str(code)
+        points = list(zip(merged['stop_lat'][start:end].tolist(), merged['stop_lon'][start:end].tolist()))
+        paths.append(BusPath(route_id, points))
+    return paths
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    i = min(int(round(q / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[i]
+
+# "ignored" reasons that mean the server throttled us rather than judged the report
+RATE_LIMIT_REASONS = ("rate_limited", "route_rate_limited")
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = [] # seconds, requests the server actually processed
+        self.statuses = {} # response "status" (ignored: by reason, or error) -> count
+        self.rate_limited = 0
+        self.server_samples = [] # /api/ingest-stats snapshots
+
+    def record(self, status, latency=None):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def record_response(self, body, latency):
+        status = body.get("status", "unknown")
+        if status == "ignored":
+            reason = body.get("reason")
+            status = f"ignored:{reason}"
+            if reason in RATE_LIMIT_REASONS:
+                # Answered before any real work; would flatter the latencies
+                self.rate_limited += 1
+                latency = None
+        self.record(status, latency)
+
+async def ride(client, url, user_id, bus, jitter, start_distance, speed_mps, interval_s, time_scale, stop_at, stats, rng):
+    """One rider: report the bus position (plus a few metres of jitter) every interval."""
+    await asyncio.sleep(rng.uniform(0, interval_s / time_scale)) # Spread the first wave
+    started = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= stop_at:
+            return
+        sim_elapsed = (now - started) * time_scale
+        lat, lng = bus.position(start_distance + sim_elapsed * speed_mps)
+        payload = {
+            "user_id": user_id,
+            "route_id": bus.route_id,
+            "lat": lat + jitter[0],
+            "lng": lng + jitter[1],
+            "timestamp": time.time(),
+            "speed": round(speed_mps * 3.6, 1),
+        }
+        t0 = time.perf_counter()
+        try:
+            r = await client.post(url, json=payload)
+            latency = time.perf_counter() - t0
+            if r.status_code == 200:
+                stats.record_response(r.json(), latency)
+            else:
+                stats.record(f"http_{r.status_code}")
+        except Exception as e:
+            stats.record(type(e).__name__)
+        next_at = now + interval_s / time_scale
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+
+async def poll_server(client, base_url, stop_at, stats, every_s=1.0):
+    while time.monotonic() < stop_at:
+        try:
+            r = await client.get(f"{base_url}/api/ingest-stats")
+            if r.status_code == 200:
+                sample = r.json()
+                sample["t"] = time.monotonic()
+                stats.server_samples.append(sample)
+        except Exception:
+            pass
+        await asyncio.sleep(every_s)
+
+async def run_load(args):
+    try:
+        import httpx
+    except ImportError:
+        print("Load mode needs httpx (pip install httpx)")
+        sys.exit(1)
+
+    rng = random.Random(args.seed)
+    url = args.url
+    base_url = url.split("/api/")[0]
+    paths = load_bus_paths(args.buses, rng)
+    stats = LoadStats()
+
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        before = (await client.get(f"{base_url}/api/ingest-stats")).json()
+        riders = 0
+        tasks = []
+        stop_at = time.monotonic() + args.duration
+        for b, bus in enumerate(paths):
+            start_distance = rng.uniform(0, bus.length)
+            # Groups riding the same bus: 1..riders_per_bus, a few metres apart
+            for k in range(rng.randint(1, args.riders_per_bus)):
+                jitter = (rng.uniform(-8, 8) / 111000, rng.uniform(-8, 8) / 111000)
+                tasks.append(ride(client, url, f"load_{args.seed}_{b}_{k}", bus, jitter, start_distance,
+                                  args.bus_speed, args.interval, args.time_scale, stop_at, stats, rng))
+                riders += 1
+        print(f"Simulating {riders} riders on {len(paths)} buses for {args.duration}s "
+              f"(report every {args.interval}s simulated, {args.time_scale}x time)...")
+        started = time.perf_counter()
+        await asyncio.gather(poll_server(client, base_url, stop_at, stats), *tasks)
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(args.settle)
+        after = (await client.get(f"{base_url}/api/ingest-stats")).json()
+        virtual_buses = after.get("virtual_buses")
+
+    return summarize(args, stats, before, after, riders, len(paths), elapsed, virtual_buses)
+
+def summarize(args, stats, before, after, riders, buses, elapsed, virtual_buses):
+    latencies = sorted(stats.latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    tick_ms = sorted(s["last_tick_ms"] for s in stats.server_samples if s.get("last_tick_ms"))
+    total = sum(stats.statuses.values())
+    result = {
+        "seed": args.seed,
+        "riders": riders,
+        "buses": buses,
+        "duration_s": round(elapsed, 2),
+        "time_scale": args.time_scale,
+        "mode": after.get("mode"),
+        "state_backend": after.get("state_backend"),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 1) if elapsed > 0 else None,
+        "statuses": stats.statuses,
+        "rate_limited": stats.rate_limited,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 50)),
+            "p90": ms(percentile(latencies, 90)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        # Batch / shared modes re-cluster on a tick; sync mode clusters inside
+        # each request, so there it shows up in the request latency instead
+        "cluster_tick_ms": {
+            "p50": percentile(tick_ms, 50),
+            "p99": percentile(tick_ms, 99),
+            "max": tick_ms[-1] if tick_ms else None,
+            "ticks": (after.get("ticks", 0) - before.get("ticks", 0)),
+        },
+        "server_processed": after.get("processed", 0) - before.get("processed", 0),
+        "server_dropped": after.get("dropped", 0) - before.get("dropped", 0),
+        "max_queue_depth": max((s.get("max_depth", 0) for s in stats.server_samples), default=0),
+        "active_reports": after.get("active_reports"),
+        "virtual_buses": virtual_buses,
+    }
+    return result
+
+def print_summary(result):
+    print("")
+    print(f"Requests      : {result['requests']} in {result['duration_s']}s -> {result['throughput_rps']} req/s "
+          f"({result['mode']}, {result['state_backend']})")
+    print(f"Statuses      : {result['statuses']}")
+    if result['rate_limited']:
+        print(f"Rate limited  : {result['rate_limited']} requests (not in the latencies) - run the server with "
+              f"USER_REPORTS_PER_SECOND=0 ROUTE_REPORTS_PER_SECOND=0 to measure throughput")
+    lat = result['latency_ms']
+    print(f"Latency (ms)  : p50 {lat['p50']}  p90 {lat['p90']}  p99 {lat['p99']}  max {lat['max']}")
+    tick = result['cluster_tick_ms']
+    print(f"Cluster tick  : p50 {tick['p50']}  p99 {tick['p99']}  max {tick['max']} ms over {tick['ticks']} ticks")
+    print(f"Server        : processed {result['server_processed']}, dropped {result['server_dropped']}, "
+          f"max queue {result['max_queue_depth']}")
+    print(f"Clusters      : {result['virtual_buses']} virtual buses for {result['buses']} simulated buses "
+          f"({result['active_reports']} active reports, {result['riders']} riders)")
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Simulate a user on a bus.')
+    parser = argparse.ArgumentParser(description='Simulate a user on a bus, or (--load) many of them.')
     parser.add_argument('--user', type=str, default=f"ghost_{int(time.time())}", help='User ID')
     parser.add_argument('--route', type=str, help='Route ID (optional)')
     parser.add_argument('--speed', type=float, default=5.0, help='Speed factor (skip points)')
@@ -107,6 +376,28 @@ if __name__ == "__main__":
     parser.add_argument('--offset_lng', type=float, default=0.0, help='Longitude offset')
     parser.add_argument('--payload-speed', type=float, default=0.0, help='Speed value to send in payload')
 
+    load = parser.add_argument_group('load test')
+    load.add_argument('--load', action='store_true', help='Run the load test instead of a single rider')
+    load.add_argument('--url', type=str, default=API_URL, help='broadcast-location URL')
+    load.add_argument('--buses', type=int, default=500, help='Simulated buses')
+    load.add_argument('--riders-per-bus', type=int, default=4, help='Up to this many riders per bus')
+    load.add_argument('--interval', type=float, default=10.0, help='Simulated seconds between reports per rider')
+    load.add_argument('--time-scale', type=float, default=10.0, help='Simulated seconds per wall second')
+    load.add_argument('--bus-speed', type=float, default=6.0, help='Bus speed in m/s (simulated)')
+    load.add_argument('--duration', type=float, default=30.0, help='Wall-clock seconds to run')
+    load.add_argument('--connections', type=int, default=100, help='HTTP connection pool size')
+    load.add_argument('--timeout', type=float, default=10.0, help='Request timeout in seconds')
+    load.add_argument('--settle', type=float, default=1.0, help='Seconds to wait for the last tick before reading stats')
+    load.add_argument('--seed', type=int, default=1, help='Same seed -> same buses, riders and start points')
+    load.add_argument('--json', type=str, help='Also write the summary to this file (for before/after diffs)')
+
     args = parser.parse_args()
-    
-    simulate_trip(args.user, args.route, args.speed, args.offset_lat, args.offset_lng, args.payload_speed)
+
+    if args.load:
+        result = asyncio.run(run_load(args))
+        print_summary(result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2)
+    else:
+        simulate_trip(args.user, args.route, args.speed, args.offset_lat, args.offset_lng, args.payload_speed)
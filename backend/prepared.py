@@ -0,0 +1,116 @@
+"""
+Response bodies serialized once and served as bytes.
+
+A PreparedResponse holds the JSON of one payload, its ETag (a hash of the
+body) and compressed copies, made on first use per encoding. Endpoints
+whose data changes much less often than it is read keep one per published
+snapshot (PreparedSnapshot) instead of letting FastAPI validate and encode
+the payload on every request.
+
+JSON goes through pydantic-core's encoder (already installed with FastAPI;
+it takes pydantic models directly). Brotli is used when the `brotli`
+package is installed, gzip otherwise.
+"""
+import gzip
+import hashlib
+import threading
+
+from pydantic_core import to_json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # Optional: pip install brotli
+
+
+def dump_json(payload):
+    """Compact JSON bytes; NaN / inf become null (they aren't valid JSON)."""
+    return to_json(payload, inf_nan_mode='null')
+
+
+def parse_accept_encoding(header):
+    """Accept-Encoding -> {coding: q}, e.g. "gzip, br;q=0" -> {"gzip": 1.0, "br": 0.0}."""
+    weights = {}
+    for item in (header or "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0 # Malformed weight: don't pick it
+        weights[coding] = q
+    return weights
+
+
+class PreparedResponse:
+    """One pre-serialized answer: JSON bytes, an ETag and gzip / br bodies built on demand."""
+
+    __slots__ = ('body', 'etag', '_gzip', '_br')
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self._gzip = None
+        self._br = None
+
+    @property
+    def gzip_body(self):
+        # Two readers may race to build it; both get the same bytes
+        if self._gzip is None:
+            self._gzip = gzip.compress(self.body, compresslevel=6)
+        return self._gzip
+
+    @property
+    def br_body(self):
+        if self._br is None and brotli is not None:
+            self._br = brotli.compress(self.body, quality=5)
+        return self._br
+
+    def encoded(self, accept_encoding):
+        """(body, Content-Encoding or None) for an Accept-Encoding header."""
+        weights = parse_accept_encoding(accept_encoding)
+        wildcard = weights.get("*", 0.0)
+        br = weights.get("br", wildcard) if brotli is not None else 0.0
+        gzip_q = weights.get("gzip", wildcard)
+        # Highest q wins, br on a tie; q=0 means "not this one"
+        if br > 0 and br >= gzip_q:
+            return self.br_body, "br"
+        if gzip_q > 0:
+            return self.gzip_body, "gzip"
+        return self.body, None
+
+
+class PreparedSnapshot:
+    """
+    PreparedResponse of whatever `source()` currently returns, rebuilt with
+    `serialize(value)` only when that object changes. Sources are immutable
+    snapshots swapped by assignment, so a change is an identity change.
+    """
+
+    def __init__(self, source, serialize):
+        self.source = source
+        self.serialize = serialize
+        self.lock = threading.Lock()
+        self.current = (object(), None) # (source value, PreparedResponse)
+        self.builds = 0
+
+    def get(self):
+        value = self.source()
+        cached_value, prepared = self.current
+        if cached_value is value:
+            return prepared
+        with self.lock:
+            # Another request may have built it (or a newer one) while we waited
+            value = self.source()
+            cached_value, prepared = self.current
+            if cached_value is not value:
+                prepared = PreparedResponse(self.serialize(value))
+                self.current = (value, prepared)
+                self.builds += 1
+            return prepared
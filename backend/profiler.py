@@ -0,0 +1,62 @@
+"""
+On-demand sampling profiler.
+
+Samples the stack of every Python thread at a fixed interval (from a
+background thread, via sys._current_frames) and counts identical stacks.
+The result is in "collapsed" format - one `frame;frame;frame count` line per
+stack - which flamegraph.pl / speedscope read directly. Nothing is
+instrumented and nothing runs while no profile is being taken.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    def __init__(self, interval_seconds=0.005, max_depth=64):
+        self.interval_seconds = interval_seconds
+        self.max_depth = max_depth
+        self.lock = threading.Lock() # one profile at a time
+
+    def profile(self, seconds):
+        """Sample for `seconds` and return (collapsed stack Counter, sample count)."""
+        stacks = Counter()
+        samples = 0
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        deadline = time.monotonic() + seconds
+        with self.lock:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+                samples += 1
+                time.sleep(self.interval_seconds)
+        return stacks, samples
+
+    def _collapse(self, thread_name, frame):
+        parts = []
+        while frame is not None and len(parts) < self.max_depth:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        parts.append(thread_name)
+        return ";".join(reversed(parts))
+
+
+def render_collapsed(stacks, skip_idle=True):
+    lines = []
+    for stack, count in stacks.most_common():
+        # Threads parked in the executor / selector aren't interesting
+        if skip_idle and _is_idle(stack):
+            continue
+        lines.append(f"{stack} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def _is_idle(stack):
+    leaf = stack.rsplit(";", 1)[-1]
+    return leaf.startswith(("wait (threading.py", "_worker (thread.py", "select (selectors.py", "_sleep_cycle"))
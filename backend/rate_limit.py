@@ -0,0 +1,51 @@
+"""
+Token buckets for report ingest.
+
+Each key (a user id, a route id) gets a bucket of `burst` tokens that
+refills at `rate` tokens per second; a report spends one. Buckets live in
+an LRU of at most `max_keys`, so made-up ids can't grow it without bound -
+an evicted bucket was idle the longest and would be (nearly) full anyway.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate # tokens per second; <= 0 disables the limiter
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict() # key -> [tokens, last refill time]
+        self.allowed = 0
+        self.limited = 0
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, key, now=None):
+        """Spend a token for `key`. False if its bucket is empty."""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = [float(self.burst), now]
+                self.buckets[key] = bucket
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1.0:
+                self.limited += 1
+                return False
+            bucket[0] -= 1.0
+            self.allowed += 1
+            return True
+
+    def stats(self):
+        return {"keys": len(self.buckets), "allowed": self.allowed, "limited": self.limited}
@@ -0,0 +1,220 @@
+"""
+Replay recorded rider reports through the clustering pipeline.
+
+Reads reports from the history store (history.py; recorded by a server
+started with HISTORY_ENABLED=1) and feeds them, in
+order and with their recorded timestamps, through the same
+CLUSTER_ENGINE.upsert + cluster_reports() path main.py runs - as fast as
+possible by default, or at `--speed` times real time. At every recorded
+bus snapshot the replayed VIRTUAL_BUSES are compared with what was
+published at the time (or with another replay's output, `--baseline`).
+
+    python replay_history.py --day 2026-10-17
+    python replay_history.py --day 2026-10-17 --mode batch --out replay_a
+    TRACKING_ENABLED=0 python replay_history.py --day 2026-10-17 --baseline replay_a
+
+Environment settings (TRACKING_ENABLED, CLUSTER_TICK_SECONDS, ...) are read
+by main.py as usual, so two runs can compare settings as well as code.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Don't record the replay into the history it is reading, and cluster in
+# this process only
+os.environ["HISTORY_ENABLED"] = "0"
+os.environ["STATE_BACKEND"] = "memory"
+
+import main # noqa: E402 (after the environment is set)
+from history import HistoryWriter, read_history # noqa: E402
+from spatial import haversine_np # noqa: E402
+
+MATCH_RADIUS_M = 50 # A recorded bus with a replayed bus this close (same route) counts as matched
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value).timestamp()
+
+
+def time_range(args):
+    if args.day:
+        start = datetime.fromisoformat(args.day).timestamp() # Local midnight
+        return start, start + 86400
+    return (parse_time(args.start) if args.start else None), (parse_time(args.end) if args.end else None)
+
+
+def snapshot_groups(buses):
+    """Recorded bus rows -> [(snapshot time, {route_id: (lats, lngs)})]."""
+    t = buses["t"]
+    if not len(t):
+        return []
+    groups = []
+    bounds = np.flatnonzero(np.diff(t)) + 1
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(t)]):
+        by_route = {}
+        routes = buses["route_id"][start:end]
+        lats, lngs = buses["lat"][start:end], buses["lng"][start:end]
+        for route_id in set(routes):
+            mask = routes == route_id
+            by_route[route_id] = (lats[mask], lngs[mask])
+        groups.append((float(t[start]), by_route))
+    return groups
+
+
+class Comparison:
+    """Replayed vs recorded buses, accumulated over every snapshot."""
+
+    def __init__(self):
+        self.snapshots = 0
+        self.recorded = 0
+        self.replayed = 0
+        self.count_diffs = []
+        self.distances = []
+
+    def add(self, recorded_by_route, buses):
+        replayed = {}
+        for bus in buses:
+            replayed.setdefault(bus.route_id, []).append((bus.lat, bus.lng))
+        recorded_total = sum(len(lats) for lats, _ in recorded_by_route.values())
+        self.snapshots += 1
+        self.recorded += recorded_total
+        self.replayed += len(buses)
+        self.count_diffs.append(len(buses) - recorded_total)
+        for route_id, (lats, lngs) in recorded_by_route.items():
+            points = replayed.get(route_id)
+            if not points:
+                self.distances.extend([np.inf] * len(lats))
+                continue
+            points = np.asarray(points)
+            for lat, lng in zip(lats, lngs):
+                self.distances.append(float(haversine_np(lat, lng, points[:, 0], points[:, 1]).min()))
+
+    def summary(self):
+        distances = np.asarray(self.distances) if self.distances else np.zeros(0)
+        finite = distances[np.isfinite(distances)]
+        return {
+            "snapshots": self.snapshots,
+            "recorded_buses": self.recorded,
+            "replayed_buses": self.replayed,
+            "mean_abs_count_diff": round(float(np.mean(np.abs(self.count_diffs))), 2) if self.count_diffs else None,
+            "matched_within_m": MATCH_RADIUS_M,
+            "matched_fraction": round(float((distances <= MATCH_RADIUS_M).mean()), 4) if len(distances) else None,
+            "distance_p50_m": round(float(np.percentile(finite, 50)), 1) if len(finite) else None,
+            "distance_p95_m": round(float(np.percentile(finite, 95)), 1) if len(finite) else None,
+        }
+
+
+def replay(reports, snapshots, mode="sync", tick_seconds=0.5, speed=0.0, out=None):
+    t = reports["t"]
+    n = len(t)
+    comparison = Comparison()
+    publish_ms = []
+    next_snapshot = 0
+    batch = []
+    next_tick = float(t[0]) + tick_seconds if n else 0.0
+
+    def publish(now):
+        nonlocal next_snapshot
+        started = time.perf_counter()
+        with main.CLUSTER_LOCK:
+            main.cluster_reports(now)
+        publish_ms.append((time.perf_counter() - started) * 1000)
+        # Snapshots recorded up to now compare against what we have published
+        while next_snapshot < len(snapshots) and snapshots[next_snapshot][0] <= now:
+            comparison.add(snapshots[next_snapshot][1], main.VIRTUAL_BUSES)
+            next_snapshot += 1
+        if out is not None:
+            out.record_buses(main.VIRTUAL_BUSES, now)
+            if len(out.pending["buses"]) >= 100000:
+                out.flush()
+
+    wall_started = time.perf_counter()
+    for i in range(n):
+        now = float(t[i])
+        if speed > 0:
+            wait = wall_started + (now - float(t[0])) / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        if mode == "batch" and now >= next_tick:
+            if batch:
+                main.apply_report_batch(batch)
+                batch = []
+            publish(next_tick)
+            # Skip the empty ticks in a gap; one publish already expired what it had to
+            next_tick += (int((now - next_tick) // tick_seconds) + 1) * tick_seconds
+        report = main.UserReport(user_id=reports["user_id"][i], route_id=reports["route_id"][i],
+                                 lat=float(reports["lat"][i]), lng=float(reports["lng"][i]),
+                                 timestamp=now, speed=float(reports["speed"][i]))
+        if mode == "batch":
+            batch.append(report)
+            continue
+        with main.CLUSTER_LOCK:
+            main.CLUSTER_ENGINE.upsert(report)
+        publish(now)
+    if batch:
+        main.apply_report_batch(batch)
+        publish(next_tick)
+    if out is not None:
+        out.flush()
+    wall = time.perf_counter() - wall_started
+    return wall, publish_ms, comparison
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Replay recorded reports through the clustering pipeline.')
+    parser.add_argument('--dir', default=main.HISTORY_DIR, help='History directory to read reports from')
+    parser.add_argument('--day', help='Local date to replay (YYYY-MM-DD)')
+    parser.add_argument('--start', help='Replay from (ISO time, local)')
+    parser.add_argument('--end', help='Replay until (ISO time, local)')
+    parser.add_argument('--mode', choices=['sync', 'batch'], default=main.INGEST_MODE if main.INGEST_MODE in ('sync', 'batch') else 'sync',
+                        help='sync: publish after every report; batch: every --tick seconds')
+    parser.add_argument('--tick', type=float, default=main.CLUSTER_TICK_SECONDS, help='Batch tick (recorded seconds)')
+    parser.add_argument('--speed', type=float, default=0.0, help='Times real time; 0 = as fast as possible')
+    parser.add_argument('--baseline', help='Compare against bus snapshots in this directory instead of --dir')
+    parser.add_argument('--out', help='Write the replayed bus snapshots here (a history directory)')
+    parser.add_argument('--json', help='Also write the summary to this file')
+    args = parser.parse_args()
+
+    start, end = time_range(args)
+    t0 = time.perf_counter()
+    reports = read_history(args.dir, "reports", start, end)
+    buses = read_history(args.baseline or args.dir, "buses", start, end)
+    snapshots = snapshot_groups(buses)
+    print(f"Read {len(reports['t'])} reports and {len(snapshots)} bus snapshots in {time.perf_counter() - t0:.2f}s")
+    if not len(reports["t"]):
+        print("Nothing to replay.")
+        return
+
+    out = None
+    if args.out:
+        out = HistoryWriter(args.out, snapshot_seconds=main.HISTORY_SNAPSHOT_SECONDS, retention_days=0)
+    wall, publish_ms, comparison = replay(reports, snapshots, args.mode, args.tick, args.speed, out)
+
+    span = float(reports["t"][-1] - reports["t"][0])
+    summary = {
+        "mode": args.mode,
+        "tracking": main.TRACKER is not None,
+        "reports": len(reports["t"]),
+        "recorded_seconds": round(span, 1),
+        "replay_seconds": round(wall, 2),
+        "speedup": round(span / wall, 1) if wall > 0 else None,
+        "reports_per_second": round(len(reports["t"]) / wall, 1) if wall > 0 else None,
+        "publishes": len(publish_ms),
+        "publish_ms_p50": round(float(np.percentile(publish_ms, 50)), 3),
+        "publish_ms_p99": round(float(np.percentile(publish_ms, 99)), 3),
+        "final_buses": len(main.VIRTUAL_BUSES),
+        "evicted_reports": main.CLUSTER_ENGINE.evicted,
+        "comparison": comparison.summary(),
+    }
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,345 @@
+"""
+Per-route headways, bunching and delay percentiles, kept up to date as
+buses change.
+
+RouteAnalytics is fed by the pipeline, never by requests:
+
+  * update_virtual(changed, removed) after every clustering publish - only
+    the routes those buses are on get recomputed
+  * update_live(buses) after every OTD poll
+
+Each bus is placed on its route's shape (RouteLine.project) and the route's
+buses are split by direction, then ordered by distance along the shape;
+the gaps between neighbours going the same way give headways (gap /
+follower speed) and bunching (gap under `bunching_gap_m`).
+Delays go into a DelaySketch per route: a fixed-size rolling histogram, so
+memory doesn't grow with traffic. The finished summary of each route is a
+RouteState replaced whole, so route() is a dict lookup (plus building its
+JSON once after each change, on the first read).
+
+Direction is the trip's GTFS direction_id for live buses that have one
+("0" / "1"). Otherwise (virtual buses, feeds without direction_id) it is
+the bus's own heading along the shape, "forward" or "backward", once it has
+moved `direction_min_m` one way; a bus that hasn't yet is "unknown" and
+isn't paired with anyone. Routes without a shape still get bus counts and
+delays, just no ordering.
+"""
+import threading
+import time
+
+import numpy as np
+
+from metrics import Histogram
+
+ANALYTICS_UPDATE_SECONDS = Histogram("dsatm_route_analytics_update_seconds",
+                                     "Time to refresh route analytics after a publish / feed poll")
+
+SOURCES = ("virtual", "live")
+UNKNOWN_DIRECTION = "unknown"
+HEADINGS = {1: "forward", -1: "backward", 0: UNKNOWN_DIRECTION} # Along the shape
+
+
+class DelaySketch:
+    """
+    Rolling delay histogram: `windows` slots of `window_seconds` each, delays
+    binned to `bin_minutes` between min/max (outliers land in the end bins).
+    Memory is fixed at windows x bins counters per route.
+    """
+
+    def __init__(self, window_seconds=600, windows=6, min_minutes=-30, max_minutes=90, bin_minutes=1.0):
+        self.window_seconds = window_seconds
+        self.min_minutes = min_minutes
+        self.bin_minutes = bin_minutes
+        self.bins = int(round((max_minutes - min_minutes) / bin_minutes)) + 1
+        self.counts = np.zeros((windows, self.bins), dtype=np.int32)
+        self.sums = np.zeros(windows, dtype=np.float64)
+        self.epochs = np.full(windows, -1, dtype=np.int64) # Which window each slot holds
+
+    def _slot(self, now):
+        epoch = int(now // self.window_seconds)
+        slot = epoch % len(self.epochs)
+        if self.epochs[slot] != epoch:
+            self.counts[slot] = 0
+            self.sums[slot] = 0.0
+            self.epochs[slot] = epoch
+        return slot
+
+    def add(self, delay_minutes, now):
+        slot = self._slot(now)
+        b = int(round((delay_minutes - self.min_minutes) / self.bin_minutes))
+        self.counts[slot, min(max(b, 0), self.bins - 1)] += 1
+        self.sums[slot] += delay_minutes
+
+    def summary(self, now, quantiles=(0.5, 0.9, 0.95)):
+        epoch = int(now // self.window_seconds)
+        live = self.epochs > epoch - len(self.epochs)
+        counts = self.counts[live].sum(axis=0)
+        n = int(counts.sum())
+        if not n:
+            return {"samples": 0}
+        cumulative = np.cumsum(counts)
+        result = {"samples": n, "mean_minutes": round(float(self.sums[live].sum()) / n, 1)}
+        for q in quantiles:
+            b = int(np.searchsorted(cumulative, q * n))
+            result[f"p{int(q * 100)}_minutes"] = self.min_minutes + b * self.bin_minutes
+        return result
+
+
+def direction_key(state):
+    """Which way a bus runs: its trip's direction_id, else its heading along the shape."""
+    if state[6] is not None:
+        return state[6]
+    return HEADINGS[state[4]]
+
+
+class DirectionState:
+    """
+    The buses of one route running one way, as arrays in travel order
+    (behind first). Buses whose direction isn't known yet are listed but
+    never paired: they may well be heading the other way.
+    """
+
+    __slots__ = ("direction", "ids", "along", "delays", "gaps", "headways", "bunched", "bunched_count", "_view")
+
+    def __init__(self, direction, members, bunching_gap_m, default_speed_mps):
+        self.direction = direction
+        on_shape = [(bus_id, state) for bus_id, state in members if state[0] is not None]
+        along = np.fromiter((state[0] for _, state in on_shape), dtype=np.float64, count=len(on_shape))
+        # Travel order: increasing distance, unless most of them move down the shape
+        reverse = sum(state[4] for _, state in on_shape) < 0
+        order = np.argsort(-along if reverse else along, kind="stable")
+        self.ids = [on_shape[i][0] for i in order]
+        self.along = along[order]
+        self.delays = [on_shape[i][1][2] for i in order]
+        if direction == UNKNOWN_DIRECTION:
+            order = order[:0]
+        speeds = np.fromiter((on_shape[i][1][1] for i in order), dtype=np.float64, count=len(order))
+        # Gap i is between bus i (behind) and bus i + 1 (ahead); the follower sets the headway
+        self.gaps = np.abs(np.diff(self.along[:len(order)]))
+        follower_speed = speeds[:-1]
+        self.headways = self.gaps / np.where(follower_speed > 1.0, follower_speed, default_speed_mps)
+        self.bunched = self.gaps < bunching_gap_m
+        self.bunched_count = int(self.bunched.sum())
+        self._view = None
+
+    def view(self):
+        view = self._view
+        if view is None:
+            gaps = [{"lead": self.ids[i + 1], "follow": self.ids[i], "gap_m": round(float(gap), 1),
+                     "headway_seconds": round(float(headway), 1), "bunched": bool(bunched)}
+                    for i, (gap, headway, bunched) in enumerate(zip(self.gaps, self.headways, self.bunched))]
+            view = {
+                "order": [{"id": bus_id, "distance_m": round(float(along), 1),
+                           "delay_minutes": None if delay is None else round(delay, 1)}
+                          for bus_id, along, delay in zip(self.ids, self.along, self.delays)],
+                "gaps": gaps,
+                "headway": {
+                    "mean_seconds": round(float(self.headways.mean()), 1),
+                    "min_seconds": round(float(self.headways.min()), 1),
+                    "max_seconds": round(float(self.headways.max()), 1),
+                } if len(self.headways) else None,
+                "bunched_pairs": self.bunched_count,
+            }
+            self._view = view
+        return view
+
+
+class RouteState:
+    """
+    One route's buses, split by direction (DirectionState each). The JSON
+    view is built on the first read and kept until the next change replaces
+    the whole object, so updates stay cheap when nobody is looking.
+    """
+
+    __slots__ = ("route_id", "bus_count", "on_shape", "directions", "bunched_count", "sketch", "updated_at", "_view")
+
+    def __init__(self, route_id, route_buses, sketch, now, bunching_gap_m, default_speed_mps):
+        self.route_id = route_id
+        self.bus_count = len(route_buses)
+        groups = {}
+        for bus_id, state in route_buses.items():
+            groups.setdefault(direction_key(state), []).append((bus_id, state))
+        self.directions = {direction: DirectionState(direction, members, bunching_gap_m, default_speed_mps)
+                           for direction, members in sorted(groups.items())}
+        self.on_shape = sum(len(d.ids) for d in self.directions.values())
+        self.bunched_count = sum(d.bunched_count for d in self.directions.values())
+        self.sketch = sketch
+        self.updated_at = now
+        self._view = None
+
+    def view(self, lock):
+        view = self._view
+        if view is None:
+            with lock: # The sketch may be taking a sample
+                delay = self.sketch.summary(self.updated_at) if self.sketch is not None else {"samples": 0}
+            view = {
+                "buses": self.bus_count,
+                "on_shape": self.on_shape,
+                "directions": {direction: d.view() for direction, d in self.directions.items()},
+                "bunched_pairs": self.bunched_count,
+                "delay": delay,
+                "updated_at": self.updated_at,
+            }
+            self._view = view
+        return view
+
+    def bunched_gaps(self):
+        for direction, d in self.directions.items():
+            if d.bunched_count:
+                for gap in d.view()["gaps"]:
+                    if gap["bunched"]:
+                        yield {"direction": direction, **gap}
+
+
+class RouteAnalytics:
+    def __init__(self, line_for, bunching_gap_m=300.0, default_speed_mps=4.0, sample_seconds=30.0,
+                 window_seconds=600, windows=6, direction_min_m=30.0):
+        self.line_for = line_for # route_id -> RouteLine or None
+        self.bunching_gap_m = bunching_gap_m
+        self.direction_min_m = direction_min_m # Movement along the shape that sets / flips a heading
+        self.default_speed_mps = default_speed_mps # For headways when the follower is (nearly) stopped
+        self.sample_seconds = sample_seconds # A bus adds to its route's delays at most this often
+        self.window_seconds = window_seconds
+        self.windows = windows
+
+        self.lock = threading.Lock()
+        # source -> route_id -> {bus_id: [along_m or None, speed_mps, delay_min, last sampled,
+        #                                 heading (+1 / -1 / 0), along at the last heading check, direction_id]}
+        self.buses = {source: {} for source in SOURCES}
+        self.bus_route = {source: {} for source in SOURCES} # bus_id -> route_id
+        self.sketches = {source: {} for source in SOURCES} # route_id -> DelaySketch
+        self.routes = {source: {} for source in SOURCES} # route_id -> RouteState, replaced on every change
+        self.bunched_routes = {source: set() for source in SOURCES}
+        self.bunched_pairs = {source: 0 for source in SOURCES}
+        self.updates = 0
+
+    def update_virtual(self, changed, removed, now=None):
+        """After a clustering publish: `changed` VirtualBus objects, `removed` bus ids."""
+        now = time.time() if now is None else now
+        with self.lock, ANALYTICS_UPDATE_SECONDS.time():
+            touched = set()
+            for bus_id in removed:
+                route_id = self.bus_route["virtual"].pop(bus_id, None)
+                if route_id is not None:
+                    self.buses["virtual"].get(route_id, {}).pop(bus_id, None)
+                    touched.add(route_id)
+            for bus in changed:
+                touched.add(self._place("virtual", bus.id, str(bus.route_id), bus.lat, bus.lng,
+                                        bus.speed_kmh / 3.6, bus.delay_minutes if bus.delay_count else None, now))
+            for route_id in touched:
+                self._summarize("virtual", route_id, now)
+            self.updates += 1
+
+    def replace_virtual(self, buses, now=None):
+        """Whole snapshot (shared-state followers only see those)."""
+        seen = {bus.id for bus in buses}
+        removed = [bus_id for bus_id in self.bus_route["virtual"] if bus_id not in seen]
+        self.update_virtual(buses, removed, now)
+
+    def update_live(self, buses, route_of, delay_of, direction_of=None, now=None):
+        """
+        After an OTD poll with the full bus list. `route_of(trip_id)` gives
+        the route_id, `delay_of(trip_id)` the delay in seconds and
+        `direction_of(trip_id)` the GTFS direction_id (either may be None).
+        """
+        now = time.time() if now is None else now
+        with self.lock, ANALYTICS_UPDATE_SECONDS.time():
+            old_routes = set(self.buses["live"])
+            routes = {}
+            for bus in buses:
+                trip_id = str(bus.get('trip_id') or '')
+                if not trip_id:
+                    continue
+                route_id = route_of(trip_id)
+                routes.setdefault(route_id, []).append(bus)
+            placed = {}
+            for route_id, route_buses in routes.items():
+                previous = self.buses["live"].get(route_id, {})
+                current = {}
+                for bus in route_buses:
+                    trip_id = str(bus['trip_id'])
+                    delay = delay_of(trip_id)
+                    state = previous.get(bus['id'])
+                    current[bus['id']] = self._state(route_id, state, bus['lat'], bus['lng'], bus['speed'] / 3.6,
+                                                     None if delay is None else delay / 60.0, now, "live",
+                                                     direction_of(trip_id) if direction_of is not None else None)
+                    placed[bus['id']] = route_id
+                self.buses["live"][route_id] = current
+            for route_id in old_routes - set(routes):
+                del self.buses["live"][route_id]
+            self.bus_route["live"] = placed
+            for route_id in old_routes | set(routes):
+                self._summarize("live", route_id, now)
+            self.updates += 1
+
+    def _place(self, source, bus_id, route_id, lat, lng, speed_mps, delay_minutes, now):
+        route_buses = self.buses[source].setdefault(route_id, {})
+        route_buses[bus_id] = self._state(route_id, route_buses.get(bus_id), lat, lng, speed_mps, delay_minutes,
+                                          now, source)
+        self.bus_route[source][bus_id] = route_id
+        return route_id
+
+    def _state(self, route_id, previous, lat, lng, speed_mps, delay_minutes, now, source, direction_id=None):
+        line = self.line_for(route_id)
+        along = None
+        heading, anchor = (previous[4], previous[5]) if previous is not None else (0, None)
+        if line is not None:
+            hint = previous[0] if previous is not None else None
+            along, _ = line.project(lat, lng, hint=hint)
+            # Heading sticks until the bus has clearly moved the other way (e.g. at a terminus)
+            if anchor is None:
+                anchor = along
+            elif abs(along - anchor) >= self.direction_min_m:
+                heading = 1 if along > anchor else -1
+                anchor = along
+        sampled = previous[3] if previous is not None else None
+        if delay_minutes is not None and (sampled is None or now - sampled >= self.sample_seconds):
+            sketch = self.sketches[source].get(route_id)
+            if sketch is None:
+                sketch = self.sketches[source][route_id] = DelaySketch(self.window_seconds, self.windows)
+            sketch.add(delay_minutes, now)
+            sampled = now
+        return [along, speed_mps, delay_minutes, sampled, heading, anchor, direction_id]
+
+    def _summarize(self, source, route_id, now):
+        route_buses = self.buses[source].get(route_id) or {}
+        sketch = self.sketches[source].get(route_id)
+        old = self.routes[source].pop(route_id, None)
+        if old is not None:
+            self.bunched_pairs[source] -= old.bunched_count
+            if old.bunched_count:
+                self.bunched_routes[source].discard(route_id)
+        if not route_buses and sketch is None:
+            return
+        state = RouteState(route_id, route_buses, sketch, now, self.bunching_gap_m, self.default_speed_mps)
+        self.routes[source][route_id] = state
+        self.bunched_pairs[source] += state.bunched_count
+        if state.bunched_count:
+            self.bunched_routes[source].add(route_id)
+
+    def route(self, route_id):
+        """{source: summary} for one route, or None if no bus has been seen on it."""
+        result = {}
+        for source in SOURCES:
+            state = self.routes[source].get(route_id)
+            result[source] = state.view(self.lock) if state is not None else None
+        return result if any(result.values()) else None
+
+    def bunching(self):
+        """Every currently bunched pair, all routes."""
+        alerts = []
+        for source in SOURCES:
+            routes = self.routes[source]
+            for route_id in list(self.bunched_routes[source]):
+                state = routes.get(route_id)
+                if state is not None:
+                    alerts.extend({"route_id": route_id, "source": source, **gap} for gap in state.bunched_gaps())
+        return alerts
+
+    def stats(self):
+        return {
+            "routes": {source: len(self.routes[source]) for source in SOURCES},
+            "buses": {source: len(self.bus_route[source]) for source in SOURCES},
+            "bunched_pairs": dict(self.bunched_pairs),
+            "updates": self.updates,
+        }
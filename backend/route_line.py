@@ -0,0 +1,133 @@
+"""
+Route shapes as 1-D lines: positions along a route in metres from its start.
+"""
+import math
+
+import numpy as np
+
+from spatial import METERS_PER_DEG_LAT
+
+
+class RouteLine:
+    """
+    A route shape (list of (lat, lng)) with cumulative distances, so a point
+    can be projected to its distance along the route and back.
+
+    Coordinates are handled on a local equirectangular projection centred on
+    the route, which is accurate to well under a metre at city scale.
+    Segments are bucketed into `cell_m` grid cells, so projecting a point
+    near the route only looks at the few segments around it.
+    """
+
+    def __init__(self, points, cell_m=100.0):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.lats = points[:, 0]
+        self.lngs = points[:, 1]
+        self.lat0 = float(self.lats.mean()) if len(points) else 0.0
+        self.kx = METERS_PER_DEG_LAT * math.cos(math.radians(self.lat0))
+        self.ky = METERS_PER_DEG_LAT
+        self.x = self.lngs * self.kx
+        self.y = self.lats * self.ky
+        steps = np.hypot(np.diff(self.x), np.diff(self.y))
+        self.cum = np.concatenate(([0.0], np.cumsum(steps))) # metres at each vertex
+        self.cell_m = cell_m
+        self.cells = self._index_segments()
+
+    def __len__(self):
+        return len(self.cum)
+
+    @property
+    def length(self):
+        return float(self.cum[-1]) if len(self.cum) else 0.0
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_m)), int(math.floor(y / self.cell_m))
+
+    def _index_segments(self):
+        # (col, row) -> array of segment indices whose bounding box touches the cell
+        cells = {}
+        if len(self.cum) < 2:
+            return cells
+        col0 = np.floor(np.minimum(self.x[:-1], self.x[1:]) / self.cell_m).astype(np.int64)
+        col1 = np.floor(np.maximum(self.x[:-1], self.x[1:]) / self.cell_m).astype(np.int64)
+        row0 = np.floor(np.minimum(self.y[:-1], self.y[1:]) / self.cell_m).astype(np.int64)
+        row1 = np.floor(np.maximum(self.y[:-1], self.y[1:]) / self.cell_m).astype(np.int64)
+        for i in range(len(col0)):
+            for col in range(col0[i], col1[i] + 1):
+                for row in range(row0[i], row1[i] + 1):
+                    cells.setdefault((col, row), []).append(i)
+        return {cell: np.array(segments, dtype=np.int64) for cell, segments in cells.items()}
+
+    def _candidates(self, px, py, rings):
+        col, row = self._cell(px, py)
+        found = [self.cells[(c, r)]
+                 for c in range(col - rings, col + rings + 1)
+                 for r in range(row - rings, row + rings + 1)
+                 if (c, r) in self.cells]
+        if not found:
+            return None
+        return np.unique(np.concatenate(found))
+
+    def _distances(self, px, py, segments):
+        ax, ay = self.x[segments], self.y[segments]
+        dx, dy = self.x[segments + 1] - ax, self.y[segments + 1] - ay
+        seg_len2 = dx * dx + dy * dy
+        t = np.where(seg_len2 > 0, ((px - ax) * dx + (py - ay) * dy) / np.where(seg_len2 > 0, seg_len2, 1), 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        off = np.hypot(ax + t * dx - px, ay + t * dy - py)
+        along = self.cum[segments] + t * np.sqrt(seg_len2)
+        return along, off
+
+    def project(self, lat, lng, hint=None, ambiguity_m=25.0, max_off=None):
+        """
+        (distance along the route, metres off the route) of the closest
+        point on the shape. Where the shape passes within `ambiguity_m` of
+        the point more than once (both directions on one road, loops), the
+        candidate nearest to `hint` (a previous along-route distance) wins.
+
+        With `max_off`, points further than that from the route return
+        (0.0, inf) without looking at the whole shape.
+        """
+        if len(self.cum) < 2:
+            return 0.0, float('inf')
+        px, py = lng * self.kx, lat * self.ky
+
+        # Grow the search ring until the best hit (plus the ambiguity margin)
+        # is closer than anything outside the ring could be
+        along = off = None
+        max_rings = None if max_off is None else int(math.ceil(max_off / self.cell_m))
+        rings = 1
+        while True:
+            segments = self._candidates(px, py, rings)
+            if segments is not None:
+                along, off = self._distances(px, py, segments)
+                if off.min() + ambiguity_m <= rings * self.cell_m:
+                    break
+            if max_rings is not None and rings >= max_rings:
+                if off is None or off.min() > max_off:
+                    return 0.0, float('inf')
+                break
+            if rings >= 8:
+                # Far from the route: just check every segment
+                along, off = self._distances(px, py, np.arange(len(self.cum) - 1))
+                break
+            rings *= 2
+
+        best = int(np.argmin(off))
+        if hint is not None:
+            candidates = np.flatnonzero(off <= off[best] + ambiguity_m)
+            if len(candidates) > 1:
+                best = int(candidates[np.argmin(np.abs(along[candidates] - hint))])
+        return float(along[best]), float(off[best])
+
+    def point_at(self, distance):
+        """(lat, lng) at `distance` metres along the route (clamped to its ends)."""
+        if len(self.cum) < 2:
+            return float(self.lats[0]), float(self.lngs[0])
+        distance = min(max(distance, 0.0), self.length)
+        i = int(np.searchsorted(self.cum, distance, side='right')) - 1
+        i = min(max(i, 0), len(self.cum) - 2)
+        span = self.cum[i + 1] - self.cum[i]
+        t = (distance - self.cum[i]) / span if span > 0 else 0.0
+        return (float(self.lats[i] + (self.lats[i + 1] - self.lats[i]) * t),
+                float(self.lngs[i] + (self.lngs[i + 1] - self.lngs[i]) * t))
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+
+from spatial import haversine_np
+
+DAY_SECONDS = 86400
+# Wider than any arrival_seconds value (GTFS times can run past 24:00)
+_STOP_KEY_STRIDE = 4 * DAY_SECONDS
+
+
+class RouteSchedule:
+    """
+    Every scheduled stop time of one route, arranged for batch matching.
+
+    `lats` / `lons` / `stop_ids` hold the route's distinct stops. The stop
+    times are grouped by stop and sorted by arrival inside each group, with
+    `keys = stop_index * stride + arrival_seconds` so one searchsorted over
+    `keys` finds the closest departure at any stop for a whole batch.
+    """
+
+    def __init__(self, route_id, stop_ids, lats, lons, arrivals, trip_rows, keys):
+        self.route_id = route_id
+        self.stop_ids = stop_ids
+        self.lats = lats
+        self.lons = lons
+        self.arrivals = arrivals # seconds, grouped by stop
+        self.trip_rows = trip_rows # index into TRIP_STOPS.trip_ids, same order
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def match(self, lats, lngs, seconds_of_day, radius_m):
+        """
+        Match a batch of positions/times to this route's schedule.
+
+        Returns (stop_index, distance_m, trip_row, delay_seconds) arrays;
+        stop_index is -1 where no stop is within radius_m.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        seconds = np.asarray(seconds_of_day, dtype=np.int64)
+        count = len(lats)
+
+        stop_index = np.full(count, -1, dtype=np.int64)
+        distance = np.full(count, np.inf)
+        trip_row = np.full(count, -1, dtype=np.int64)
+        delay = np.zeros(count, dtype=np.int64)
+        if count == 0 or len(self.stop_ids) == 0:
+            return stop_index, distance, trip_row, delay
+
+        # Strategy A: nearest stop per report (reports x stops distances)
+        dists = haversine_np(lats[:, None], lngs[:, None], self.lats[None, :], self.lons[None, :])
+        nearest = np.argmin(dists, axis=1)
+        nearest_dist = dists[np.arange(count), nearest]
+        at_stop = nearest_dist <= radius_m
+        stop_index[at_stop] = nearest[at_stop]
+        distance[at_stop] = nearest_dist[at_stop]
+        if not at_stop.any():
+            return stop_index, distance, trip_row, delay
+
+        # Strategy B: closest scheduled arrival at that stop, across every
+        # trip of the route. Also try yesterday/tomorrow so trips that run
+        # past midnight match.
+        stops = nearest[at_stop]
+        lo = np.searchsorted(self.keys, stops * _STOP_KEY_STRIDE)
+        hi = np.searchsorted(self.keys, (stops + 1) * _STOP_KEY_STRIDE) - 1
+        now = seconds[at_stop]
+
+        best_row = np.full(len(stops), -1, dtype=np.int64)
+        best_delay = np.zeros(len(stops), dtype=np.int64)
+        best_abs = np.full(len(stops), np.iinfo(np.int64).max)
+        for shift in (0, DAY_SECONDS, -DAY_SECONDS):
+            t = now + shift
+            pos = np.searchsorted(self.keys, stops * _STOP_KEY_STRIDE + t)
+            for candidate in (pos - 1, pos):
+                row = np.clip(candidate, lo, hi)
+                d = t - self.arrivals[row]
+                better = np.abs(d) < best_abs
+                best_abs = np.where(better, np.abs(d), best_abs)
+                best_delay = np.where(better, d, best_delay)
+                best_row = np.where(better, row, best_row)
+
+        trip_row[at_stop] = self.trip_rows[best_row]
+        delay[at_stop] = best_delay
+        return stop_index, distance, trip_row, delay
+
+
+def build_route_schedules(merged):
+    """
+    {route_id: RouteSchedule} from the merged-stops snapshot columns
+    (see gtfs_snapshot.load_merged_stops).
+    """
+    schedules = {}
+    offsets = np.asarray(merged['_trip_offsets'])
+    if len(offsets) < 2:
+        return schedules
+
+    route_codes, route_values = column_codes(merged, 'route_id')
+    stop_codes, stop_values = column_codes(merged, 'stop_id')
+    arrivals = np.asarray(merged['arrival_seconds'], dtype=np.int64)
+    lats = np.asarray(merged['stop_lat'], dtype=np.float64)
+    lons = np.asarray(merged['stop_lon'], dtype=np.float64)
+    trip_of_row = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    # Group rows by route, then stop, then arrival time
+    order = np.lexsort((arrivals, stop_codes, route_codes))
+    route_sorted = route_codes[order]
+    route_bounds = np.flatnonzero(np.r_[True, route_sorted[1:] != route_sorted[:-1], True])
+
+    for start, end in zip(route_bounds[:-1], route_bounds[1:]):
+        rows = order[start:end]
+        stops = stop_codes[rows]
+        first = np.flatnonzero(np.r_[True, stops[1:] != stops[:-1]])
+        local_stop = np.cumsum(np.r_[False, stops[1:] != stops[:-1]])
+        route_arrivals = arrivals[rows]
+
+        route_id = str(route_values[route_codes[rows[0]]])
+        schedules[route_id] = RouteSchedule(
+            route_id=route_id,
+            stop_ids=stop_values[stops[first]],
+            lats=lats[rows[first]],
+            lons=lons[rows[first]],
+            arrivals=route_arrivals,
+            trip_rows=trip_of_row[rows],
+            keys=local_stop * _STOP_KEY_STRIDE + route_arrivals,
+        )
+    return schedules
+
+
+class StopTimetable:
+    """
+    Every scheduled arrival, grouped by stop and sorted by time.
+
+    Stop i's arrivals are `arrivals[offsets[i]:offsets[i + 1]]`, so the next
+    arrivals after a time are one binary search (searchsorted) inside that
+    slice. `rows` points each arrival back at its row in the merged stops
+    snapshot (and so at its trip via trip_rows).
+    """
+
+    def __init__(self, stop_ids, stop_names, offsets, arrivals, rows, trip_rows, route_codes, route_values):
+        self.stop_ids = stop_ids
+        self.stop_names = stop_names
+        self.offsets = offsets
+        self.arrivals = arrivals
+        self.rows = rows
+        self.trip_rows = trip_rows
+        self.route_codes = route_codes
+        self.route_values = route_values
+        self.stop_index = {str(stop_id): i for i, stop_id in enumerate(stop_ids)}
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def __contains__(self, stop_id):
+        return str(stop_id) in self.stop_index
+
+    def stop_name(self, stop_id):
+        return self.stop_names[self.stop_index[str(stop_id)]]
+
+    def between(self, stop_id, start_seconds, end_seconds):
+        """Indexes (into arrivals/rows/...) of the stop's arrivals in [start, end)."""
+        i = self.stop_index[str(stop_id)]
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        times = self.arrivals[lo:hi]
+        first = lo + np.searchsorted(times, start_seconds, side='left')
+        last = lo + np.searchsorted(times, end_seconds, side='left')
+        return np.arange(first, last)
+
+    def route_id(self, index):
+        return str(self.route_values[self.route_codes[index]])
+
+
+def build_stop_timetable(merged):
+    """StopTimetable from the merged-stops snapshot columns."""
+    offsets = np.asarray(merged['_trip_offsets'])
+    stop_codes, stop_values = column_codes(merged, 'stop_id')
+    route_codes, route_values = column_codes(merged, 'route_id')
+    arrivals = np.asarray(merged['arrival_seconds'], dtype=np.int64)
+    if len(offsets) < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return StopTimetable([], [], np.zeros(1, dtype=np.int64), empty, empty, empty, empty, route_values)
+    trip_of_row = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    order = np.lexsort((arrivals, stop_codes))
+    stops = stop_codes[order]
+    first = np.flatnonzero(np.r_[True, stops[1:] != stops[:-1]])
+
+    if 'stop_name' in merged:
+        name_codes, name_values = column_codes(merged, 'stop_name')
+        stop_names = [str(name_values[code]) if code >= 0 else "" for code in name_codes[order[first]]]
+    else:
+        stop_names = [""] * len(first)
+
+    return StopTimetable(
+        stop_ids=stop_values[stops[first]],
+        stop_names=stop_names,
+        offsets=np.append(first, len(order)).astype(np.int64),
+        arrivals=arrivals[order],
+        rows=order,
+        trip_rows=trip_of_row[order],
+        route_codes=route_codes[order],
+        route_values=route_values,
+    )
+
+
+def column_codes(merged, name):
+    """Integer codes plus the value for each code, for plain or dictionary-encoded columns."""
+    values = merged.get(f"{name}__values")
+    if values is not None:
+        return np.asarray(merged[name]), np.asarray(values).astype(object)
+    codes, uniques = pd.factorize(np.asarray(merged[name]))
+    return codes, np.asarray(uniques).astype(object)
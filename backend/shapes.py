@@ -0,0 +1,240 @@
+"""
+Route shapes (route_shapes.json) for /api/shapes.
+
+The file is parsed once and re-read only when its mtime/size change (checked
+at most every few seconds - line() is on the report hot path). Besides
+the original full payload, routes can be requested by id or by map bounding
+box, simplified with Douglas-Peucker at a tolerance that matches the map
+zoom and sent as encoded polylines. Every response body is built once per
+query, compressed once, and tagged with an ETag (prepared.py).
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from prepared import PreparedResponse
+from route_line import RouteLine
+from spatial import METERS_PER_DEG_LAT
+
+# Web Mercator ground resolution at zoom 0, metres per pixel at the equator
+MERCATOR_M_PER_PX = 156543.03392
+MAX_ZOOM = 20
+
+
+def zoom_tolerance_m(zoom, lat, pixels=1.0):
+    """Simplification tolerance in metres: `pixels` screen pixels at this zoom."""
+    zoom = min(max(zoom, 0), MAX_ZOOM)
+    return pixels * MERCATOR_M_PER_PX * math.cos(math.radians(lat)) / (2 ** zoom)
+
+
+def simplify(points, tolerance_m):
+    """
+    Douglas-Peucker on an (n, 2) array of (lat, lng). Returns the kept rows.
+
+    Distances are measured on a local equirectangular projection, which is
+    plenty for a city-sized shape.
+    """
+    n = len(points)
+    if n <= 2 or tolerance_m <= 0:
+        return points
+    lat0 = math.radians(float(points[:, 0].mean()))
+    y = points[:, 0] * METERS_PER_DEG_LAT
+    x = points[:, 1] * METERS_PER_DEG_LAT * math.cos(lat0)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            dist = np.hypot(px, py)
+        else:
+            dist = np.abs(px * dy - py * dx) / length
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance_m:
+            mid = start + 1 + i
+            keep[mid] = True
+            stack.append((start, mid))
+            stack.append((mid, end))
+    return points[keep]
+
+
+def encode_polyline(points, precision=5):
+    """Google encoded polyline of (lat, lng) rows."""
+    factor = 10 ** precision
+    coords = np.round(np.asarray(points, dtype=np.float64) * factor).astype(np.int64)
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    out = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return "".join(out)
+
+
+class _ShapeSet:
+    """One loaded version of the file, with its own response caches."""
+
+    def __init__(self, stamp, routes, raw_json):
+        self.stamp = stamp # (mtime_ns, size), None if the file is missing
+        self.routes = routes # route_id -> (n, 2) float array of (lat, lng)
+        self.route_ids = [route_id for route_id, pts in routes.items() if len(pts)]
+        # min_lat, min_lng, max_lat, max_lng per entry of route_ids
+        self.bounds = np.array([
+            (*routes[r].min(axis=0), *routes[r].max(axis=0)) for r in self.route_ids
+        ]).reshape(-1, 4)
+        self.raw_json = raw_json
+        self.responses = OrderedDict() # query key -> PreparedResponse (LRU)
+        self.encoded = {} # (route_id, zoom) -> encoded polyline
+        self.lines = {} # route_id -> RouteLine, built on first use
+
+
+class ShapeStore:
+    def __init__(self, path, tolerance_px=1.0, cache_size=256, check_seconds=5.0):
+        self.path = path
+        self.check_seconds = check_seconds # os.stat the file at most this often
+        self.checked_at = None
+        self.tolerance_px = tolerance_px
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.shapes = _ShapeSet(None, {}, b"{}")
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        """Reload if route_shapes.json changed on disk (or disappeared). Returns the current set."""
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.check_seconds:
+            return self.shapes
+        self.checked_at = now
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self.shapes.stamp:
+            return self.shapes
+        with self.lock:
+            if stamp == self.shapes.stamp:
+                return self.shapes
+            routes, raw = {}, b"{}"
+            if stamp is not None:
+                try:
+                    with open(self.path, "rb") as f:
+                        raw = f.read()
+                    routes = {
+                        str(route_id): np.asarray(points, dtype=np.float64).reshape(-1, 2)
+                        for route_id, points in json.loads(raw).items()
+                    }
+                except Exception as e:
+                    print(f"Error loading shapes: {e}")
+                    routes, raw = {}, b"{}"
+            # Swap in one assignment; requests already running keep the old set
+            self.shapes = _ShapeSet(stamp, routes, raw)
+            self.loads += 1
+            return self.shapes
+
+    def get(self, route_ids=None, bbox=None, zoom=None, encoding="polyline"):
+        """
+        PreparedResponse for a query. With no filters this is the file as-is
+        ({route_id: [[lat, lng], ...]}), like the old endpoint.
+
+        bbox is (west, south, east, north) - Leaflet's toBBoxString() order.
+        """
+        shapes = self.refresh()
+        filtered = route_ids is not None or bbox is not None or zoom is not None
+        key = (tuple(route_ids) if route_ids is not None else None, bbox, zoom, encoding if filtered else None)
+        with self.lock:
+            response = shapes.responses.get(key)
+            if response is not None:
+                shapes.responses.move_to_end(key)
+                self.hits += 1
+                return response
+        self.misses += 1
+
+        if not filtered:
+            response = PreparedResponse(shapes.raw_json)
+        else:
+            selected = self._select(shapes, route_ids, bbox)
+            if encoding == "points":
+                payload = {r: self._simplified(shapes, r, zoom).tolist() for r in selected}
+            else:
+                payload = {r: self._encoded(shapes, r, zoom) for r in selected}
+            response = PreparedResponse(json.dumps(payload, separators=(',', ':')).encode())
+
+        with self.lock:
+            shapes.responses[key] = response
+            if len(shapes.responses) > self.cache_size:
+                shapes.responses.popitem(last=False)
+        return response
+
+    def line(self, route_id):
+        """RouteLine of a route's shape (cumulative distances), or None if it has none."""
+        shapes = self.refresh()
+        route_id = str(route_id)
+        line = shapes.lines.get(route_id)
+        if line is None:
+            points = shapes.routes.get(route_id)
+            if points is None or len(points) < 2:
+                return None
+            line = shapes.lines.setdefault(route_id, RouteLine(points))
+        return line
+
+    def build_lines(self):
+        """Build every route's RouteLine up front (run off the event loop at startup)."""
+        shapes = self.refresh()
+        for route_id in list(shapes.routes):
+            self.line(route_id)
+        return len(shapes.lines)
+
+    def _select(self, shapes, route_ids, bbox):
+        if route_ids is not None:
+            candidates = [r for r in route_ids if len(shapes.routes.get(r, ()))]
+        else:
+            candidates = shapes.route_ids
+        if bbox is None:
+            return candidates
+        west, south, east, north = bbox
+        b = shapes.bounds
+        hit = (b[:, 0] <= north) & (b[:, 2] >= south) & (b[:, 1] <= east) & (b[:, 3] >= west)
+        inside = {shapes.route_ids[i] for i in np.flatnonzero(hit)}
+        return [r for r in candidates if r in inside]
+
+    def _simplified(self, shapes, route_id, zoom):
+        points = shapes.routes[route_id]
+        if zoom is None:
+            return points
+        tolerance = zoom_tolerance_m(zoom, float(points[0, 0]), self.tolerance_px)
+        return simplify(points, tolerance)
+
+    def _encoded(self, shapes, route_id, zoom):
+        key = (route_id, zoom)
+        encoded = shapes.encoded.get(key)
+        if encoded is None:
+            encoded = encode_polyline(self._simplified(shapes, route_id, zoom))
+            shapes.encoded[key] = encoded
+        return encoded
+
+    def stats(self):
+        shapes = self.shapes
+        return {
+            "routes": len(shapes.routes),
+            "points": int(sum(len(p) for p in shapes.routes.values())),
+            "loads": self.loads,
+            "cached_responses": len(shapes.responses),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
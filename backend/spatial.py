@@ -0,0 +1,134 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEG_LAT = 111320.0
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    R = EARTH_RADIUS_M # Radius of Earth in meters
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    delta_phi = math.radians(lat2 - lat1)
+    delta_lambda = math.radians(lon2 - lon1)
+
+    a = math.sin(delta_phi / 2.0) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * \
+        math.sin(delta_lambda / 2.0) ** 2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+    return R * c
+
+
+def haversine_np(lat1, lon1, lat2, lon2):
+    """Vectorized haversine in meters; arguments broadcast like numpy arrays."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(np.asarray(lon2) - np.asarray(lon1))
+
+    a = np.sin(delta_phi / 2.0) ** 2 + \
+        np.cos(phi1) * np.cos(phi2) * \
+        np.sin(delta_lambda / 2.0) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex:
+    """
+    Uniform lat/lng bucket grid for fixed-radius lookups.
+
+    Points are hashed into square-ish cells of `cell_m` meters. A query with
+    radius <= cell_m only has to look at the 3x3 block of cells around it,
+    so the cost depends on local density, not on the total number of points.
+    Points can be moved and removed, so the same grid works for live data.
+    """
+
+    def __init__(self, cell_m, ref_lat=28.6):
+        self.cell_m = cell_m
+        self.cell_lat = cell_m / METERS_PER_DEG_LAT
+        self.cell_lng = cell_m / (METERS_PER_DEG_LAT * math.cos(math.radians(ref_lat)))
+        self.cells = {} # (row, col) -> {key: (lat, lng)}
+        self.key_cells = {} # key -> (row, col)
+
+    def __len__(self):
+        return len(self.key_cells)
+
+    def __contains__(self, key):
+        return key in self.key_cells
+
+    def cell_of(self, lat, lng):
+        return (int(math.floor(lat / self.cell_lat)), int(math.floor(lng / self.cell_lng)))
+
+    def insert(self, key, lat, lng):
+        """Add or move a point. Returns the cell it now lives in."""
+        cell = self.cell_of(lat, lng)
+        old_cell = self.key_cells.get(key)
+        if old_cell is not None and old_cell != cell:
+            self._discard(key, old_cell)
+        self.cells.setdefault(cell, {})[key] = (lat, lng)
+        self.key_cells[key] = cell
+        return cell
+
+    def remove(self, key):
+        cell = self.key_cells.pop(key, None)
+        if cell is not None:
+            self._discard(key, cell)
+        return cell
+
+    def _discard(self, key, cell):
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            return
+        bucket.pop(key, None)
+        if not bucket:
+            del self.cells[cell]
+
+    def neighbours(self, lat, lng, radius_m=None):
+        """Yield (key, lat, lng) for every point in the cells covering the radius."""
+        rings = 1
+        if radius_m is not None and radius_m > self.cell_m:
+            rings = int(math.ceil(radius_m / self.cell_m))
+        row, col = self.cell_of(lat, lng)
+        for dr in range(-rings, rings + 1):
+            for dc in range(-rings, rings + 1):
+                bucket = self.cells.get((row + dr, col + dc))
+                if bucket:
+                    for key, (p_lat, p_lng) in bucket.items():
+                        yield key, p_lat, p_lng
+
+    def within(self, west, south, east, north):
+        """Yield the keys of every point inside a lat/lng bounding box."""
+        row_lo, col_lo = self.cell_of(south, west)
+        row_hi, col_hi = self.cell_of(north, east)
+        span = (row_hi - row_lo + 1) * (col_hi - col_lo + 1)
+        if span <= len(self.cells):
+            cells = ((r, c) for r in range(row_lo, row_hi + 1) for c in range(col_lo, col_hi + 1))
+        else:
+            # Box is bigger than the occupied area; walk the occupied cells instead
+            cells = (cell for cell in self.cells
+                     if row_lo <= cell[0] <= row_hi and col_lo <= cell[1] <= col_hi)
+        for cell in cells:
+            bucket = self.cells.get(cell)
+            if not bucket:
+                continue
+            inner = row_lo < cell[0] < row_hi and col_lo < cell[1] < col_hi
+            for key, (lat, lng) in bucket.items():
+                # Cells on the edge of the box need the exact check
+                if inner or (south <= lat <= north and west <= lng <= east):
+                    yield key
+
+    def nearest(self, lat, lng, max_dist, exclude=None):
+        """Return (key, distance) of the closest point within max_dist, or (None, inf)."""
+        best_key = None
+        best_dist = float('inf')
+        for key, p_lat, p_lng in self.neighbours(lat, lng, max_dist):
+            if key == exclude:
+                continue
+            dist = haversine_distance(lat, lng, p_lat, p_lng)
+            if dist < best_dist:
+                best_dist = dist
+                best_key = key
+        if best_dist > max_dist:
+            return None, float('inf')
+        return best_key, best_dist
@@ -0,0 +1,302 @@
+"""
+Shared state for running the backend with several uvicorn workers.
+
+The default ("memory") keeps reports and virtual buses in the worker's own
+process, as before. With STATE_BACKEND=redis, every worker talks to one
+Redis-compatible server (real Redis, or fake_redis_server.py locally):
+
+- /api/broadcast-location pushes the report onto a shared list;
+- one worker at a time holds a short leader lease, drains that list into its
+  ClusterEngine and publishes the virtual bus snapshot with a version number;
+- the other workers only fetch the snapshot when its version changes.
+
+Live reports are also kept in a shared hash, so a worker that takes over the
+lease can rebuild the clusters instead of starting empty.
+"""
+import asyncio
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class RespError(Exception):
+    pass
+
+
+class RespClient:
+    """Minimal blocking Redis protocol (RESP2) client; one connection, one lock."""
+
+    def __init__(self, url, timeout_seconds=5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout_seconds = timeout_seconds
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout_seconds)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        if self.db:
+            self._send(('SELECT', self.db))
+            self._read()
+
+    def _close(self):
+        try:
+            if self._sock is not None:
+                self._sock.close()
+        finally:
+            self._sock = None
+            self._file = None
+
+    def _send(self, args):
+        out = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(f"${len(data)}\r\n".encode())
+            out.append(data)
+            out.append(b"\r\n")
+        self._sock.sendall(b"".join(out))
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Connection closed by state server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RespError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+        raise RespError(f"Unexpected reply: {line!r}")
+
+    def execute(self, *args):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._send(args)
+                except OSError:
+                    # Stale connection: the command never went out, so
+                    # sending it again on a fresh one is safe
+                    self._close()
+                    if attempt:
+                        raise
+                    continue
+                try:
+                    return self._read()
+                except OSError:
+                    # The command may have run (RPUSH, LPOP ...) - never
+                    # resend it; the caller sees the error instead
+                    self._close()
+                    raise
+
+
+# Extend the lease only if we still hold it, in one step: a GET then SET
+# could extend a lease another worker took in between
+RENEW_LEASE_SCRIPT = (
+    "if redis.call('GET', KEYS[1]) == ARGV[1] then "
+    "return redis.call('PEXPIRE', KEYS[1], ARGV[2]) else return 0 end"
+)
+
+
+class RedisStateStore:
+    """Reports queue, live report hash, leader lease and bus snapshot in one Redis."""
+
+    def __init__(self, url, prefix="dsatm"):
+        self.client = RespClient(url)
+        self.prefix = prefix
+
+    def _key(self, name):
+        return f"{self.prefix}:{name}"
+
+    # Ingest (any worker)
+    def push_report(self, report_json):
+        return self.client.execute('RPUSH', self._key('ingest'), report_json)
+
+    def queue_depth(self):
+        return self.client.execute('LLEN', self._key('ingest'))
+
+    def report_count(self):
+        return self.client.execute('HLEN', self._key('reports'))
+
+    # Clustering (leader only)
+    def acquire_lease(self, worker_id, ttl_ms):
+        """Take or renew the leader lease. Returns True if we hold it."""
+        key = self._key('leader')
+        if self.client.execute('SET', key, worker_id, 'NX', 'PX', ttl_ms) == 'OK':
+            return True
+        return self.client.execute('EVAL', RENEW_LEASE_SCRIPT, 1, key, worker_id, ttl_ms) == 1
+
+    def pop_reports(self, max_count):
+        items = self.client.execute('LPOP', self._key('ingest'), max_count)
+        return items or []
+
+    def save_reports(self, reports_by_user):
+        if not reports_by_user:
+            return
+        args = ['HSET', self._key('reports')]
+        for user_id, report_json in reports_by_user.items():
+            args.extend((user_id, report_json))
+        self.client.execute(*args)
+
+    def delete_reports(self, user_ids):
+        if user_ids:
+            self.client.execute('HDEL', self._key('reports'), *user_ids)
+
+    def load_reports(self):
+        flat = self.client.execute('HGETALL', self._key('reports')) or []
+        return [flat[i + 1] for i in range(0, len(flat), 2)]
+
+    def publish_snapshot(self, buses_json):
+        self.client.execute('SET', self._key('buses'), buses_json)
+        return self.client.execute('INCR', self._key('buses_version'))
+
+    # Readers (every worker)
+    def snapshot_version(self):
+        version = self.client.execute('GET', self._key('buses_version'))
+        return int(version) if version is not None else 0
+
+    def load_snapshot(self):
+        return self.client.execute('GET', self._key('buses'))
+
+
+class SharedClusterSync:
+    """
+    Per-worker tick loop for the shared backend.
+
+    The leader drains the shared ingest list into `engine` and publishes;
+    everybody else adopts the published snapshot when its version changes.
+    `parse_report`, `publish_local` and `load_buses` convert between the
+    JSON wire format and main.py's models.
+    """
+
+    def __init__(self, store, engine, lock, parse_report, publish_local, load_buses,
+                 tick_seconds=0.5, batch_size=500, lease_ms=3000):
+        self.store = store
+        self.engine = engine
+        self.lock = lock
+        self.parse_report = parse_report
+        self.publish_local = publish_local # () -> JSON bytes of the new snapshot
+        self.load_buses = load_buses # (JSON bytes) -> None, installs the snapshot
+        self.tick_seconds = tick_seconds
+        self.batch_size = batch_size
+        self.lease_ms = lease_ms
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        self.is_leader = False
+        self._stale = True # Leader must publish even if nothing new arrived
+        self.seen_version = 0
+        self.ticks = 0
+        self.processed = 0
+        self.takeovers = 0
+        self.rejected = 0 # Reports on the shared list we couldn't parse
+        self.errors = 0
+        self.last_tick_ms = 0.0
+
+    def tick(self):
+        started = time.perf_counter()
+        leader = self.store.acquire_lease(self.worker_id, self.lease_ms)
+        if leader and not self.is_leader:
+            self._take_over()
+        self.is_leader = leader
+
+        if leader:
+            self._lead()
+        else:
+            version = self.store.snapshot_version()
+            if version != self.seen_version:
+                payload = self.store.load_snapshot()
+                if payload is not None:
+                    self.load_buses(payload)
+                self.seen_version = version
+        self.ticks += 1
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+
+    def _take_over(self):
+        # Rebuild the clusters from the shared live reports
+        self.takeovers += 1
+        reports = [self.parse_report(raw) for raw in self.store.load_reports()]
+        reports.sort(key=lambda r: r.timestamp)
+        with self.lock:
+            for user_id in list(self.engine.reports):
+                self.engine.remove(user_id)
+            self.engine.upsert_many(reports)
+            evicted = self._evicted()
+        self.store.delete_reports(evicted) # More riders than MAX_ACTIVE_REPORTS were shared
+        self._stale = True
+
+    def _evicted(self):
+        # Riders the engine dropped at its cap during the last upsert_many()
+        # (unless a later report in the same batch brought them back)
+        return [user_id for user_id in self.engine.last_evicted if user_id not in self.engine.reports]
+
+    def _lead(self):
+        raw_reports = []
+        while True:
+            batch = self.store.pop_reports(self.batch_size)
+            raw_reports.extend(batch)
+            if len(batch) < self.batch_size:
+                break
+        parsed = [] # (report, raw json)
+        for raw in raw_reports:
+            try:
+                parsed.append((self.parse_report(raw), raw))
+            except ValueError:
+                self.rejected += 1
+        reports = [report for report, _ in parsed]
+
+        with self.lock:
+            self.engine.upsert_many(reports)
+            evicted = self._evicted()
+            expired = self.engine.expire(time.time())
+            if not (reports or expired or self._stale):
+                return
+            payload = self.publish_local()
+
+        # Evicted riders go with the save, or a takeover would bring them back
+        self.store.save_reports({report.user_id: raw for report, raw in parsed})
+        self.store.delete_reports(expired + evicted)
+        self.seen_version = self.store.publish_snapshot(payload)
+        self._stale = False
+        self.processed += len(reports)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.tick)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error syncing shared state: {e}")
+            await asyncio.sleep(self.tick_seconds)
+
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "is_leader": self.is_leader,
+            "snapshot_version": self.seen_version,
+            "ticks": self.ticks,
+            "processed": self.processed,
+            "takeovers": self.takeovers,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "last_tick_ms": round(self.last_tick_ms, 3),
+        }
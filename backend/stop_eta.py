@@ -0,0 +1,225 @@
+"""
+Next arrivals at a stop: the timetable shifted by live delays.
+
+Scheduled arrivals come from schedule.StopTimetable (per stop, sorted, one
+binary search per query). Each one is adjusted by the best delay we have:
+
+  * "live": an OTD bus is running that exact trip - its delay is taken at
+    the trip stop nearest to it (and stops it has already passed drop out)
+  * "virtual": crowd-sourced virtual buses on the route - median delay of
+    the ones validated against a stop, for trips in service right now
+  * "schedule": nothing known, timetable as-is
+
+Answers are cached per stop for a few seconds, so a popular stop costs one
+lookup per TTL however many riders are polling it.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from schedule import DAY_SECONDS
+from spatial import haversine_np
+
+LIVE_MATCH_RADIUS_M = 400 # A live bus further than this from every stop of its trip is ignored
+MAX_DELAY_SECONDS = 3 * 3600 # Anything bigger is a mismatched trip, not a delay
+IN_SERVICE_SLACK_SECONDS = 600 # A trip counts as running this long before its first / after its last stop time
+
+
+def seconds_of_day(now):
+    """Local seconds since midnight, like the geofence check in main.py."""
+    return int((now + time.localtime(now).tm_gmtoff) % DAY_SECONDS)
+
+
+def format_seconds(seconds):
+    seconds = int(seconds) % DAY_SECONDS
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class StopEtas:
+    """
+    Next-arrival predictions per stop, with a short per-stop TTL cache.
+
+    `dataset()` returns the static data being served (its stop_timetable and
+    trip_stops are used; a GTFS reload swaps the whole object, and cached
+    answers / live delays from the old one are ignored after that).
+    `virtual_buses()` returns the current VirtualBus list (read lazily; route
+    delays are recomputed only when the list object changes) and
+    `route_name(route_id)` the display name. Live delays are pushed with
+    update_live() whenever the OTD feed changes.
+    """
+
+    def __init__(self, dataset, virtual_buses, route_name, ttl_seconds=10.0, horizon_seconds=2 * 3600,
+                 lookback_seconds=1800, cache_size=4096):
+        self.dataset = dataset
+        self.virtual_buses = virtual_buses
+        self.route_name = route_name
+        self.ttl_seconds = ttl_seconds
+        self.horizon_seconds = horizon_seconds
+        self.lookback_seconds = lookback_seconds # how late a bus may run and still show up
+        self.cache_size = cache_size
+
+        self.lock = threading.Lock()
+        # (TripStopTable the rows refer to, {trip row -> (delay seconds, snapshot row of the stop the bus is at)})
+        self.live = (None, {})
+        # (VirtualBus list they came from, route_id -> median delay seconds of its virtual buses)
+        self.route_delays = (None, {})
+        self.cache = OrderedDict() # (stop_id, limit) -> (expires_at, dataset, payload)
+        self.hits = 0
+        self.misses = 0
+        self.live_matched = 0
+
+    def __contains__(self, stop_id):
+        timetable = self.dataset().stop_timetable
+        return timetable is not None and stop_id in timetable
+
+    def update_live(self, buses, now=None):
+        """Work out each live bus's delay on its own trip (called with every new OTD list)."""
+        trip_stops = self.dataset().trip_stops
+        if trip_stops is None or not len(trip_stops):
+            return
+        now = time.time() if now is None else now
+        sod = seconds_of_day(now)
+        delays = {}
+        for bus in buses:
+            trip_row = trip_stops.trip_index.get(str(bus.get('trip_id')))
+            if trip_row is None:
+                continue
+            start, end = int(trip_stops.offsets[trip_row]), int(trip_stops.offsets[trip_row + 1])
+            if end <= start:
+                continue
+            dists = haversine_np(bus['lat'], bus['lng'], trip_stops.lats[start:end], trip_stops.lons[start:end])
+            nearest = int(np.argmin(dists))
+            if dists[nearest] > LIVE_MATCH_RADIUS_M:
+                continue
+            delay = sod - int(trip_stops.arrival_seconds[start + nearest])
+            # Trips past midnight: pick the day shift that makes sense
+            delay = (delay + DAY_SECONDS // 2) % DAY_SECONDS - DAY_SECONDS // 2
+            if abs(delay) > MAX_DELAY_SECONDS:
+                continue
+            delays[trip_row] = (delay, start + nearest)
+        # Rows only mean something with the table they came from, so they travel together
+        self.live = (trip_stops, delays)
+        self.live_matched = len(delays)
+
+    def _live_delays(self, trip_stops):
+        owner, delays = self.live
+        return delays if owner is trip_stops else {} # Not matched against this dataset yet
+
+    def live_delay(self, trip_id):
+        """Delay in seconds of the live bus running `trip_id`, or None if it wasn't matched."""
+        trip_stops = self.dataset().trip_stops
+        if trip_stops is None:
+            return None
+        live = self._live_delays(trip_stops).get(trip_stops.trip_index.get(str(trip_id)))
+        return None if live is None else live[0]
+
+    def _route_delays(self):
+        # Called without the lock: (source, delays) is swapped as one tuple
+        buses = self.virtual_buses()
+        source, route_delays = self.route_delays
+        if buses is source:
+            return route_delays
+        by_route = {}
+        for bus in buses:
+            if not bus.delay_count:
+                continue # Never matched to a stop: its delay is unknown, not zero
+            by_route.setdefault(str(bus.route_id), []).append(bus.delay_minutes * 60)
+        route_delays = {route_id: float(np.median(values)) for route_id, values in by_route.items()}
+        self.route_delays = (buses, route_delays)
+        return route_delays
+
+    @staticmethod
+    def _in_service(trip_stops, trip_row, t):
+        # The virtual buses are running now, so their delay says nothing about trips not started yet
+        times = trip_stops.arrival_seconds[int(trip_stops.offsets[trip_row]):int(trip_stops.offsets[trip_row + 1])]
+        if not len(times):
+            return False
+        return int(times.min()) - IN_SERVICE_SLACK_SECONDS <= t <= int(times.max()) + IN_SERVICE_SLACK_SECONDS
+
+    def arrivals(self, stop_id, limit=5, now=None):
+        """Payload for /api/stops/{stop_id}/arrivals, or None for an unknown stop."""
+        now = time.time() if now is None else now
+        key = (str(stop_id), limit)
+        dataset = self.dataset()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > now and entry[1] is dataset:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        # Outside the lock: misses on different stops (and update_live) don't
+        # queue behind each other. Two misses on one stop both compute; the
+        # answers are the same
+        payload = self._compute(dataset, str(stop_id), limit, now)
+        if payload is None:
+            return None
+        with self.lock:
+            self.cache[key] = (now + self.ttl_seconds, dataset, payload)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return payload
+
+    def _compute(self, dataset, stop_id, limit, now):
+        timetable, trip_stops = dataset.stop_timetable, dataset.trip_stops
+        if timetable is None or stop_id not in timetable:
+            return None
+        trip_delays = self._live_delays(trip_stops)
+        sod = seconds_of_day(now)
+        route_delays = self._route_delays()
+
+        upcoming = []
+        # Today's service, plus yesterday's trips whose times run past 24:00
+        for shift in (0, DAY_SECONDS):
+            t = sod + shift
+            for i in timetable.between(stop_id, t - self.lookback_seconds, t + self.horizon_seconds):
+                scheduled = int(timetable.arrivals[i]) - shift
+                trip_row = int(timetable.trip_rows[i])
+                route_id = timetable.route_id(i)
+                live = trip_delays.get(trip_row)
+                if live is not None:
+                    delay, bus_row = live
+                    if timetable.rows[i] < bus_row:
+                        continue # Bus is already past this stop
+                    source = "live"
+                elif route_id in route_delays and self._in_service(trip_stops, trip_row, t):
+                    delay, source = route_delays[route_id], "virtual"
+                else:
+                    delay, source = 0, "schedule"
+                expected = scheduled + delay
+                if expected < sod:
+                    continue
+                upcoming.append((expected, scheduled, delay, source, trip_row, route_id))
+
+        upcoming.sort(key=lambda item: item[0])
+        arrivals = []
+        for expected, scheduled, delay, source, trip_row, route_id in upcoming[:limit]:
+            arrivals.append({
+                "trip_id": str(trip_stops.trip_ids[trip_row]),
+                "route_id": route_id,
+                "route_name": self.route_name(route_id),
+                "scheduled": format_seconds(scheduled),
+                "expected": format_seconds(expected),
+                "eta_minutes": round((expected - sod) / 60, 1),
+                "delay_minutes": round(delay / 60, 1),
+                "source": source,
+            })
+        return {
+            "stop_id": stop_id,
+            "stop_name": timetable.stop_name(stop_id),
+            "generated_at": now,
+            "arrivals": arrivals,
+        }
+
+    def stats(self):
+        timetable = self.dataset().stop_timetable
+        return {
+            "stops": len(timetable) if timetable is not None else 0,
+            "cached": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "live_trips": self.live_matched,
+        }
@@ -0,0 +1,279 @@
+"""
+Virtual bus tracks on top of the rider clusters.
+
+Clusters come and go as riders move, merge and expire - a rider who moves
+further than the cluster radius between two reports starts a new cluster.
+A Track follows one physical bus across those changes: each published
+cluster is tied to a track (new clusters are matched to a free track whose
+predicted position is close, otherwise they start one), and the track
+smooths position and speed with a constant-velocity Kalman filter. On
+routes that have a shape the filter runs along the route (1-D, metres from
+the start, see route_line.py), otherwise on a local x/y plane. Between
+reports a track's position can be predicted from its velocity.
+"""
+import math
+
+from spatial import METERS_PER_DEG_LAT, haversine_distance
+
+MAX_SPEED_MPS = 30.0 # ~110 km/h; anything faster is noise
+
+
+class AxisFilter:
+    """Constant-velocity Kalman filter on one axis: state (position, velocity)."""
+
+    __slots__ = ('p', 'v', 'P00', 'P01', 'P11')
+
+    def __init__(self, position, position_var, velocity_var=25.0):
+        self.p = position
+        self.v = 0.0
+        self.P00 = position_var
+        self.P01 = 0.0
+        self.P11 = velocity_var
+
+    def predict(self, dt, accel_var):
+        if dt <= 0:
+            return
+        self.p += self.v * dt
+        # P = F P F' + Q, with Q from white-noise acceleration
+        dt2 = dt * dt
+        self.P00 += 2 * dt * self.P01 + dt2 * self.P11 + accel_var * dt2 * dt2 / 4
+        self.P01 += dt * self.P11 + accel_var * dt2 * dt / 2
+        self.P11 += accel_var * dt2
+
+    def update(self, z, meas_var):
+        s = self.P00 + meas_var
+        k0 = self.P00 / s
+        k1 = self.P01 / s
+        residual = z - self.p
+        self.p += k0 * residual
+        self.v = min(max(self.v + k1 * residual, -MAX_SPEED_MPS), MAX_SPEED_MPS)
+        P00, P01 = self.P00, self.P01
+        self.P00 = (1 - k0) * P00
+        self.P01 = (1 - k0) * P01
+        self.P11 -= k1 * P01
+
+
+class Track:
+    __slots__ = ('id', 'seq', 'route_id', 'line', 'axes', 'born', 't', 'cluster_id', 'updates', 'lat0')
+
+    def __init__(self, track_id, seq, route_id, line, lat, lng, t, meas_var):
+        self.id = track_id
+        self.seq = seq # creation order; older tracks win merges
+        self.route_id = route_id
+        self.line = line # RouteLine or None
+        self.born = t
+        self.t = t # time of the last measurement
+        self.cluster_id = None
+        self.updates = 0
+        self.lat0 = lat
+        if line is not None:
+            along, _ = line.project(lat, lng)
+            self.axes = (AxisFilter(along, meas_var),)
+        else:
+            x, y = self._to_xy(lat, lng)
+            self.axes = (AxisFilter(x, meas_var), AxisFilter(y, meas_var))
+
+    def _to_xy(self, lat, lng):
+        return lng * METERS_PER_DEG_LAT * math.cos(math.radians(self.lat0)), lat * METERS_PER_DEG_LAT
+
+    def _from_xy(self, x, y):
+        return y / METERS_PER_DEG_LAT, x / (METERS_PER_DEG_LAT * math.cos(math.radians(self.lat0)))
+
+    def update(self, lat, lng, t, accel_var, meas_var):
+        dt = t - self.t
+        for axis in self.axes:
+            axis.predict(dt, accel_var)
+        if self.line is not None:
+            along, _ = self.line.project(lat, lng, hint=self.axes[0].p)
+            self.axes[0].update(along, meas_var)
+        else:
+            x, y = self._to_xy(lat, lng)
+            self.axes[0].update(x, meas_var)
+            self.axes[1].update(y, meas_var)
+        self.t = max(self.t, t)
+        self.updates += 1
+
+    def position(self, t=None):
+        """(lat, lng) now, or extrapolated to time t at the current velocity."""
+        dt = 0.0 if t is None else max(0.0, t - self.t)
+        if self.line is not None:
+            return self.line.point_at(self.axes[0].p + self.axes[0].v * dt)
+        return self._from_xy(self.axes[0].p + self.axes[0].v * dt, self.axes[1].p + self.axes[1].v * dt)
+
+    @property
+    def speed_mps(self):
+        return math.sqrt(sum(axis.v * axis.v for axis in self.axes))
+
+
+class BusTracker:
+    """
+    Keeps one Track per bus and publishes cluster buses under track ids.
+
+    Call update() with what ClusterEngine.publish() just changed; it returns
+    nothing but fills `buses` (track id -> bus) and `last_changed` /
+    `last_removed` like the engine does. `line_for(route_id)` returns the
+    route's RouteLine or None.
+    """
+
+    def __init__(self, line_for, retarget, gate_m=150.0, reacquire_seconds=60.0,
+                 accel_sigma=0.3, meas_sigma_m=15.0, max_predict_seconds=30.0, young_seconds=30.0):
+        self.line_for = line_for
+        self.retarget = retarget # (cluster bus, track) -> published bus
+        self.gate_m = gate_m
+        self.reacquire_seconds = reacquire_seconds
+        self.accel_var = accel_sigma ** 2
+        self.meas_var = meas_sigma_m ** 2
+        self.max_predict_seconds = max_predict_seconds
+        self.young_seconds = young_seconds
+
+        self.tracks = {} # track id -> Track
+        self.cluster_track = {} # cluster id -> track id
+        self.free = {} # route_id -> {track id} without a cluster, waiting to be re-acquired
+        self.buses = {} # track id -> published bus
+        self.last_changed = []
+        self.last_removed = []
+        self._next_id = 0
+        self.created = 0
+        self.reacquired = 0
+        self.merged = 0
+
+    def __len__(self):
+        return len(self.buses)
+
+    def update(self, changed, removed, now):
+        """`changed`: cluster buses (id, route_id, lat, lng, last_updated); `removed`: cluster ids."""
+        out_changed = {}
+        out_removed = set()
+        freed = []
+
+        # Clusters that vanished free their track (it may be picked up again
+        # by a new cluster, e.g. the same riders a bit further along)
+        for cluster_id in removed:
+            track_id = self.cluster_track.pop(cluster_id, None)
+            if track_id is None:
+                continue
+            track = self.tracks[track_id]
+            track.cluster_id = None
+            self.free.setdefault(track.route_id, set()).add(track_id)
+            freed.append(track)
+            if self.buses.pop(track_id, None) is not None:
+                out_removed.add(track_id)
+
+        for bus in changed:
+            track_id = self.cluster_track.get(bus.id)
+            if track_id is not None:
+                track = self.tracks[track_id]
+                if bus.last_updated > track.t:
+                    track.update(bus.lat, bus.lng, bus.last_updated, self.accel_var, self.meas_var)
+                # else: a rider left or the cluster merged - the centroid shifted
+                # but there is no newer measurement, so leave the filter alone
+            else:
+                track = self._acquire(bus)
+                self.cluster_track[bus.id] = track.id
+                track.cluster_id = bus.id
+            self.buses[track.id] = self.retarget(bus, track)
+            out_changed[track.id] = self.buses[track.id]
+            out_removed.discard(track.id)
+
+        # When riders report one at a time (sync ingest), the first one to
+        # move past the cluster radius starts a new cluster - and a new track -
+        # while the old cluster is still alive. Once the old cluster goes, a
+        # young track near its prediction is the same bus: hand its cluster
+        # back to the old track so the id stays put
+        for track in freed:
+            if track.cluster_id is not None:
+                continue # Already re-acquired above
+            young = self._young_neighbour(track)
+            if young is None:
+                continue
+            self._merge(young, track)
+            out_changed.pop(young.id, None)
+            out_removed.add(young.id)
+            out_removed.discard(track.id)
+            out_changed[track.id] = self.buses[track.id]
+
+        # Tracks nobody picked up in time are gone for good
+        for route_id, free_ids in list(self.free.items()):
+            for track_id in list(free_ids):
+                if now - self.tracks[track_id].t > self.reacquire_seconds:
+                    free_ids.discard(track_id)
+                    del self.tracks[track_id]
+            if not free_ids:
+                del self.free[route_id]
+
+        self.last_changed = list(out_changed.values())
+        self.last_removed = list(out_removed)
+        return list(self.buses.values())
+
+    def _young_neighbour(self, track):
+        best, best_dist = None, self.gate_m
+        for other in self.tracks.values():
+            if (other is track or other.cluster_id is None or other.route_id != track.route_id
+                    or other.seq < track.seq or other.t - other.born > self.young_seconds):
+                continue
+            lat, lng = track.position(min(other.t, track.t + self.max_predict_seconds))
+            other_lat, other_lng = other.position()
+            dist = haversine_distance(lat, lng, other_lat, other_lng)
+            if dist <= best_dist:
+                best, best_dist = other, dist
+        return best
+
+    def _merge(self, young, track):
+        # `track` takes over young's cluster, fed with young's latest position
+        lat, lng = young.position()
+        track.update(lat, lng, young.t, self.accel_var, self.meas_var)
+        track.cluster_id = young.cluster_id
+        self.cluster_track[young.cluster_id] = track.id
+        self.free[track.route_id].discard(track.id)
+        bus = self.buses.pop(young.id)
+        del self.tracks[young.id]
+        self.buses[track.id] = self.retarget(bus, track)
+        self.merged += 1
+
+    def _acquire(self, bus):
+        # Nearest free track on the route whose prediction is within the gate
+        best, best_dist = None, self.gate_m
+        for track_id in self.free.get(bus.route_id, ()):
+            track = self.tracks[track_id]
+            lat, lng = track.position(min(bus.last_updated, track.t + self.max_predict_seconds))
+            dist = haversine_distance(bus.lat, bus.lng, lat, lng)
+            if dist <= best_dist:
+                best, best_dist = track, dist
+        if best is not None:
+            self.free[bus.route_id].discard(best.id)
+            best.update(bus.lat, bus.lng, bus.last_updated, self.accel_var, self.meas_var)
+            self.reacquired += 1
+            return best
+
+        track_id = f"vbus_{bus.route_id}_{self._next_id}"
+        track = Track(track_id, self._next_id, bus.route_id, self.line_for(bus.route_id), bus.lat, bus.lng,
+                      bus.last_updated, self.meas_var)
+        self._next_id += 1
+        self.tracks[track_id] = track
+        self.created += 1
+        return track
+
+    def predicted(self, now, move, buses=None):
+        """
+        Published buses (or just `buses`, e.g. last_changed) with positions
+        extrapolated to `now` (at most max_predict_seconds ahead).
+        """
+        out = []
+        items = tuple(self.buses.items()) if buses is None else [(bus.id, bus) for bus in buses]
+        for track_id, bus in items:
+            track = self.tracks.get(track_id)
+            if track is None:
+                continue
+            lat, lng = track.position(min(now, track.t + self.max_predict_seconds))
+            out.append(move(bus, lat, lng))
+        return out
+
+    def stats(self):
+        return {
+            "tracks": len(self.tracks),
+            "published": len(self.buses),
+            "free": sum(len(ids) for ids in self.free.values()),
+            "created": self.created,
+            "reacquired": self.reacquired,
+            "merged": self.merged,
+        }
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class TripResolver:
+    """
+    Live trip_id -> route name, memoized.
+
+    Resolution order is the one get_buses always used: direct trip lookup,
+    then the route_id prefix of the trip id ("1879_0_6" -> "1879"), then a
+    "Route <prefix>" placeholder. Results (including misses) are kept in a
+    bounded LRU, so a vehicle that stays on the same trip costs one dict
+    lookup per poll.
+
+    Trip ids that don't match the static data are collected once each and
+    written to `unknown_log_path` by flush(), off the request path.
+
+    `dataset()` returns the static data currently served (anything with
+    trip_to_route and route_id_to_name). When it returns a different object
+    (GTFS hot reload) the cache starts over; counters and the unknown-id log
+    carry on.
+    """
+
+    def __init__(self, dataset, cache_size=50000,
+                 unknown_log_path="unknown_routes.log", max_unknown=100000):
+        self.dataset = dataset
+        self.cache_size = cache_size
+        self.current = (None, OrderedDict()) # (dataset, trip_id -> (route_name, matched))
+
+        self.unknown_log_path = unknown_log_path
+        self.max_unknown = max_unknown
+        self.unknown_ids = set()
+        self.pending_unknown = []
+        self._lock = threading.Lock()
+
+        # Counters
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.matched_trip = 0
+        self.matched_route = 0
+        self.unmatched = 0
+
+    @property
+    def cache(self):
+        return self.current[1]
+
+    def resolve(self, trip_id):
+        dataset = self.dataset()
+        owner, cache = self.current
+        if owner is not dataset:
+            # New static data: fresh cache, tied to the dataset it was filled from
+            cache = OrderedDict()
+            self.current = (dataset, cache)
+            self.unknown_ids = set() # The new data may know them
+        entry = cache.get(trip_id)
+        if entry is not None:
+            self.cache_hits += 1
+            cache.move_to_end(trip_id)
+        else:
+            self.cache_misses += 1
+            entry = self._resolve_uncached(dataset, trip_id)
+            cache[trip_id] = entry
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+        route_name, matched = entry
+        if matched == "trip":
+            self.matched_trip += 1
+        elif matched == "route":
+            self.matched_route += 1
+        else:
+            self.unmatched += 1
+        return route_name
+
+    def _resolve_uncached(self, dataset, trip_id):
+        trip_to_route, route_id_to_name = dataset.trip_to_route, dataset.route_id_to_name
+        # Strategy 1: Direct Trip ID Lookup
+        route_name = trip_to_route.get(trip_id)
+        matched = "trip"
+
+        # Strategy 2: Extract Route ID from Trip ID (e.g. "1879_0_6" -> "1879")
+        if not route_name:
+            potential_route_id = trip_id.split('_')[0]
+            route_name = route_id_to_name.get(potential_route_id)
+            matched = "route"
+
+            # If still not found, use the ID itself as a fallback
+            if not route_name:
+                route_name = f"Route {potential_route_id}"
+                matched = None
+
+        # NaN (from pandas) in the static maps
+        if route_name != route_name:
+            route_name = "Unknown Route"
+            matched = None
+
+        if matched is None:
+            self._record_unknown(trip_id)
+        return str(route_name), matched
+
+    def _record_unknown(self, trip_id):
+        if trip_id in self.unknown_ids or len(self.unknown_ids) >= self.max_unknown:
+            return
+        self.unknown_ids.add(trip_id)
+        with self._lock:
+            self.pending_unknown.append(trip_id)
+
+    def flush(self):
+        """Append newly seen unknown trip ids to the log file."""
+        with self._lock:
+            pending, self.pending_unknown = self.pending_unknown, []
+        if not pending:
+            return 0
+        with open(self.unknown_log_path, "a") as f:
+            for trip_id in pending:
+                f.write(f"Unmatched Live Trip ID: '{trip_id}'\n")
+        return len(pending)
+
+    async def run_flusher(self, interval_seconds=30.0):
+        try:
+            while True:
+                await asyncio.sleep(interval_seconds)
+                try:
+                    await asyncio.to_thread(self.flush)
+                except Exception as e:
+                    print(f"Error writing {self.unknown_log_path}: {e}")
+        finally:
+            # Don't lose what we collected on shutdown
+            self.flush()
+
+    def stats(self):
+        lookups = self.matched_trip + self.matched_route + self.unmatched
+        return {
+            "cache_size": len(self.cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "matched_trip": self.matched_trip,
+            "matched_route": self.matched_route,
+            "unmatched": self.unmatched,
+            "match_rate": round((lookups - self.unmatched) / lookups, 4) if lookups else None,
+            "unknown_trip_ids": len(self.unknown_ids),
+        }
@@ -0,0 +1,117 @@
+from collections import namedtuple
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+StopTime = namedtuple('StopTime', ['stop_id', 'stop_lat', 'stop_lon', 'arrival_seconds'])
+
+
+class TripStopTable(Mapping):
+    """
+    Stop times of every trip in CSR layout.
+
+    One contiguous array per column (stop id, lat, lon, arrival seconds),
+    with the rows of trip i in offsets[i]:offsets[i + 1]. This replaces a
+    dict per stop time: the arrays can come straight from the memory-mapped
+    snapshot, and arrival times are already integer seconds.
+
+    Behaves like a read-only {trip_id: TripView} mapping.
+    """
+
+    def __init__(self, trip_ids, offsets, stop_ids, lats, lons, arrival_seconds, stop_id_values=None):
+        self.trip_ids = trip_ids
+        self.offsets = offsets
+        self.stop_ids = stop_ids
+        self.lats = lats
+        self.lons = lons
+        self.arrival_seconds = arrival_seconds
+        # Set when stop_ids are dictionary codes rather than the ids themselves
+        self.stop_id_values = stop_id_values
+        self.trip_index = {str(trip_id): i for i, trip_id in enumerate(trip_ids)}
+
+    @classmethod
+    def from_snapshot(cls, columns):
+        """Build from gtfs_snapshot.load_merged_stops() columns without copying."""
+        return cls(
+            trip_ids=columns['_trip_ids'],
+            offsets=columns['_trip_offsets'],
+            stop_ids=columns['stop_id'],
+            lats=columns['stop_lat'],
+            lons=columns['stop_lon'],
+            arrival_seconds=columns['arrival_seconds'],
+            stop_id_values=columns.get('stop_id__values'),
+        )
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.zeros(1, dtype=np.int64), *(np.empty(0) for _ in range(4)))
+
+    def __getitem__(self, trip_id):
+        i = self.trip_index[str(trip_id)]
+        return TripView(self, str(trip_id), int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def __iter__(self):
+        return iter(self.trip_index)
+
+    def __len__(self):
+        return len(self.trip_index)
+
+    def __contains__(self, trip_id):
+        return str(trip_id) in self.trip_index
+
+    def stop_id_at(self, row):
+        code = self.stop_ids[row]
+        if self.stop_id_values is not None:
+            return str(self.stop_id_values[code])
+        return code.item() if hasattr(code, 'item') else code
+
+
+class TripView(Sequence):
+    """Read-only view of one trip's stop times, in arrival order."""
+
+    __slots__ = ('table', 'trip_id', 'start', 'end')
+
+    def __init__(self, table, trip_id, start, end):
+        self.table = table
+        self.trip_id = trip_id
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        row = self.start + i
+        table = self.table
+        return StopTime(
+            table.stop_id_at(row),
+            float(table.lats[row]),
+            float(table.lons[row]),
+            int(table.arrival_seconds[row]),
+        )
+
+    # Column slices (numpy views into the shared arrays, not copies)
+    @property
+    def lats(self):
+        return self.table.lats[self.start:self.end]
+
+    @property
+    def lons(self):
+        return self.table.lons[self.start:self.end]
+
+    @property
+    def arrival_seconds(self):
+        return self.table.arrival_seconds[self.start:self.end]
+
+    @property
+    def stop_ids(self):
+        return self.table.stop_ids[self.start:self.end]
+
+    def __repr__(self):
+        return f"TripView({self.trip_id!r}, {len(self)} stops)"